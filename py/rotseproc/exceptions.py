@@ -11,3 +11,9 @@ class ReferenceException(Exception):
     def __str__(self):
         return "Reference Exception: %s"%(repr(self.value))
 
+
+class LockException(Exception):
+    def __init__(self,value):
+        self.value=value
+    def __str__(self):
+        return "Lock Exception: %s"%(repr(self.value))
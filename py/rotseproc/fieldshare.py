@@ -0,0 +1,130 @@
+"""
+Sharing field-level products between co-located targets
+
+Targets in the same field and telescope whose night ranges overlap share their
+frames, so the field-level steps (finding data, frame rejection, coaddition,
+source extraction and zero points) run once over the union of the ranges into
+a shared product area. Each target then links the coadds of its own nights and
+runs only the target-specific steps.
+"""
+import os
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Pipeline steps whose products only depend on field, telescope and nights
+FIELD_STEPS = ('Find_Data', 'Frame_Quality', 'Coaddition', 'Source_Extraction', 'Zero_Points')
+
+def night_range(night, t_before, t_after):
+    """
+    First and last night searched for a target, see rotseproc.io.supernova.supernova_date_range
+    """
+    from rotseproc.io.supernova import supernova_date_range
+    dates = supernova_date_range(night, t_before, t_after)
+    return dates[0], dates[-1]
+
+def field_dir(field, telescope, first, last):
+    """
+    Shared product directory of a field, relative to the redux directory
+    """
+    return os.path.join('fields', '{}_{}_{}-{}'.format(telescope, field, first, last))
+
+def group_targets(targets, t_before, t_after, minshare=2):
+    """
+    Group targets by field and telescope with overlapping night ranges
+
+    Args:
+        targets  : list of (name, args) with night, telescope, field, ra and dec args
+                   as queued by rotseproc.jobqueue
+        t_before, t_after : Find_Data search range around single discovery nights
+    Optional:
+        minshare : smallest number of targets worth sharing field products
+
+    Returns:
+        list of groups with FIELD, TELESCOPE, NIGHT ([first, last]), DIR and
+        TARGETS ({name: [first, last]}), and the list of targets run on their own
+    """
+    from rotseproc.rotse_config import parse_coordinates
+    from rotseproc.io.supernova import find_supernova_field
+
+    byfield = {}
+    single = []
+    for name, args in targets:
+        field = args['field']
+        if field is None and args['ra'] is not None:
+            ra, dec = parse_coordinates(args['ra'], args['dec'])
+            if ra is not None:
+                field = find_supernova_field(ra, dec)
+        if field is None or len(args['night']) == 0:
+            single.append(name)
+            continue
+        first, last = night_range(args['night'], t_before, t_after)
+        # Fields are given with (sks0246+3652) or without the survey prefix, group on the coordinates part
+        byfield.setdefault((field[-9:], args['telescope']), []).append((int(first), int(last), first, last, name, field))
+
+    groups = []
+    for (coords, telescope), members in sorted(byfield.items()):
+        # The field job keeps the full field name, with the prefix if any target gives it,
+        # so its data and metrics are found under the same field as standalone runs
+        field = max((m[5] for m in members), key=len)
+        # Merge overlapping night ranges
+        members.sort()
+        clusters = []
+        for m in members:
+            if len(clusters) > 0 and m[0] <= clusters[-1][-1][1]:
+                clusters[-1].append(m)
+                clusters[-1].sort(key=lambda x: x[1])
+            else:
+                clusters.append([m])
+        for cl in clusters:
+            if len(cl) < minshare:
+                single += [m[4] for m in cl]
+                continue
+            first = min(cl, key=lambda x: x[0])[2]
+            last = max(cl, key=lambda x: x[1])[3]
+            groups.append({'FIELD'     : field,
+                           'TELESCOPE' : telescope,
+                           'NIGHT'     : [first, last],
+                           'DIR'       : field_dir(field, telescope, first, last),
+                           'TARGETS'   : {m[4]: [m[2], m[3]] for m in cl}})
+            log.info("Sharing field {} {} from {} to {} between {} targets".format(
+                field, telescope, first, last, len(cl)))
+
+    return groups, single
+
+def link_field_products(fielddir, outdir, first=None, last=None):
+    """
+    Link the shared coadds of a field into a target output directory
+
+    Only coadds of nights between first and last (yymmdd) are linked, so the
+    target steps see the same coadds as a standalone run.
+
+    Returns:
+        number of linked coadds
+    """
+    from rotseproc.io.findfile import findfile
+    from rotseproc.io.output import makedirs
+
+    ncoadd = 0
+    for sub in ('image', 'prod'):
+        src = os.path.join(fielddir, 'coadd', sub)
+        dest = os.path.join(outdir, 'coadd', sub)
+        makedirs(dest)
+        for f in sorted(os.listdir(src)):
+            night = f[:6]
+            if first is not None and night.isdigit() and not (int(first) <= int(night) <= int(last)):
+                continue
+            link = os.path.join(dest, f)
+            if not os.path.lexists(link):
+                os.symlink(os.path.abspath(os.path.join(src, f)), link)
+            if sub == 'image':
+                ncoadd += 1
+
+    zpfile = findfile('zeropoints', fielddir)
+    if os.path.exists(zpfile) and not os.path.lexists(findfile('zeropoints', outdir)):
+        os.symlink(os.path.abspath(zpfile), findfile('zeropoints', outdir))
+
+    log.info("Linked {} coadds of {} into {}".format(ncoadd, fielddir, outdir))
+
+    return ncoadd
@@ -0,0 +1,233 @@
+"""
+Shared-memory store of frames for process-pool workers
+
+Frames (or stamps of them) are read once by the parent process into shared
+memory segments. Workers get a small picklable handle instead of the array and
+attach to it as a zero-copy read-only numpy view, so neither pickling the pixels
+nor re-reading the FITS file is paid per task. The store counts references to
+each frame and frees a segment when its last reference is released. Frames that
+would exceed the memory cap are spilled to memory mapped files instead.
+"""
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+import numpy as np
+from multiprocessing import shared_memory
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Picklable reference to a stored frame, kind is 'shm' (name is the segment) or 'mmap' (name is the file)
+FrameHandle = namedtuple('FrameHandle', ['key', 'kind', 'name', 'shape', 'dtype'])
+
+#- Segments and memory maps attached by this process, kept open while their views are in use
+_attached = {}
+
+def _open_segment(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before python 3.13 attaching registers the segment again with the
+        # resource tracker that pool workers share with the store, which is harmless
+        return shared_memory.SharedMemory(name=name)
+
+def attach(handle):
+    """
+    Read-only numpy view of a stored frame, for use in worker processes
+    """
+    if handle.kind == 'shm':
+        if handle.name not in _attached:
+            _attached[handle.name] = _open_segment(handle.name)
+        data = np.ndarray(handle.shape, dtype=handle.dtype, buffer=_attached[handle.name].buf)
+    else:
+        if handle.name not in _attached:
+            _attached[handle.name] = np.memmap(handle.name, dtype=handle.dtype, mode='r', shape=handle.shape)
+        data = _attached[handle.name].view()
+    data.flags.writeable = False
+    return data
+
+def detach(handle=None):
+    """
+    Close the segment of a handle attached by this process, or all of them
+
+    Views of a closed segment must not be used any more.
+    """
+    names = list(_attached) if handle is None else [handle.name]
+    for name in names:
+        seg = _attached.pop(name, None)
+        if isinstance(seg, shared_memory.SharedMemory):
+            seg.close()
+
+class FrameStore:
+    """
+    Frames in shared memory, reference counted and capped
+
+    Args:
+        maxbytes : shared memory budget in bytes, frames beyond it are spilled
+                   to memory mapped files (None for no cap)
+    Optional:
+        spilldir : directory of spilled frames (default a temporary directory)
+
+    Use as a context manager, or call close, to free all frames.
+    """
+    def __init__(self, maxbytes=None, spilldir=None):
+        self.maxbytes = maxbytes
+        self._spilldir = spilldir
+        self._tmpdir = None
+        self._frames = {}
+        self._refs = {}
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.nspilled = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __contains__(self, key):
+        return key in self._frames
+
+    def __len__(self):
+        return len(self._frames)
+
+    def _spillfile(self):
+        if self._spilldir is None:
+            self._tmpdir = self._tmpdir or tempfile.mkdtemp(prefix='rotse_frames_')
+            spilldir = self._tmpdir
+        else:
+            spilldir = self._spilldir
+            os.makedirs(spilldir, exist_ok=True)
+        fd, filename = tempfile.mkstemp(prefix='frame', suffix='.dat', dir=spilldir)
+        os.close(fd)
+        return filename
+
+    def put(self, key, data):
+        """
+        Store a copy of an array, or take a reference to the frame already stored under key
+
+        Returns:
+            FrameHandle to pass to workers
+        """
+        with self._lock:
+            if key in self._frames:
+                self._refs[key] += 1
+                return self._frames[key][0]
+
+            data = np.ascontiguousarray(data)
+            nbytes = max(data.nbytes, 1)
+            if self.maxbytes is None or self.nbytes + nbytes <= self.maxbytes:
+                seg = shared_memory.SharedMemory(create=True, size=nbytes)
+                handle = FrameHandle(key, 'shm', seg.name, data.shape, data.dtype.str)
+                self.nbytes += nbytes
+            else:
+                filename = self._spillfile()
+                seg = np.memmap(filename, dtype=data.dtype, mode='w+', shape=data.shape)
+                handle = FrameHandle(key, 'mmap', filename, data.shape, data.dtype.str)
+                self.nspilled += 1
+                log.debug("Frame store is over {} bytes, spilling {} to {}".format(self.maxbytes, key, filename))
+
+            view = np.ndarray(data.shape, dtype=data.dtype, buffer=seg.buf if handle.kind == 'shm' else seg)
+            view[...] = data
+            if handle.kind == 'mmap':
+                seg.flush()
+            self._frames[key] = (handle, seg, nbytes)
+            self._refs[key] = 1
+            return handle
+
+    def load(self, filename, section=None):
+        """
+        Read an image (or a stamp of it) once and store it
+
+        Args:
+            filename : FITS image
+        Optional:
+            section  : tuple of slices of the stamp to keep, only these rows are read
+
+        Returns:
+            FrameHandle, the frame is keyed by its path and section
+        """
+        key = (os.path.abspath(filename), repr(section))
+        with self._lock:
+            if key in self._frames:
+                self._refs[key] += 1
+                return self._frames[key][0]
+
+        from astropy.io import fits
+        from rotseproc.io.fitsimage import image_hdu
+        with fits.open(filename, memmap=True) as hdul:
+            data = image_hdu(hdul).data
+            if section is not None:
+                data = data[section]
+            # FITS data is big endian, store it in native byte order
+            data = data.astype(data.dtype.newbyteorder('='), copy=False)
+            return self.put(key, data)
+
+    def get(self, key):
+        """
+        Read-only view of a frame in this process
+        """
+        return attach(self._frames[key][0])
+
+    def acquire(self, handle):
+        """
+        Take another reference to a stored frame
+        """
+        with self._lock:
+            self._refs[handle.key] += 1
+        return handle
+
+    def release(self, handle):
+        """
+        Drop a reference to a frame, freeing it with the last reference
+
+        Returns:
+            number of references left
+        """
+        with self._lock:
+            key = handle.key
+            if key not in self._refs:
+                return 0
+            self._refs[key] -= 1
+            if self._refs[key] > 0:
+                return self._refs[key]
+            self._free(key)
+            return 0
+
+    def _free(self, key):
+        handle, seg, nbytes = self._frames.pop(key)
+        del self._refs[key]
+        detach(handle)
+        if handle.kind == 'shm':
+            seg.close()
+            seg.unlink()
+            self.nbytes -= nbytes
+        else:
+            del seg
+            try:
+                os.remove(handle.name)
+            except OSError:
+                pass
+
+    def utilization(self):
+        """
+        Dictionary of NFRAMES, NBYTES in shared memory and NSPILLED frames
+        """
+        with self._lock:
+            nspilled = sum(1 for h, s, n in self._frames.values() if h.kind == 'mmap')
+            return {'NFRAMES': len(self._frames), 'NBYTES': self.nbytes, 'NSPILLED': nspilled}
+
+    def close(self):
+        """
+        Free every frame regardless of references
+        """
+        with self._lock:
+            for key in list(self._frames):
+                self._free(key)
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
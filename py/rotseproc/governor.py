@@ -0,0 +1,221 @@
+"""
+Node-wide governor of processes, memory and I/O streams
+
+Every parallel stage (external tools, staging threads, header reads, plot
+workers) reserves the capacity it needs before it starts and releases it when
+it is done. Reservations are leases in a small SQLite database on local disk,
+so all pipeline processes on a node (e.g. several queue workers) share the same
+limits. Leases of processes that died are dropped the next time anyone
+reserves, and a reservation larger than a limit is clipped to it so it can
+still run alone.
+"""
+import os
+import time
+import sqlite3
+import tempfile
+import contextlib
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Governed resources: processes, bytes of memory and concurrent I/O streams
+RESOURCES = ('procs', 'memory', 'io')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    pid     INTEGER NOT NULL,
+    procs   INTEGER NOT NULL,
+    memory  REAL NOT NULL,
+    io      INTEGER NOT NULL,
+    label   TEXT,
+    started REAL NOT NULL
+);
+"""
+
+def default_statefile():
+    """
+    Governor database shared by the pipeline processes of this node
+    """
+    return os.path.join(tempfile.gettempdir(), 'rotse_governor.db')
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Governor:
+    """
+    Limits on the processes, memory and I/O streams used by all pipeline
+    processes of a node
+
+    Optional:
+        maxprocs  : number of processes (external tools, workers) running at once
+        memory    : memory budget in bytes
+        maxio     : number of concurrent I/O streams (file copies, header reads)
+        statefile : lease database, on local disk (default default_statefile())
+        poll      : seconds between tries while waiting for capacity
+
+    Limits that are None are not enforced, without any limit reservations
+    return immediately and nothing is recorded.
+    """
+    def __init__(self, maxprocs=None, memory=None, maxio=None, statefile=None, poll=1.):
+        self.limits = {'procs': maxprocs, 'memory': memory, 'io': maxio}
+        self.statefile = statefile if statefile is not None else default_statefile()
+        self.poll = poll
+
+    @property
+    def enabled(self):
+        return any(v is not None for v in self.limits.values())
+
+    def _connect(self):
+        conn = sqlite3.connect(self.statefile, timeout=60., isolation_level=None)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _reap(self, conn):
+        pids = [row[0] for row in conn.execute("SELECT DISTINCT pid FROM leases")]
+        dead = [(p,) for p in pids if not _alive(p)]
+        if len(dead) > 0:
+            conn.executemany("DELETE FROM leases WHERE pid = ?", dead)
+            log.debug("Dropped leases of {} dead processes".format(len(dead)))
+
+    def _request(self, procs, memory, io):
+        # Clip requests to the limits so an oversized task can still run alone
+        request = {'procs': procs, 'memory': memory, 'io': io}
+        for key, limit in self.limits.items():
+            if limit is not None and request[key] > limit:
+                log.debug("Clipping {} request {} to the limit {}".format(key, request[key], limit))
+                request[key] = limit
+        return request
+
+    def try_acquire(self, procs=0, memory=0, io=0, label=None):
+        """
+        Reserve capacity if it is available now
+
+        Returns:
+            lease id, or None if the capacity is in use
+        """
+        if not self.enabled:
+            return 0
+        request = self._request(procs, memory, io)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._reap(conn)
+            used = conn.execute("SELECT COALESCE(SUM(procs),0), COALESCE(SUM(memory),0), COALESCE(SUM(io),0) FROM leases").fetchone()
+            for key, inuse in zip(RESOURCES, used):
+                limit = self.limits[key]
+                if limit is not None and request[key] > 0 and inuse + request[key] > limit:
+                    conn.execute("ROLLBACK")
+                    return None
+            cur = conn.execute("INSERT INTO leases (pid, procs, memory, io, label, started) VALUES (?,?,?,?,?,?)",
+                               (os.getpid(), int(request['procs']), float(request['memory']), int(request['io']),
+                                label, time.time()))
+            conn.execute("COMMIT")
+            return cur.lastrowid
+        finally:
+            conn.close()
+
+    def acquire(self, procs=0, memory=0, io=0, label=None, timeout=None):
+        """
+        Reserve capacity, waiting until it is available
+
+        Optional:
+            timeout : seconds to wait before raising TimeoutError (None to wait forever)
+
+        Returns:
+            lease id to release
+        """
+        tstart = time.time()
+        waiting = False
+        while True:
+            lease = self.try_acquire(procs, memory, io, label)
+            if lease is not None:
+                if waiting:
+                    log.info("Got capacity for {} after {:.0f} s".format(label, time.time() - tstart))
+                return lease
+            if not waiting:
+                log.info("Waiting for capacity for {} (procs={}, memory={:.2g} GB, io={})".format(
+                    label, procs, memory/1e9, io))
+                waiting = True
+            if timeout is not None and time.time() - tstart > timeout:
+                raise TimeoutError("No capacity for {} after {} s".format(label, timeout))
+            time.sleep(self.poll)
+
+    def release(self, lease):
+        """
+        Release a lease returned by acquire
+        """
+        if not self.enabled or lease is None:
+            return
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM leases WHERE id = ?", (lease,))
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def reserve(self, procs=0, memory=0, io=0, label=None, timeout=None):
+        """
+        Hold capacity for the duration of a block
+        """
+        lease = self.acquire(procs, memory, io, label, timeout)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def utilization(self):
+        """
+        Live use of the node
+
+        Returns:
+            dictionary with the USED and LIMIT of each resource and the LEASES
+            (pid, procs, memory, io, label, seconds held) of running processes
+        """
+        out = {key.upper(): {'USED': 0, 'LIMIT': self.limits[key]} for key in RESOURCES}
+        out['LEASES'] = []
+        if not os.path.exists(self.statefile):
+            return out
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._reap(conn)
+            conn.execute("COMMIT")
+            now = time.time()
+            for pid, procs, memory, io, label, started in conn.execute(
+                    "SELECT pid, procs, memory, io, label, started FROM leases ORDER BY started"):
+                out['PROCS']['USED'] += procs
+                out['MEMORY']['USED'] += memory
+                out['IO']['USED'] += io
+                out['LEASES'].append({'pid': pid, 'procs': procs, 'memory': memory, 'io': io,
+                                      'label': label, 'held': now - started})
+        finally:
+            conn.close()
+        return out
+
+#- Governor shared by all PAs, QAs and services of this process
+_governor = None
+
+def setup_governor(maxprocs=None, memory=None, maxio=None, statefile=None):
+    """
+    Replace the shared governor, memory is the budget in bytes
+    """
+    global _governor
+    _governor = Governor(maxprocs, memory, maxio, statefile)
+    return _governor
+
+def get_governor():
+    """
+    Return the shared governor, without limits if none was set up
+    """
+    global _governor
+    if _governor is None:
+        _governor = Governor()
+    return _governor
@@ -0,0 +1,115 @@
+"""
+I/O functions for sobj/cobj source catalogs
+"""
+import numpy as np
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Catalog quantities and the column names they go by in SExtractor and ROTSE catalogs
+CATALOG_COLUMNS = {'X'           : ('X_IMAGE', 'X'),
+                   'Y'           : ('Y_IMAGE', 'Y'),
+                   'RA'          : ('ALPHA_J2000', 'RA'),
+                   'DEC'         : ('DELTA_J2000', 'DEC'),
+                   'MAG'         : ('MAG_AUTO', 'MAG_APER', 'M_APER'),
+                   'MAGERR'      : ('MAGERR_AUTO', 'MAGERR_APER', 'MERR_APER'),
+                   'FWHM'        : ('FWHM_IMAGE', 'FWHM'),
+                   'BACKGROUND'  : ('BACKGROUND', 'SKY'),
+                   'ELLIPTICITY' : ('ELLIPTICITY',),
+                   'FLAGS'       : ('FLAGS',)}
+
+def _find_column(names, quantity):
+    upper = {n.upper(): n for n in names}
+    for alias in CATALOG_COLUMNS.get(quantity, (quantity,)):
+        if alias.upper() in upper:
+            return upper[alias.upper()]
+    return None
+
+def read_catalog(filename, columns, ext=1):
+    """
+    Read selected columns of a catalog without loading the rest of the table
+
+    Args:
+        filename : sobj/cobj FITS file
+        columns  : quantities to read, keys of CATALOG_COLUMNS or column names
+    Optional:
+        ext      : table extension
+
+    Returns:
+        dictionary of float arrays, NaN filled for quantities missing from the
+        catalog. Vector columns (several apertures) return the first element.
+    """
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdul:
+        table = hdul[ext].data
+        nrows = 0 if table is None else len(table)
+        names = [] if table is None else table.columns.names
+        out = {}
+        for col in columns:
+            name = _find_column(names, col)
+            if name is None:
+                out[col] = np.full(nrows, np.nan)
+                continue
+            values = np.asarray(table[name], dtype=float)
+            if values.ndim > 1:
+                values = values.reshape(nrows, -1)[:, 0]
+            out[col] = values.copy()
+
+    return out
+
+def stack_catalogs(filenames, columns, ext=1):
+    """
+    Read selected columns of many catalogs into flat arrays
+
+    Returns:
+        seg  : index of the catalog of each row
+        data : dictionary of concatenated float arrays, see read_catalog
+    """
+    parts = [read_catalog(f, columns, ext) for f in filenames]
+    nrows = [len(p[columns[0]]) if len(columns) > 0 else 0 for p in parts]
+    seg = np.repeat(np.arange(len(filenames)), nrows)
+    data = {}
+    for col in columns:
+        data[col] = np.concatenate([p[col] for p in parts]) if len(parts) > 0 else np.zeros(0)
+
+    return seg, data
+
+def cutout_catalog(filename, outfile, origin, shape, ext=1):
+    """
+    Write the sources of a catalog inside a cutout of its frame, with positions on the cutout grid
+
+    Args:
+        filename : sobj/cobj FITS file of the full frame
+        outfile  : catalog of the cutout
+        origin   : (x, y) of the first pixel of the cutout in the frame
+        shape    : (ny, nx) of the cutout
+    Optional:
+        ext      : table extension
+
+    Returns:
+        number of sources kept
+    """
+    from astropy.io import fits
+    from rotseproc.io.output import atomic_output
+    with fits.open(filename) as hdul:
+        hdu = hdul[ext]
+        table = hdu.data
+        keep = np.zeros(0, dtype=bool)
+        if table is not None:
+            xname = _find_column(table.columns.names, 'X')
+            yname = _find_column(table.columns.names, 'Y')
+            x = np.asarray(table[xname], dtype=float) - origin[0]
+            y = np.asarray(table[yname], dtype=float) - origin[1]
+            # The half pixel margin keeps sources on the edge pixels for 0 and 1 based positions
+            keep = (x > -0.5) & (x < shape[1] + 0.5) & (y > -0.5) & (y < shape[0] + 0.5)
+            table = table[keep]
+            table[xname] = x[keep]
+            table[yname] = y[keep]
+            hdul[ext] = fits.BinTableHDU(table, header=hdu.header)
+        hdul[ext].header['CUTX0'] = (origin[0], 'x origin of cutout in original frame')
+        hdul[ext].header['CUTY0'] = (origin[1], 'y origin of cutout in original frame')
+        with atomic_output(outfile) as tmpfile:
+            hdul.writeto(tmpfile)
+
+    return int(keep.sum())
@@ -10,7 +10,9 @@ def findfile(filetype, outdir):
     # Set up dictionary for file locations
     filedict = {'lightcurve' : '{}/{}.pdf',
                 'qafile'     : '{}/{}.json',
-                'qafig'      : '{}/{}.pdf'}
+                'qafig'      : '{}/{}.pdf',
+                'mergedqa'   : '{}/{}.jsonl',
+                'zeropoints' : '{}/{}.fits'}
 
     # Return file for specific filetype
     outfile = filedict[filetype].format(outdir, filetype)
@@ -0,0 +1,105 @@
+"""
+I/O functions for plain and tile-compressed FITS images
+"""
+import os
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Tile compression algorithms supported for output images
+COMPRESSION_TYPES = ('RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1', 'PLIO_1')
+
+def image_hdu(hdul):
+    """
+    First HDU holding image data, a CompImageHDU for tile-compressed files
+    """
+    from astropy.io import fits
+    for hdu in hdul:
+        if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and hdu.header.get('NAXIS', 0) > 0:
+            return hdu
+    return hdul[0]
+
+def is_compressed(filename):
+    """
+    Check whether a FITS file stores its image tile-compressed
+    """
+    from astropy.io import fits
+    with fits.open(filename) as hdul:
+        return isinstance(image_hdu(hdul), fits.CompImageHDU)
+
+def read_image(filename, header=True):
+    """
+    Read image data (and header) from a plain or tile-compressed FITS file
+    """
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdul:
+        hdu = image_hdu(hdul)
+        data = hdu.data.copy() if hdu.data is not None else None
+        if header:
+            return data, hdu.header.copy()
+    return data
+
+def read_header(filename):
+    """
+    Read the image header from a plain or tile-compressed FITS file without reading pixels
+    """
+    from astropy.io import fits
+    with fits.open(filename, memmap=True) as hdul:
+        return image_hdu(hdul).header.copy()
+
+def write_image(filename, data, header=None, compression=None, quantize_level=16., overwrite=False):
+    """
+    Write an image as plain or tile-compressed FITS
+
+    Args:
+        filename : output file
+        data     : image array
+    Optional:
+        header         : image header
+        compression    : one of COMPRESSION_TYPES, None for an uncompressed image
+        quantize_level : quantization level of floating point images
+    """
+    from astropy.io import fits
+    if compression is None:
+        fits.writeto(filename, data, header, overwrite=overwrite)
+        return
+
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError("Compression {} is not one of {}".format(compression, COMPRESSION_TYPES))
+
+    hdu = fits.CompImageHDU(data, header, compression_type=compression, quantize_level=quantize_level)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(filename, overwrite=overwrite)
+
+def convert_image(infile, outfile, compression=None, quantize_level=16.):
+    """
+    Copy a FITS image, (de)compressing it on the way
+
+    The output is written under a temporary name and renamed into place,
+    so infile and outfile can be the same file.
+    """
+    from rotseproc.io.output import atomic_output
+    data, header = read_image(infile)
+    with atomic_output(outfile) as tmpfile:
+        write_image(tmpfile, data, header, compression=compression, quantize_level=quantize_level, overwrite=True)
+
+def compress_products(outdir, compression, quantize_level=16., subdirs=('preproc', 'coadd', 'sub')):
+    """
+    Tile-compress the images of a finished run in place
+
+    External tools (IDL, SExtractor) can't read compressed images, so this
+    runs once the pipeline has finished.
+    """
+    import glob
+    nfiles = 0
+    for sub in subdirs:
+        for image in sorted(glob.glob(os.path.join(outdir, sub, 'image', '*.fit*'))):
+            # Linked products are shared with other runs and compressed by the run that made them
+            if os.path.islink(image):
+                continue
+            if not is_compressed(image):
+                convert_image(image, image, compression=compression, quantize_level=quantize_level)
+                nfiles += 1
+    log.info("Compressed {} images in {} with {}".format(nfiles, outdir, compression))
+
+    return nfiles
@@ -0,0 +1,159 @@
+"""
+Persistent cache of selected FITS header keywords
+
+Opening a frame on network storage just to read a keyword costs more than the
+keyword is worth. The cache keeps the selected keywords of every frame it has
+seen in a local SQLite database, keyed by absolute path, size and mtime, so a
+frame is read again only when it changes. Missing entries are filled by
+header-only reads in a thread pool.
+"""
+import os
+import json
+import sqlite3
+import numpy as np
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Keywords cached by default: saturation, timing and WCS
+DEFAULT_KEYS = ('SATCNTS', 'EXPTIME', 'MJD', 'DATE-OBS', 'NAXIS1', 'NAXIS2',
+                'CTYPE1', 'CTYPE2', 'CRVAL1', 'CRVAL2', 'CRPIX1', 'CRPIX2',
+                'CD1_1', 'CD1_2', 'CD2_1', 'CD2_2')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS headers (
+    path   TEXT PRIMARY KEY,
+    size   INTEGER NOT NULL,
+    mtime  REAL NOT NULL,
+    header TEXT NOT NULL
+);
+"""
+
+def _file_key(filename):
+    path = os.path.abspath(filename)
+    st = os.stat(path)
+    return path, st.st_size, st.st_mtime
+
+def _read_keys(filename, keys):
+    from rotseproc.io.fitsimage import read_header
+    header = read_header(filename)
+    return {k: header[k] if k in header else None for k in keys}
+
+class HeaderCache:
+    """
+    Cache of FITS header keywords
+
+    Args:
+        dbfile : cache database
+    Optional:
+        keys     : keywords to cache
+        nthreads : number of parallel header reads when filling the cache
+    """
+    def __init__(self, dbfile, keys=DEFAULT_KEYS, nthreads=8, timeout=30.):
+        self.dbfile = dbfile
+        self.keys = tuple(keys)
+        self.nthreads = nthreads
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+        self._conn = sqlite3.connect(dbfile, timeout=timeout)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def headers(self, filenames, keys=None):
+        """
+        Cached keywords of a list of files, reading the headers of new or changed files
+
+        Keywords missing from a header are None.
+
+        Returns:
+            list of dictionaries, one per file
+        """
+        keys = self.keys if keys is None else tuple(keys)
+        filekeys = [_file_key(f) for f in filenames]
+
+        # Look up all files in one query, SQLite limits the number of parameters
+        cached = {}
+        paths = [fk[0] for fk in filekeys]
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i+500]
+            sql = "SELECT path, size, mtime, header FROM headers WHERE path IN ({})".format(','.join('?'*len(chunk)))
+            for path, size, mtime, header in self._conn.execute(sql, chunk):
+                cached[path] = (size, mtime, json.loads(header))
+
+        result = [None] * len(filekeys)
+        missing = []
+        for i, (path, size, mtime) in enumerate(filekeys):
+            entry = cached.get(path)
+            if entry is not None and entry[0] == size and entry[1] == mtime and all(k in entry[2] for k in keys):
+                result[i] = entry[2]
+            else:
+                missing.append(i)
+
+        if len(missing) > 0:
+            # Read every cached keyword so later lookups of other keys hit as well
+            readkeys = tuple(self.keys) + tuple(k for k in keys if k not in self.keys)
+            from concurrent.futures import ThreadPoolExecutor
+            from rotseproc.governor import get_governor
+            nthreads = max(1, min(self.nthreads, len(missing)))
+            with get_governor().reserve(io=nthreads, label='header reads'), ThreadPoolExecutor(max_workers=nthreads) as pool:
+                headers = list(pool.map(lambda i: _read_keys(filekeys[i][0], readkeys), missing))
+
+            rows = []
+            for i, header in zip(missing, headers):
+                result[i] = header
+                path, size, mtime = filekeys[i]
+                rows.append((path, size, mtime, json.dumps(header)))
+            with self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO headers VALUES (?,?,?,?)", rows)
+            log.debug("Read {} of {} headers, {} cached".format(len(missing), len(filekeys), len(filekeys)-len(missing)))
+
+        return [{k: h[k] for k in keys} for h in result]
+
+    def lookup(self, filenames, keys=None):
+        """
+        Vectorized keyword lookup
+
+        Returns:
+            numpy structured array with one row per file and one column per keyword,
+            float columns (NaN where missing) for numeric keywords and object
+            columns otherwise
+        """
+        keys = self.keys if keys is None else tuple(keys)
+        headers = self.headers(filenames, keys)
+
+        columns = []
+        for k in keys:
+            values = [h[k] for h in headers]
+            if all(v is None or (isinstance(v, (int, float)) and not isinstance(v, bool)) for v in values):
+                columns.append(np.array([np.nan if v is None else v for v in values], dtype=float))
+            else:
+                columns.append(np.array(values, dtype=object))
+
+        dtype = [(k, c.dtype) for k, c in zip(keys, columns)]
+        table = np.empty(len(headers), dtype=dtype)
+        for k, c in zip(keys, columns):
+            table[k] = c
+        return table
+
+    def get(self, filename, key):
+        """
+        Single cached keyword of a file
+        """
+        return self.headers([filename], [key])[0][key]
+
+    def prune(self):
+        """
+        Remove entries of files that no longer exist
+
+        Returns:
+            number of removed entries
+        """
+        paths = [row[0] for row in self._conn.execute("SELECT path FROM headers")]
+        gone = [(p,) for p in paths if not os.path.exists(p)]
+        with self._conn:
+            self._conn.executemany("DELETE FROM headers WHERE path = ?", gone)
+        return len(gone)
@@ -0,0 +1,189 @@
+"""
+Columnar store of supernova light curves for many targets
+"""
+import os
+import json
+import numpy as np
+from rotseproc import rlogger
+from rotseproc.io.output import OutputLock, makedirs, temp_name
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Columns of the light curve store, in addition to TARGET_ID
+LC_COLUMNS = [('MJD', 'f8'), ('ROTSE_MAG', 'f8'), ('MAG_ERR', 'f8')]
+
+class LightCurveStore:
+    """
+    Appendable light curve store with a target index
+
+    Each column is a raw binary file in the store directory, read through
+    np.memmap, and index.json maps each target to its id and its block of
+    rows. Upserting a target appends a new block and drops the old one from
+    the index, compact() reclaims the space of dropped blocks.
+
+    The store is shared by concurrent pipelines, so upsert and compact hold
+    the OutputLock of the store directory (waiting for it) while they re-read
+    the index, write the columns and replace the index.
+    """
+    def __init__(self, path):
+        self.path = path
+        makedirs(path)
+        self._indexfile = os.path.join(path, 'index.json')
+        self._dtypes = dict([('TARGET_ID', 'i4')] + LC_COLUMNS)
+        self._read_index()
+
+    def _colfile(self, col):
+        return os.path.join(self.path, col + '.bin')
+
+    def _read_index(self):
+        if os.path.exists(self._indexfile):
+            with open(self._indexfile, 'r') as f:
+                self._index = json.load(f)
+        else:
+            self._index = {'nrows': 0, 'nextid': 0, 'targets': {}}
+
+    def _write_index(self):
+        tmpfile = temp_name(self._indexfile)
+        with open(tmpfile, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmpfile, self._indexfile)
+
+    def _column(self, col):
+        nrows = self._index['nrows']
+        if nrows == 0:
+            return np.zeros(0, dtype=self._dtypes[col])
+        return np.memmap(self._colfile(col), dtype=self._dtypes[col], mode='r', shape=(nrows,))
+
+    def _live(self):
+        """ Boolean mask of rows that belong to the current block of a target """
+        live = np.zeros(self._index['nrows'], dtype=bool)
+        for t in self._index['targets'].values():
+            live[t['start']:t['stop']] = True
+        return live
+
+    @property
+    def targets(self):
+        """ Names of the targets in the store """
+        return sorted(self._index['targets'])
+
+    def target_ids(self):
+        """ Dictionary of target id to target name """
+        return {t['id']: name for name, t in self._index['targets'].items()}
+
+    def upsert(self, target, mjd, mag, magerr):
+        """
+        Insert or replace the light curve of a target
+        """
+        with OutputLock(self.path, blocking=True):
+            # Other pipelines may have written since this store was opened
+            self._read_index()
+            data = {'MJD': mjd, 'ROTSE_MAG': mag, 'MAG_ERR': magerr}
+            nnew = len(mjd)
+            if target in self._index['targets']:
+                tid = self._index['targets'][target]['id']
+            else:
+                tid = self._index['nextid']
+                self._index['nextid'] += 1
+            data['TARGET_ID'] = np.full(nnew, tid)
+
+            # Write past the last indexed row, so bytes from an interrupted upsert are overwritten
+            start = self._index['nrows']
+            for col, dtype in self._dtypes.items():
+                values = np.ascontiguousarray(data[col], dtype=dtype)
+                colfile = self._colfile(col)
+                with open(colfile, 'r+b' if os.path.exists(colfile) else 'wb') as f:
+                    f.seek(start * np.dtype(dtype).itemsize)
+                    f.write(values.tobytes())
+                    f.truncate()
+
+            self._index['nrows'] = start + nnew
+            self._index['targets'][target] = {'id': tid, 'start': start, 'stop': start + nnew}
+            self._write_index()
+            log.info("Stored {} light curve points for {}".format(nnew, target))
+
+    def get(self, target):
+        """
+        Light curve of one target as a dictionary of column arrays
+        """
+        if target not in self._index['targets']:
+            raise KeyError("No light curve for {} in {}".format(target, self.path))
+        t = self._index['targets'][target]
+        return {col: np.array(self._column(col)[t['start']:t['stop']]) for col, dtype in LC_COLUMNS}
+
+    def query(self, targets=None, mjd_range=None, mag_range=None):
+        """
+        Vectorized selection of light curve points
+
+        Optional:
+            targets   : list of target names (default all)
+            mjd_range : [mjd_lo, mjd_hi]
+            mag_range : [mag_lo, mag_hi]
+
+        Returns:
+            dictionary of column arrays including TARGET_ID, see target_ids()
+        """
+        select = self._live()
+        if targets is not None:
+            ids = [self._index['targets'][t]['id'] for t in targets if t in self._index['targets']]
+            select &= np.isin(self._column('TARGET_ID'), ids)
+        if mjd_range is not None:
+            mjd = self._column('MJD')
+            select &= (mjd >= mjd_range[0]) & (mjd <= mjd_range[1])
+        if mag_range is not None:
+            mag = self._column('ROTSE_MAG')
+            select &= (mag >= mag_range[0]) & (mag <= mag_range[1])
+
+        rows = np.flatnonzero(select)
+        return {col: self._column(col)[rows] for col in self._dtypes}
+
+    def export_fits(self, target, filename, overwrite=True):
+        """
+        Write the light curve of one target to a FITS table
+        """
+        from astropy.table import Table
+        output = Table(self.get(target), names=[col for col, dtype in LC_COLUMNS])
+        output.meta['TARGET'] = target
+        output.write(filename, overwrite=overwrite)
+
+    def compact(self):
+        """
+        Rewrite the store keeping only the current block of each target
+        """
+        with OutputLock(self.path, blocking=True):
+            self._read_index()
+            rows = np.flatnonzero(self._live())
+            if rows.size == self._index['nrows']:
+                return
+            targets = sorted(self._index['targets'].items(), key=lambda t: t[1]['start'])
+            columns = {col: np.array(self._column(col)[rows]) for col in self._dtypes}
+
+            # Live rows keep their order, so each block shifts down by the dropped rows before it
+            start = 0
+            for name, t in targets:
+                n = t['stop'] - t['start']
+                t['start'], t['stop'] = start, start + n
+                start += n
+
+            for col, values in columns.items():
+                tmpfile = temp_name(self._colfile(col))
+                values.tofile(tmpfile)
+                os.replace(tmpfile, self._colfile(col))
+            self._index['nrows'] = rows.size
+            self._write_index()
+
+def write_light_curve_features(filename, features, target_names=None):
+    """
+    Write light curve features from rotseproc.pa.palib.light_curve_features to a FITS table
+
+    Optional:
+        target_names : dictionary of target id to name, e.g. LightCurveStore.target_ids()
+    """
+    from astropy.table import Table
+    from rotseproc.io.output import write_table
+    output = Table(features)
+    if target_names is not None:
+        output.add_column([target_names.get(int(i), '') for i in features['TARGET_ID']], name='TARGET', index=0)
+    write_table(output, filename)
+
+    return
@@ -0,0 +1,153 @@
+"""
+Historical store of QA metrics across pipeline runs
+"""
+import os
+import time
+import sqlite3
+import numpy as np
+from rotseproc import rlogger, exceptions
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    runtime   REAL NOT NULL,
+    target    TEXT,
+    field     TEXT,
+    telescope TEXT,
+    night     TEXT,
+    step      TEXT NOT NULL,
+    metric    TEXT NOT NULL,
+    value     REAL
+);
+CREATE INDEX IF NOT EXISTS metrics_lookup ON metrics (metric, step, telescope, field, runtime);
+CREATE INDEX IF NOT EXISTS metrics_target ON metrics (target, night);
+"""
+
+_COLUMNS = ('runtime', 'target', 'field', 'telescope', 'night', 'step', 'metric', 'value')
+
+class MetricsStore:
+    """
+    SQLite store of scalar QA metrics, one row per run, step and metric
+
+    Every pipeline run appends its metrics, and the history is used to derive
+    rolling reference values and ranges for the QAs
+    """
+    def __init__(self, dbfile, timeout=30.):
+        self.dbfile = dbfile
+        dbdir = os.path.dirname(os.path.abspath(dbfile))
+        if not os.path.exists(dbdir):
+            os.makedirs(dbdir)
+        self._conn = sqlite3.connect(dbfile, timeout=timeout)
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def append(self, step, metrics, target=None, field=None, telescope=None, night=None, runtime=None):
+        """
+        Add the scalar numeric metrics of one pipeline step
+
+        Args:
+            step    : pipeline step name (e.g. Coaddition)
+            metrics : dictionary of QA metrics, non scalar or non numeric entries are skipped
+        Optional:
+            target, field, telescope, night : keys for this run
+            runtime : time of the run (default now)
+        """
+        if runtime is None:
+            runtime = time.time()
+        if isinstance(night, (list, tuple)):
+            night = ' '.join(night)
+
+        rows = []
+        for key, val in metrics.items():
+            try:
+                val = np.asarray(val, dtype=float)
+            except (TypeError, ValueError):
+                continue
+            if val.size != 1:
+                continue
+            rows.append((runtime, target, field, telescope, night, step.upper(), key, float(val)))
+
+        with self._conn:
+            self._conn.executemany("INSERT INTO metrics VALUES (?,?,?,?,?,?,?,?)", rows)
+
+        return len(rows)
+
+    def query(self, metric, step=None, target=None, field=None, telescope=None, night=None, limit=None):
+        """
+        Query the history of a metric, most recent runs first
+
+        Keys given as None are not used to select rows.
+
+        Returns:
+            numpy structured array with the columns of the store
+        """
+        where = ["metric = ?"]
+        args = [metric]
+        for col, val in (('step', step.upper() if step else None), ('target', target), ('field', field),
+                         ('telescope', telescope), ('night', night)):
+            if val is not None:
+                where.append("{} = ?".format(col))
+                args.append(val)
+        sql = "SELECT {} FROM metrics WHERE {} ORDER BY runtime DESC".format(', '.join(_COLUMNS), ' AND '.join(where))
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+
+        rows = self._conn.execute(sql, args).fetchall()
+        dtype = [('runtime', 'f8'), ('target', 'O'), ('field', 'O'), ('telescope', 'O'),
+                 ('night', 'O'), ('step', 'O'), ('metric', 'O'), ('value', 'f8')]
+        return np.array(rows, dtype=dtype)
+
+    def query_runs(self, step, metrics, target=None, field=None, telescope=None, limit=None):
+        """
+        Metrics recorded together by each run of a step, most recent runs first
+
+        Returns:
+            numpy structured array with a runtime column and one column per metric
+            (NaN where a run didn't record the metric)
+        """
+        cols = ', '.join("MAX(CASE WHEN metric = ? THEN value END)" for m in metrics)
+        where = ["step = ?"]
+        args = list(metrics) + [step.upper()]
+        for col, val in (('target', target), ('field', field), ('telescope', telescope)):
+            if val is not None:
+                where.append("{} = ?".format(col))
+                args.append(val)
+        sql = "SELECT runtime, {} FROM metrics WHERE {} GROUP BY runtime, target ORDER BY runtime DESC".format(cols, ' AND '.join(where))
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+
+        rows = [tuple(np.nan if v is None else v for v in row) for row in self._conn.execute(sql, args).fetchall()]
+        dtype = [('runtime', 'f8')] + [(m, 'f8') for m in metrics]
+        return np.array(rows, dtype=dtype)
+
+    def reference(self, metric, step=None, field=None, telescope=None, window=50, minruns=5,
+                  normal_pct=(16., 84.), warn_pct=(2.5, 97.5)):
+        """
+        Rolling reference value and ranges for a metric
+
+        The reference is the median of the last window runs and the ranges are
+        percentile bands of those runs, expressed as reference - metric as used
+        by rotseproc.qa.qas.evaluate_QA_status. The field is required, so the
+        references of a field are never pooled with those of other fields.
+
+        Returns:
+            dictionary with REF, NORMAL_RANGE and WARN_RANGE entries, or None
+            if fewer than minruns runs are available
+        """
+        if field is None:
+            raise exceptions.ParameterException("Reference of {} needs a field".format(metric))
+        values = self.query(metric, step=step, field=field, telescope=telescope, limit=window)['value']
+        values = values[np.isfinite(values)]
+        if values.size < minruns:
+            return None
+
+        ref = np.median(values)
+        nlo, nhi, wlo, whi = np.percentile(values, [normal_pct[0], normal_pct[1], warn_pct[0], warn_pct[1]])
+
+        return {'REF': [float(ref)],
+                'NORMAL_RANGE': [float(ref - nhi), float(ref - nlo)],
+                'WARN_RANGE': [float(ref - whi), float(ref - wlo)]}
@@ -0,0 +1,202 @@
+"""
+Atomic, concurrency-safe writing of pipeline products
+
+Products are written under a hidden temporary name in their target directory
+and renamed into place once complete, so a killed or overlapping run never
+leaves a half-written product where later steps (or their glob patterns) would
+pick it up. OutputLock keeps two workers from processing the same output
+directory at once.
+"""
+import os
+import re
+import glob
+import errno
+import fcntl
+import shutil
+import threading
+import contextlib
+from rotseproc import rlogger
+from rotseproc.exceptions import LockException
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Advisory lock file of an output directory
+LOCKFILE = '.rotse.lock'
+
+#- Names made by temp_name
+_TEMP_NAME = re.compile(r'^\..*\.tmp\d+-\d+(\.[^.]*)?$')
+
+def makedirs(*paths):
+    """
+    Create directories with their parents, directories that exist are left alone
+    """
+    for path in paths:
+        os.makedirs(path, exist_ok=True)
+
+def temp_name(filename):
+    """
+    Hidden temporary name next to filename, unique to this process and thread
+
+    The extension is kept so writers that pick the format from it still work.
+    """
+    dirname, basename = os.path.split(filename)
+    stem, ext = os.path.splitext(basename)
+    return os.path.join(dirname, '.{}.tmp{}-{}{}'.format(stem, os.getpid(), threading.get_ident(), ext))
+
+def is_temp(filename):
+    """
+    Check whether a file name was made by temp_name
+    """
+    return _TEMP_NAME.match(os.path.basename(filename)) is not None
+
+@contextlib.contextmanager
+def atomic_output(filename):
+    """
+    Write a file under a temporary name and rename it to filename when the block succeeds
+
+        with atomic_output('lightcurve.fits') as tmpfile:
+            table.write(tmpfile)
+
+    If the block raises, the temporary file is removed and filename is untouched.
+    """
+    tmpfile = temp_name(filename)
+    try:
+        yield tmpfile
+        os.replace(tmpfile, filename)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+def write_table(table, filename, **kwargs):
+    """
+    Atomically write an astropy Table, replacing filename
+    """
+    with atomic_output(filename) as tmpfile:
+        table.write(tmpfile, overwrite=True, **kwargs)
+
+def copy_file(src, dest):
+    """
+    Atomically copy a file to dest
+    """
+    with atomic_output(dest) as tmpfile:
+        shutil.copyfile(src, tmpfile)
+
+def commit(src, dest):
+    """
+    Move a finished file into place
+
+    A rename within a file system is atomic, across file systems the file is
+    copied under a temporary name next to dest first.
+    """
+    try:
+        os.replace(src, dest)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(src, dest)
+        os.remove(src)
+
+def commit_files(files, destdir):
+    """
+    Move finished files into destdir, keeping their names
+
+    Returns:
+        list of the moved files in destdir
+    """
+    makedirs(destdir)
+    out = []
+    for f in files:
+        dest = os.path.join(destdir, os.path.basename(f))
+        commit(f, dest)
+        out.append(dest)
+    return out
+
+def remove_stale(pattern):
+    """
+    Remove files matching pattern, e.g. outputs an external tool left behind in
+    its working directory when a previous run was killed
+
+    Only call this while holding the OutputLock of the directory.
+
+    Returns:
+        number of removed files
+    """
+    stale = glob.glob(pattern)
+    for f in stale:
+        os.remove(f)
+    if len(stale) > 0:
+        log.info("Removed {} files left by an earlier run ({})".format(len(stale), pattern))
+    return len(stale)
+
+class OutputLock:
+    """
+    Advisory lock of an output directory, held while a pipeline processes it
+
+    Args:
+        outdir   : output directory, created if needed
+    Optional:
+        blocking : wait for the lock instead of raising LockException
+
+    The lock is a flock on outdir/.rotse.lock, which the kernel releases when
+    the process exits, so a killed run never leaves a stale lock. Taking the
+    lock removes temporary files left by killed runs in outdir and its
+    subdirectories, skipping subdirectories with a lock file of their own:
+    those belong to other runs (e.g. other targets under $ROTSE_REDUX) or
+    shared stores, which clean up after themselves. Use as a context manager
+    or call acquire and release.
+    """
+    def __init__(self, outdir, blocking=False):
+        self.outdir = outdir
+        self.blocking = blocking
+        self.lockfile = os.path.join(outdir, LOCKFILE)
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self):
+        if self._fd is not None:
+            return
+        makedirs(self.outdir)
+        fd = os.open(self.lockfile, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if self.blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            holder = os.read(fd, 64).decode(errors='replace').strip()
+            os.close(fd)
+            raise LockException("{} is being processed by another run (pid {})".format(self.outdir, holder or '?'))
+        except BaseException:
+            os.close(fd)
+            raise
+        # Record the holder for the message of runs that find the directory locked
+        os.ftruncate(fd, 0)
+        os.write(fd, '{}\n'.format(os.getpid()).encode())
+        self._fd = fd
+
+        nstale = 0
+        for dirpath, dirnames, filenames in os.walk(self.outdir):
+            # Don't descend into directories locked (now or earlier) by other runs
+            dirnames[:] = [d for d in dirnames if not os.path.exists(os.path.join(dirpath, d, LOCKFILE))]
+            for f in filenames:
+                if is_temp(f):
+                    os.remove(os.path.join(dirpath, f))
+                    nstale += 1
+        if nstale > 0:
+            log.info("Removed {} temporary files of killed runs from {}".format(nstale, self.outdir))
+
+    def release(self):
+        if self._fd is None:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
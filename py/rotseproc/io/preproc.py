@@ -2,8 +2,15 @@
 I/O functions for preprocessed files
 """
 import os
-from shutil import copyfile
+import queue
+import itertools
+import threading
+import contextvars
+import numpy as np
 from rotseproc import rlogger
+from rotseproc.governor import get_governor
+from rotseproc.io.fitsimage import is_compressed, convert_image, image_hdu
+from rotseproc.io.output import makedirs, copy_file, atomic_output
 
 rlog = rlogger.rotseLogger("ROTSE-III",20)
 log = rlog.getlog()
@@ -47,18 +54,258 @@ def copy_preproc(images, prods, outdir):
     imagedir = os.path.join(preprocdir, 'image')
     proddir = os.path.join(preprocdir, 'prod')
 
-    # Make directories
-    os.makedirs(preprocdir)
-    os.makedirs(imagedir)
-    os.makedirs(proddir)
+    # Make directories, nights staged one at a time share them
+    makedirs(imagedir, proddir)
 
-    # Copy files
+    # Copy files, external tools need compressed images to be decompressed
     for i in images:
         imageout = os.path.join(imagedir, os.path.split(i)[1])
-        copyfile(i, imageout)
+        if is_compressed(i):
+            convert_image(i, imageout)
+        else:
+            copy_file(i, imageout)
     for p in prods:
         prodout = os.path.join(proddir, os.path.split(p)[1])
-        copyfile(p, prodout)
+        copy_file(p, prodout)
+
+    return
+
+def cutout_preproc(images, prods, outdir, ra, dec, radius):
+    """
+    Write WCS cutouts around the target instead of copying full preprocessed frames
+
+    Args:
+        images, prods : preprocessed image and prod files
+        outdir        : output directory
+        ra, dec       : target coordinates in degrees
+        radius        : half size of the square cutout in pixels
+
+    Stamps all have the full size, pixels off the frame are NaN. Catalogs of
+    the stamped frames keep the sources on the stamp, with positions shifted
+    to the stamp grid, other prod files are copied. Prod files of frames
+    without the target are skipped with their frame.
+    """
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    from astropy.nddata import Cutout2D
+    from astropy.nddata.utils import NoOverlapError
+    from rotseproc.io.catalog import cutout_catalog
+
+    log.info("Writing {} pixel cutouts of preprocessed files to {}".format(2*radius+1, outdir))
+    # Define directories
+    preprocdir = os.path.join(outdir, 'preproc')
+    imagedir = os.path.join(preprocdir, 'image')
+    proddir = os.path.join(preprocdir, 'prod')
+
+    # Make directories, nights staged one at a time share them
+    makedirs(imagedir, proddir)
+
+    prodsbyframe = {}
+    for p in prods:
+        prodsbyframe.setdefault(frame_key(p), []).append(p)
+
+    # Cut out stamps, memory mapping only reads the rows of the frame inside the stamp
+    nstamps = 0
+    for i in images:
+        with fits.open(i, memmap=True) as hdul:
+            hdu = image_hdu(hdul)
+            header = hdu.header
+            wcs = WCS(header)
+            position = wcs.world_to_pixel_values(ra, dec)
+            # Integer frames can't hold NaN, their pixels off the frame are 0
+            fill = np.nan if hdu.data.dtype.kind == 'f' else 0
+            try:
+                cutout = Cutout2D(hdu.data, position, 2*radius+1, wcs=wcs, mode='partial', fill_value=fill, copy=True)
+            except NoOverlapError:
+                log.warning("Target is not in {}, skipping".format(os.path.split(i)[1]))
+                continue
+
+            # Pixel (0, 0) of the stamp in the frame, off the frame for stamps over its edge
+            origin = tuple(int(o - c) for o, c in zip(cutout.origin_original, cutout.origin_cutout))
+            outheader = fits.PrimaryHDU(header=header).header
+            outheader.update(cutout.wcs.to_header())
+            outheader['CUTOUT'] = (True, 'Cutout of preprocessed frame around target')
+            outheader['CUTX0'] = (origin[0], 'x origin of cutout in original frame')
+            outheader['CUTY0'] = (origin[1], 'y origin of cutout in original frame')
+            imageout = os.path.join(imagedir, os.path.split(i)[1])
+            with atomic_output(imageout) as tmpfile:
+                fits.writeto(tmpfile, cutout.data, outheader)
+            nstamps += 1
+
+        for p in prodsbyframe.get(frame_key(i), []):
+            prodout = os.path.join(proddir, os.path.split(p)[1])
+            if p.endswith('obj.fit'):
+                cutout_catalog(p, prodout, origin, cutout.shape)
+            else:
+                copy_file(p, prodout)
+
+    log.info("Wrote {} cutouts".format(nstamps))
 
     return
 
+def frame_key(filename):
+    """
+    Night, field, telescope and exposure part of an image or prod file name
+    """
+    return os.path.split(filename)[1][:25]
+
+class NightStream:
+    """
+    Preprocessed files staged to the output directory night by night
+
+    Iterating stages the nights in a background thread, at most depth nights
+    ahead of the consumer, and yields (date, images, prods) with the staged
+    files of each night once they are on disk. The nights are listed from
+    their source as they are staged, so a generator streams the listing too,
+    unless the full lists of images or prods are asked for first. Frames
+    rejected before their night is staged are never copied. Unless keep is
+    set, the staged files of a night are removed when the consumer asks for
+    the next night, so disk use stays bounded by the prefetch depth rather
+    than the baseline length.
+
+    Args:
+        nights : iterable of (date, images, prods) source files of each night
+        stage  : function(images, prods) staging files to outdir/preproc
+        outdir : output directory
+    Optional:
+        depth  : number of nights staged ahead of the consumer
+        keep   : keep the staged files of consumed nights
+
+    Attributes:
+        workload : NFRAMES, NNIGHTS and NBYTES of the nights listed so far,
+                   updated in place as the listing goes on
+    """
+    def __init__(self, nights, stage, outdir, depth=2, keep=False):
+        self._source = iter(nights)
+        self._listed = []
+        self._lock = threading.Lock()
+        self.stage = stage
+        self.outdir = outdir
+        self.depth = max(1, int(depth))
+        self.keep = keep
+        self.rejected = set()
+        self.workload = {'NFRAMES': 0, 'NNIGHTS': 0, 'NBYTES': 0}
+        self._started = False
+
+    def _list(self, n=None):
+        """
+        List nights from the source until there are more than n (all if None)
+        """
+        from rotseproc.planner import data_workload
+        with self._lock:
+            while self._source is not None and (n is None or len(self._listed) <= n):
+                try:
+                    night = next(self._source)
+                except StopIteration:
+                    self._source = None
+                    break
+                self._listed.append(night)
+                for key, value in data_workload(night[1], night[2]).items():
+                    self.workload[key] += value
+            return self._listed
+
+    def _night(self, n):
+        listed = self._list(n)
+        return listed[n] if n < len(listed) else None
+
+    @property
+    def nights(self):
+        """
+        All nights, listing the rest of the source
+        """
+        return list(self._list())
+
+    @property
+    def images(self):
+        return [i for date, images, prods in self.nights for i in images if frame_key(i) not in self.rejected]
+
+    @property
+    def prods(self):
+        return [p for date, images, prods in self.nights for p in prods if frame_key(p) not in self.rejected]
+
+    def reject(self, images):
+        """
+        Drop frames (and their prod files) from nights that are not staged yet
+        """
+        self.rejected.update(frame_key(i) for i in images)
+
+    def _staged(self, files, sub):
+        outdir = os.path.join(self.outdir, 'preproc', sub)
+        staged = [os.path.join(outdir, os.path.split(f)[1]) for f in files]
+        return [f for f in staged if os.path.exists(f)]
+
+    @staticmethod
+    def _remove(item):
+        date, images, prods = item
+        for f in images + prods:
+            if os.path.exists(f):
+                os.remove(f)
+        log.debug("Removed {} staged files of {}".format(len(images) + len(prods), date))
+
+    @staticmethod
+    def _put(nights, item, stop):
+        # Block while depth staged nights wait for the consumer, unless it stopped iterating
+        while not stop.is_set():
+            try:
+                nights.put(item, timeout=1.)
+                return
+            except queue.Full:
+                pass
+
+    def _producer(self, nights, stop):
+        try:
+            for n in itertools.count():
+                if stop.is_set():
+                    return
+                night = self._night(n)
+                if night is None:
+                    break
+                date, images, prods = night
+                images = [i for i in images if frame_key(i) not in self.rejected]
+                prods = [p for p in prods if frame_key(p) not in self.rejected]
+                with rlogger.log_context(epoch=date), get_governor().reserve(io=1, label='staging {}'.format(date)):
+                    self.stage(images, prods)
+                self._put(nights, (date, self._staged(images, 'image'), self._staged(prods, 'prod')), stop)
+        except Exception as e:
+            self._put(nights, e, stop)
+            return
+        self._put(nights, None, stop)
+
+    def __iter__(self):
+        if self._started:
+            raise RuntimeError("NightStream can only be iterated once")
+        self._started = True
+
+        nights = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        # Run in a copy of the caller's context so staging logs keep the target and step
+        ctx = contextvars.copy_context()
+        producer = threading.Thread(target=ctx.run, args=(self._producer, nights, stop), daemon=True)
+        producer.start()
+        log.info("Staging nights to {}, {} ahead".format(self.outdir, self.depth))
+        try:
+            while True:
+                item = nights.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                # The consumer is done with this night once it asks for the next one
+                if not self.keep:
+                    self._remove(item)
+        finally:
+            stop.set()
+            producer.join()
+
+def find_stream(inp):
+    """
+    NightStream passed on by an earlier step, alone or in a tuple, or None
+    """
+    if isinstance(inp, NightStream):
+        return inp
+    if isinstance(inp, tuple):
+        for i in inp:
+            if isinstance(i, NightStream):
+                return i
+    return None
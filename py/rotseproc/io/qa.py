@@ -1,14 +1,152 @@
 """
 I/O functions for QAs
 """
+import os
 import json
+import numpy as np
+from rotseproc.io.output import temp_name
+
+#- Arrays larger than this go to the binary sidecar of the merged QA file
+SIDECAR_MIN_SIZE = 1000
+
+def qa_default(obj):
+    """
+    JSON serializer for numpy types found in QA outputs
+    """
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
 
 def write_qa_file(filename, retval):
     """
     Write JSON file for QA
     """
-    outfile = open(filename, 'w')
-    json.dump(retval, outfile, sort_keys=True, indent=4)
+    with open(filename, 'w') as outfile:
+        json.dump(retval, outfile, sort_keys=True, indent=4, default=qa_default)
 
     return
 
+def sidecar_file(filename):
+    """
+    Name of the binary sidecar holding large array metrics of a merged QA file
+    """
+    return os.path.splitext(filename)[0] + '.npz'
+
+class MergedQAWriter:
+    """
+    Append-only JSON Lines writer for merged QA output, one line per pipeline step
+
+    Lines are streamed to a temporary file which is atomically renamed to
+    filename on close, so readers never see a partially written file. A run
+    that fails calls abort instead, which removes the temporary file.
+    Array metrics with at least sidecar_size elements are stored in a .npz
+    sidecar and referenced from the JSON line by key.
+    """
+    def __init__(self, filename, sidecar_size=SIDECAR_MIN_SIZE):
+        self.filename = filename
+        self.sidecar_size = sidecar_size
+        self._tmpfile = temp_name(filename)
+        self._sidecar = {}
+        self._out = open(self._tmpfile, 'w')
+
+    def _pack(self, stepname, metrics):
+        packed = {}
+        for key, val in metrics.items():
+            if isinstance(val, (list, tuple)):
+                try:
+                    val = np.asarray(val)
+                except ValueError: # Ragged lists stay as they are
+                    pass
+            if isinstance(val, np.ndarray) and val.dtype != object and val.size >= self.sidecar_size:
+                npzkey = '{}/{}'.format(stepname, key)
+                self._sidecar[npzkey] = val
+                packed[key] = {'__npz__': npzkey}
+            else:
+                packed[key] = val
+        return packed
+
+    def write_step(self, stepdict):
+        """
+        Append one finished pipeline step to the merged QA file
+        """
+        stepname = stepdict['PIPELINE_STEP']
+        line = {'PIPELINE_STEP': stepname,
+                'PARAMS': stepdict['PARAMS'],
+                'METRICS': self._pack(stepname, stepdict['METRICS'])}
+        self._out.write(json.dumps(line, default=qa_default) + '\n')
+        self._out.flush()
+
+    def close(self):
+        """
+        Finish writing and atomically move the merged QA file into place
+        """
+        if self._out.closed:
+            return
+        self._out.close()
+        if len(self._sidecar) > 0:
+            npzfile = sidecar_file(self.filename)
+            tmpnpz = temp_name(npzfile)
+            np.savez(tmpnpz, **self._sidecar)
+            os.replace(tmpnpz, npzfile)
+        os.replace(self._tmpfile, self.filename)
+
+    def abort(self):
+        """
+        Stop writing and remove the temporary file, leaving filename untouched
+        """
+        if not self._out.closed:
+            self._out.close()
+        if os.path.exists(self._tmpfile):
+            os.remove(self._tmpfile)
+
+def read_merged_qa(filename, steps=None, metrics=None):
+    """
+    Read merged QA output written by MergedQAWriter
+
+    Args:
+        filename : merged QA JSON Lines file
+    Optional:
+        steps   : list of pipeline step names to read (default all)
+        metrics : list of metric names to keep (default all)
+
+    Returns:
+        list of step dictionaries with PIPELINE_STEP, PARAMS and METRICS
+    """
+    if steps is not None:
+        steps = [s.upper() for s in steps]
+        # Steps are written first on each line, so unwanted lines can be skipped unparsed
+        prefixes = tuple('{{"PIPELINE_STEP": "{}"'.format(s) for s in steps)
+
+    npz = None
+    npzfile = sidecar_file(filename)
+
+    result = []
+    with open(filename, 'r') as f:
+        for line in f:
+            if steps is not None and not line.startswith(prefixes):
+                continue
+            step = json.loads(line)
+            stepmetrics = {}
+            for key, val in step['METRICS'].items():
+                if metrics is not None and key not in metrics:
+                    continue
+                if isinstance(val, dict) and '__npz__' in val:
+                    # Only load sidecar arrays that are requested
+                    if npz is None:
+                        npz = np.load(npzfile)
+                    val = npz[val['__npz__']]
+                elif isinstance(val, list):
+                    try:
+                        val = np.asarray(val)
+                    except ValueError:
+                        pass
+                stepmetrics[key] = val
+            step['METRICS'] = stepmetrics
+            result.append(step)
+
+    if npz is not None:
+        npz.close()
+
+    return result
@@ -5,8 +5,6 @@ import os, sys
 import glob
 from shutil import copyfile
 import numpy as np
-from astropy.table import Table
-import matplotlib.pyplot as plt
 from rotseproc import exceptions, rlogger
 
 rlog = rlogger.rotseLogger("ROTSE-III",20)
@@ -16,6 +14,8 @@ def load_supernova_fields():
     """
     Load supernova fields and their respective coordinates
     """
+    from astropy.table import Table
+
     # Find supernova fields file
     if 'ROTSE_SOFTWARE' in os.environ:
         data_path = os.path.join(os.getenv('ROTSE_SOFTWARE'), 'rotsehub/rotseproc/py/rotseproc/data')
@@ -51,9 +51,9 @@ def find_supernova_field(ra, dec):
 
     return found_field
 
-def find_supernova_data(night, telescope, field, t_before, t_after, datadir):
+def supernova_date_range(night, t_before, t_after):
     """
-    Get image and prod files for a range of dates
+    Get the list of nights to search for data
     """
     # Define first and last date to find data
     if len(night) == 1:
@@ -100,33 +100,85 @@ def find_supernova_data(night, telescope, field, t_before, t_after, datadir):
     stop = np.where(date_ints == int(stopdate))[0][0] + 1
     dates = dates[start:stop]
 
+    return dates
+
+def find_night_data(date, telescope, field, datadir):
+    """
+    Get image and prod files of a field for one night
+    """
+    year, month, day = date[:2], date[2:4], date[4:]
+    datapath = os.path.join(datadir, telescope, year, month, day)
+    imagedir = os.path.join(datapath, 'image')
+    proddir = os.path.join(datapath, 'prod')
+
+    images = []
+    prods = []
+    try:
+        # Load images
+        for im in os.listdir(imagedir):
+            if field in im:
+                images.append(os.path.join(imagedir, im))
+
+        # Load prods
+        for pr in os.listdir(proddir):
+            if field in pr:
+                prods.append(os.path.join(proddir, pr))
+
+    except: # No data for this night
+        pass
+
+    return images, prods
+
+def supernova_nights(night, telescope, field, t_before, t_after, datadir):
+    """
+    Generate the image and prod files of a field night by night
+
+    Yields:
+        (date, images, prods) for each night with data
+    """
+    for date in supernova_date_range(night, t_before, t_after):
+        images, prods = find_night_data(date, telescope, field, datadir)
+        if len(images) > 0 or len(prods) > 0:
+            yield date, images, prods
+
+def matched_supernova_nights(night, telescope, field, t_before, t_after, datadir):
+    """
+    Generate the image and prod files of a field night by night, keeping the
+    images with a cobj file, for streaming runs that stage while they list
+
+    Yields:
+        (date, images, prods) for each night with matched images
+    """
+    from rotseproc.io.preproc import match_image_prod
+
+    nnights = 0
+    for date, images, prods in supernova_nights(night, telescope, field, t_before, t_after, datadir):
+        # Add TLA to field if not present
+        if len(field) == 9 and len(images) > 0:
+            field = os.path.split(images[0])[1][7:19]
+        images, prods = match_image_prod(images, prods, telescope, field)
+        if len(images) > 0:
+            nnights += 1
+            yield date, images, prods
+
+    if nnights == 0:
+        log.critical("No images with cobj files were found for this supernova.")
+        raise RuntimeError("No data found for field {} of {}".format(field, telescope))
+
+    log.info("Found data in {} for {} nights".format(field, nnights))
+
+def find_supernova_data(night, telescope, field, t_before, t_after, datadir):
+    """
+    Get image and prod files for a range of dates
+    """
     # Find image and prod files
     images = []
     prods = []
     founddata = []
-    for date in dates:
-        year, month, day = date[:2], date[2:4], date[4:]
-
-        try:
-            datapath = os.path.join(datadir, telescope, year, month, day)
-            imagedir = os.path.join(datapath, 'image')
-            proddir = os.path.join(datapath, 'prod')
-
-            # Load images
-            for im in os.listdir(imagedir):
-                if field in im:
-                    image = os.path.join(imagedir, im)
-                    images.append(image)
-                    founddata.append(date)
-
-            # Load prods
-            for pr in os.listdir(proddir):
-                if field in pr:
-                    prod = os.path.join(proddir, pr)
-                    prods.append(prod)
-
-        except: # No data for this night
-            pass
+    for date, nightimages, nightprods in supernova_nights(night, telescope, field, t_before, t_after, datadir):
+        images += nightimages
+        prods += nightprods
+        founddata += [date] * len(nightimages)
 
     if len(images) == 0:
         log.critical("No images were found for this supernova.")
@@ -164,7 +216,11 @@ def find_reference_image(telescope, tempdir, outdir):
         imfile = glob.glob(imdir + '/*{}*'.format(field))[0]
         im = os.path.split(imfile)[1]
         imout = os.path.join(coadddir, 'image', im)
-        copyfile(imfile, imout)
+        from rotseproc.io.fitsimage import is_compressed, convert_image
+        if is_compressed(imfile):
+            convert_image(imfile, imout)
+        else:
+            copyfile(imfile, imout)
 
         prodfile = glob.glob(proddir + '/*{}*'.format(field))[0]
         prod = os.path.split(prodfile)[1]
@@ -0,0 +1,302 @@
+"""
+SQLite backed queue for distributing targets over pipeline workers
+
+Workers started anywhere (local processes, SLURM array tasks) claim pending
+targets with a time limited lease, renew the lease while the target runs and
+report the outcome. Leases of crashed workers expire, and the target becomes
+claimable again, or failed once its attempts are used up. The queue database must live on a filesystem with working
+POSIX locks.
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+from threading import Thread, Event
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id        INTEGER PRIMARY KEY AUTOINCREMENT,
+    target    TEXT UNIQUE NOT NULL,
+    args      TEXT NOT NULL,
+    state     TEXT NOT NULL DEFAULT 'pending',
+    worker    TEXT,
+    attempts  INTEGER NOT NULL DEFAULT 0,
+    lease     REAL,
+    started   REAL,
+    finished  REAL,
+    elapsed   REAL,
+    retcode   INTEGER,
+    after     TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease);
+"""
+
+#- Job states
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+
+def worker_name():
+    """
+    Identify this worker by host, pid and SLURM array task if any
+    """
+    name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    if 'SLURM_ARRAY_JOB_ID' in os.environ:
+        name += ':{}_{}'.format(os.environ['SLURM_ARRAY_JOB_ID'], os.environ.get('SLURM_ARRAY_TASK_ID', ''))
+    return name
+
+class JobQueue:
+    """
+    Queue of pipeline targets
+
+    Args:
+        dbfile : queue database
+    Optional:
+        lease       : seconds a claim stays valid without renewal
+        maxattempts : number of claims before a failing target is given up
+    """
+    def __init__(self, dbfile, lease=600., maxattempts=3):
+        self.dbfile = dbfile
+        self.lease = lease
+        self.maxattempts = maxattempts
+        self._conn = sqlite3.connect(dbfile, timeout=60., isolation_level=None)
+        self._conn.executescript(_SCHEMA)
+        # Queues created before job dependencies existed
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")]
+        if 'after' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN after TEXT")
+
+    def close(self):
+        self._conn.close()
+
+    def add(self, target, after=None, **kwargs):
+        """
+        Add a target with its pipeline arguments, targets already queued are skipped
+
+        Optional:
+            after : target that must be done before this one can be claimed
+
+        Returns:
+            True if the target was added
+        """
+        cur = self._conn.execute("INSERT OR IGNORE INTO jobs (target, args, after) VALUES (?, ?, ?)",
+                                 (target, json.dumps(kwargs, sort_keys=True), after))
+        return cur.rowcount == 1
+
+    def claim(self, worker=None):
+        """
+        Atomically claim the next pending target, or one whose lease has expired,
+        skipping targets that wait for another target to be done
+
+        Returns:
+            (job id, target, args dictionary), or None if nothing is left to run
+        """
+        if worker is None:
+            worker = worker_name()
+        now = time.time()
+        # BEGIN IMMEDIATE takes the write lock, so no two workers can claim the same row
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._fail_exhausted(now)
+            row = self._conn.execute(
+                "SELECT id, target, args FROM jobs WHERE (state = ? OR (state = ? AND lease < ?)) AND attempts < ? "
+                "AND (after IS NULL OR after IN (SELECT target FROM jobs WHERE state = ?)) "
+                "ORDER BY attempts, id LIMIT 1", (PENDING, RUNNING, now, self.maxattempts, DONE)).fetchone()
+            if row is None:
+                self._conn.execute("COMMIT")
+                return None
+            self._conn.execute(
+                "UPDATE jobs SET state = ?, worker = ?, attempts = attempts + 1, lease = ?, started = ?, "
+                "finished = NULL, elapsed = NULL, retcode = NULL WHERE id = ?",
+                (RUNNING, worker, now + self.lease, now, row[0]))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+
+        return row[0], row[1], json.loads(row[2])
+
+    def renew(self, jobid):
+        """
+        Extend the lease of a running job
+        """
+        self._conn.execute("UPDATE jobs SET lease = ? WHERE id = ? AND state = ?",
+                           (time.time() + self.lease, jobid, RUNNING))
+
+    def finish(self, jobid, retcode, worker=None):
+        """
+        Record the outcome of a job, failed jobs are retried until maxattempts
+
+        If worker is given, the outcome is ignored (and None returned) when the
+        job was meanwhile reclaimed by another worker after its lease expired.
+
+        Returns:
+            new state of the job
+        """
+        now = time.time()
+        if retcode == 0:
+            state = DONE
+        else:
+            attempts = self._conn.execute("SELECT attempts FROM jobs WHERE id = ?", (jobid,)).fetchone()[0]
+            state = FAILED if attempts >= self.maxattempts else PENDING
+        sql = "UPDATE jobs SET state = ?, lease = NULL, finished = ?, elapsed = ? - started, retcode = ? WHERE id = ?"
+        args = [state, now, now, retcode, jobid]
+        if worker is not None:
+            sql += " AND worker = ?"
+            args.append(worker)
+        if self._conn.execute(sql, args).rowcount == 0:
+            log.warning("Job {} was reclaimed by another worker, dropping result".format(jobid))
+            return None
+        if state == FAILED:
+            target = self._conn.execute("SELECT target FROM jobs WHERE id = ?", (jobid,)).fetchone()[0]
+            self._fail_dependents([target])
+        return state
+
+    def _fail_dependents(self, targets):
+        """
+        Fail pending targets waiting for failed targets, they can never run
+        """
+        while len(targets) > 0:
+            failed = []
+            for target in targets:
+                dependents = [row[0] for row in self._conn.execute(
+                    "SELECT target FROM jobs WHERE after = ? AND state = ?", (target, PENDING))]
+                if len(dependents) > 0:
+                    self._conn.execute("UPDATE jobs SET state = ? WHERE after = ? AND state = ?", (FAILED, target, PENDING))
+                    log.warning("Failed {} targets waiting for {}".format(len(dependents), target))
+                failed += dependents
+            # Targets waiting for the newly failed ones can't run either
+            targets = failed
+
+    def _fail_exhausted(self, now):
+        """
+        Fail jobs whose last allowed attempt crashed (their lease expired) and
+        their dependents, like finish does for attempts that report a failure
+
+        Returns:
+            number of failed jobs, not counting dependents
+        """
+        cond = "((state = ? AND lease < ?) OR state = ?) AND attempts >= ?"
+        args = (RUNNING, now, PENDING, self.maxattempts)
+        targets = [row[0] for row in self._conn.execute("SELECT target FROM jobs WHERE " + cond, args)]
+        if len(targets) == 0:
+            return 0
+        self._conn.execute("UPDATE jobs SET state = ?, lease = NULL, finished = ? WHERE " + cond, (FAILED, now) + args)
+        log.warning("Failed {} targets whose last attempt did not finish: {}".format(len(targets), ', '.join(targets)))
+        self._fail_dependents(targets)
+        return len(targets)
+
+    def release_stale(self):
+        """
+        Return running jobs with expired leases to the pending state, jobs
+        without attempts left are failed instead
+
+        Returns:
+            number of released jobs
+        """
+        now = time.time()
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._fail_exhausted(now)
+            cur = self._conn.execute("UPDATE jobs SET state = ?, worker = NULL, lease = NULL "
+                                     "WHERE state = ? AND lease < ?", (PENDING, RUNNING, now))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return cur.rowcount
+
+    def waiting(self):
+        """
+        Number of pending targets waiting for targets that aren't done yet but
+        still can be, i.e. that are running or have attempts left
+        """
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = ? AND attempts < ? "
+            "AND after IN (SELECT target FROM jobs WHERE (state = ? AND lease >= ?) OR "
+            "(state IN (?, ?) AND attempts < ?))",
+            (PENDING, self.maxattempts, RUNNING, time.time(), PENDING, RUNNING, self.maxattempts)).fetchone()[0]
+
+    def summary(self):
+        """
+        Number of jobs in each state
+        """
+        return dict(self._conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def jobs(self):
+        """
+        All jobs as a list of dictionaries
+        """
+        cur = self._conn.execute("SELECT * FROM jobs ORDER BY id")
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+class LeaseKeeper:
+    """
+    Renew the lease of a running job in a background thread
+    """
+    def __init__(self, queue, jobid):
+        self._dbfile = queue.dbfile
+        self._lease = queue.lease
+        self._jobid = jobid
+        self._stop = Event()
+        self._thread = None
+
+    def _loop(self):
+        # SQLite connections can't be shared between threads, use a separate one
+        queue = JobQueue(self._dbfile, lease=self._lease)
+        while not self._stop.wait(self._lease / 3.):
+            queue.renew(self._jobid)
+        queue.close()
+
+    def __enter__(self):
+        self._thread = Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def run_worker(queue, command, maxjobs=None, worker=None, poll=30.):
+    """
+    Claim and run targets until the queue is empty
+
+    Args:
+        queue   : JobQueue
+        command : function (target, args) -> list of command line arguments to run the target
+    Optional:
+        maxjobs : stop after this many targets
+        worker  : worker name (default host:pid)
+        poll    : seconds between claims while all pending targets wait for others
+
+    Returns:
+        number of targets run
+    """
+    import subprocess
+    if worker is None:
+        worker = worker_name()
+
+    njobs = 0
+    while maxjobs is None or njobs < maxjobs:
+        job = queue.claim(worker)
+        if job is None:
+            if queue.waiting() > 0:
+                time.sleep(poll)
+                continue
+            break
+        jobid, target, args = job
+        cmd = command(target, args)
+        log.info("Worker {} running {}: {}".format(worker, target, ' '.join(cmd)))
+
+        t0 = time.time()
+        with LeaseKeeper(queue, jobid):
+            retcode = subprocess.call(cmd)
+        state = queue.finish(jobid, retcode, worker)
+        log.info("Worker {} finished {} in {:.1f} s with status {} ({})".format(worker, target, time.time()-t0, retcode, state))
+        njobs += 1
+
+    return njobs
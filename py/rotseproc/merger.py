@@ -4,11 +4,7 @@ Merge rotse qa outputs
 Only a few necessary functions included here, need to expand
 """
 from __future__ import absolute_import, division, print_function
-import yaml
-import json
-import numpy as np
-import datetime
-import pytz
+from rotseproc.io.qa import MergedQAWriter
 
 def remove_task(myDict, Key):
     if Key in myDict:
@@ -37,9 +33,18 @@ def transferKEY(myDict, KeyHead, old_task, new_task, keyList):
     return myDict
 
 class QAMerger:
-    def __init__(self, convdict):
+    """
+    Collect QA params and metrics for each pipeline step
+
+    If mergedfile is given, each finished step is streamed to it as one
+    JSON line (see rotseproc.io.qa.MergedQAWriter)
+    """
+    def __init__(self, convdict, mergedfile=None):
         self.__stepsArr=[]
         self.__schema={'PIPELINE_STEPS':self.__stepsArr}
+        self.__writer=None
+        if mergedfile is not None:
+            self.__writer=MergedQAWriter(mergedfile)
 
     class Rotse_Step:
         def __init__(self,paName,paramsDict,metricsDict):
@@ -58,4 +63,23 @@ class QAMerger:
         stepDict={"PIPELINE_STEP":stepName.upper(),'METRICS':metricsDict,'PARAMS':paramsDict}
         self.__stepsArr.append(stepDict)
         return self.Rotse_Step(stepName,paramsDict,metricsDict)
-
+    def finishPipelineStep(self):
+        """
+        Stream the most recently added step to the merged QA file
+        """
+        if self.__writer is not None and len(self.__stepsArr) > 0:
+            self.__writer.write_step(self.__stepsArr[-1])
+    def close(self):
+        """
+        Commit the merged QA file to its final location
+        """
+        if self.__writer is not None:
+            self.__writer.close()
+            return self.__writer.filename
+        return None
+    def abort(self):
+        """
+        Discard the merged QA file of a failed run
+        """
+        if self.__writer is not None:
+            self.__writer.abort()
@@ -0,0 +1,69 @@
+"""
+Registry of the implementations (backends) of the PAs that run external tools
+
+Coaddition, Source_Extraction, Make_Subimages, Image_Differencing,
+Choose_Refstars and Photometry hand their tool runs to a backend chosen by the
+Backend option of the step in the configuration:
+
+    legacy : the ROTSE-III tools (IDL in Singularity, SExtractor, difference_all.py)
+    native : python implementations, see rotseproc.pa.native
+    mock   : fast stand-ins writing correctly shaped products, see rotseproc.pa.mock
+
+Backends of a PA share the call signature given in BACKEND_SIGNATURES, they
+write the same products in the same places so the PA (and the steps after it)
+can't tell them apart. More backends are added with register_backend.
+"""
+import importlib
+from rotseproc import exceptions
+
+#- Call signature of the backends of each PA
+BACKEND_SIGNATURES = {
+    'Coaddition'         : 'coadd(images, preprocdir, coadddir, mapcache), coadds preprocessed images by night into coadddir/image, '
+                           'keeping reprojection maps in mapcache (None for none)',
+    'Source_Extraction'  : 'extract(cimgs, coadddir, satcnts), writes the _sobj.fit (and _cobj.fit) of each coadd into coadddir/prod',
+    'Make_Subimages'     : 'subimages(coadddir, subdir, ra, dec, pixrad), writes subimages of the coadds into subdir/image and subdir/prod',
+    'Image_Differencing' : 'difference(subdir), writes *sub* difference images into subdir/image',
+    'Choose_Refstars'    : 'refstars(subdir, template, ra, dec), selects the reference stars of the template subimage',
+    'Photometry'         : 'photometry(subdir, pattern), writes subdir/lightcurve_subtract_target_psf.dat for the images matching pattern'}
+
+#- Modules of the built in backends, imported when one of their backends is asked for
+BACKEND_MODULES = {'legacy' : 'rotseproc.pa.legacy',
+                   'native' : 'rotseproc.pa.native',
+                   'mock'   : 'rotseproc.pa.mock'}
+
+_backends = {}
+
+def register_backend(paname, name):
+    """
+    Decorator registering a function as the named backend of a PA
+
+        @register_backend('Coaddition', 'native')
+        def coadd(images, preprocdir, coadddir, mapcache=None):
+            ...
+    """
+    if paname not in BACKEND_SIGNATURES:
+        raise exceptions.ParameterException("{} has no backends, choose from {}".format(paname, sorted(BACKEND_SIGNATURES)))
+
+    def register(func):
+        _backends[(paname, name)] = func
+        return func
+    return register
+
+def list_backends(paname):
+    """
+    Names of the backends of a PA, importing the built in ones
+    """
+    for module in BACKEND_MODULES.values():
+        importlib.import_module(module)
+    return sorted(name for pa, name in _backends if pa == paname)
+
+def get_backend(paname, name='legacy'):
+    """
+    Backend function of a PA, raising ParameterException if there is none by that name
+    """
+    if (paname, name) not in _backends and name in BACKEND_MODULES:
+        importlib.import_module(BACKEND_MODULES[name])
+    if (paname, name) not in _backends:
+        raise exceptions.ParameterException("{} has no {} backend, choose from {}".format(
+            paname, name, list_backends(paname)))
+    return _backends[(paname, name)]
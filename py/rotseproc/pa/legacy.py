@@ -0,0 +1,122 @@
+"""
+Legacy backends of the PAs, running the ROTSE-III tools
+
+Coaddition, subimages, reference star selection and photometry run IDL in
+Singularity, source extraction runs SExtractor and image differencing runs
+difference_all.py under python 2. All of them need the SMU cluster environment.
+"""
+import os
+import glob
+from rotseproc import rlogger
+from rotseproc.governor import get_governor
+from rotseproc.io.output import temp_name, commit, commit_files, remove_stale
+from rotseproc.pa.backends import register_backend
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- IDL in Singularity
+IDL = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
+
+#- SExtractor configuration of ROTSE-III
+SEX_CONFIG = '/scratch/group/astro/rotse/software/products/idltools/umrotse_idl/tools/sex/'
+
+@register_backend('Coaddition', 'legacy')
+def coadd(images, preprocdir, coadddir, mapcache=None):
+    """
+    Coadd with coadd_all, which groups the frames by night itself
+    """
+    # Frames of one night are selected by night, otherwise all staged frames are coadded
+    imagedir = os.path.join(preprocdir, 'image') + '/'
+    nights = set(os.path.basename(i)[:6] for i in images)
+    files = "file_search('{}{}*')".format(imagedir, nights.pop() if len(nights) == 1 else '')
+
+    # Run coaddition, IDL holds all frames of a night in memory
+    os.chdir(preprocdir)
+    # Coadds already in the working directory were left by a killed run
+    remove_stale('*000-000_c.fit')
+    memory = sum(os.path.getsize(i) for i in images if os.path.exists(i))
+    with get_governor().reserve(procs=1, memory=memory, label='coadd'):
+        os.system('{} -32 -e "coadd_all,{}"'.format(IDL, files))
+
+    # Move coadds to coadd directory
+    commit_files(glob.glob('*000-000_c.fit'), os.path.join(coadddir, 'image'))
+
+@register_backend('Source_Extraction', 'legacy')
+def extract(cimgs, coadddir, satcnts):
+    """
+    Run SExtractor on each coadd, then make the cobj files by hand in the ROTSE software container
+    """
+    singularity = "singularity shell --bind /scratch /hpc/applications/rotsesoftware/rotsesoftware.simg"
+    os.chdir(coadddir)
+    for cimg, satlevel in zip(cimgs, satcnts):
+        # Set up output files
+        basename = os.path.basename(cimg).split('000-000')[0]
+        coaddname = basename + '000-000'
+        sobj = os.path.join(coadddir, 'prod', coaddname + '_sobj.fit')
+        skyname = os.path.join(coadddir, 'prod', coaddname + '_sky.fit')
+        # Write under temporary names, committed once sextractor has finished
+        tmpfiles = {sobj: temp_name(sobj), skyname: temp_name(skyname)}
+
+        # Run sextractor
+        cmd = ('sex ' + cimg + ' -c ' + SEX_CONFIG + '/rotse3.sex -PARAMETERS_NAME ' + SEX_CONFIG +
+               '/rotse3.par -FILTER_NAME ' + SEX_CONFIG + '/gauss_2.0_5x5.conv -PHOT_APERTURES 7 -SATUR_LEVEL ' +
+               str(satlevel) + ' -CATALOG_NAME ' + tmpfiles[sobj] + ' -CHECKIMAGE_NAME ' + tmpfiles[skyname])
+        with rlogger.log_context(epoch=basename), \
+             get_governor().reserve(procs=1, memory=2*os.path.getsize(cimg), label='sextractor'):
+            log.debug("Extracting sources with saturation level {}".format(satlevel))
+            os.system(cmd)
+        for dest, tmpfile in tmpfiles.items():
+            if os.path.exists(tmpfile):
+                commit(tmpfile, dest)
+
+       # Calibrate sobj file
+       # os.system('{} -32 -e "run_cal,{}"'.format(IDL, [coadds[i]]))
+
+    # Login to singularity and generate cobj files
+    log.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+    log.info("!!! Logging into singularity. Make cobj files !!!")
+    log.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+    os.system(singularity)
+
+@register_backend('Make_Subimages', 'legacy')
+def subimages(coadddir, subdir, ra, dec, pixrad):
+    """
+    Cut subimages around the target with make_rotse3_subimage
+    """
+    files = os.listdir(os.path.join(coadddir, 'image'))
+    os.chdir(coadddir)
+    with get_governor().reserve(procs=1, label='subimages'):
+        os.system('{} -32 -e "make_rotse3_subimage,{},racent={},deccent={},pixrad={}"'.format(IDL, files, ra, dec, pixrad))
+
+    # Move subimages to sub directory
+    commit_files(glob.glob('*_c.fit'), os.path.join(subdir, 'image'))
+    commit_files(glob.glob('*_cobj.fit'), os.path.join(subdir, 'prod'))
+
+@register_backend('Image_Differencing', 'legacy')
+def difference(subdir):
+    """
+    Difference all subimages with difference_all.py
+    """
+    imdir = os.path.join(subdir, 'image')
+    os.chdir(subdir)
+    with get_governor().reserve(procs=1, label='differencing'):
+        os.system('module swap python/2; difference_all.py -i {}; module swap python/3'.format(imdir))
+
+@register_backend('Choose_Refstars', 'legacy')
+def refstars(subdir, template, ra, dec):
+    """
+    Open the rphot GUI to choose the reference stars by hand
+    """
+    os.chdir(subdir)
+    ref = "file_search('image/{}')".format(template)
+    os.system('{} -32 -e "rphot,data,imlist={},refname={},targetra={},targetdec={},/small"'.format(IDL, ref, ref, ra, dec))
+
+@register_backend('Photometry', 'legacy')
+def photometry(subdir, pattern):
+    """
+    PSF photometry of the target with run_phot
+    """
+    os.chdir(subdir)
+    with get_governor().reserve(procs=1, label='photometry'):
+        os.system('{} -32 -e "run_phot,{}"'.format(IDL, "file_search('{}')".format(pattern)))
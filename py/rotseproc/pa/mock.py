@@ -0,0 +1,400 @@
+"""
+Mock backends and synthetic data for running the pipeline without the ROTSE-III tools
+
+make_synthetic_data writes preprocessed frames and their cobj catalogs of a
+synthetic star field with a transient, plus a reference image, in the layout of
+$ROTSE_DATA and $ROTSE_TEMPLATE. The mock backends stand in for the external
+tools with cheap computations that write products with the names, headers and
+catalog columns of the real ones, so every step, QA and plot downstream runs
+as usual and the whole pipeline can be profiled end to end:
+
+    Coaddition         : average of the frames of each night, without registration
+    Source_Extraction  : catalog of the synthetic stars on each coadd, no pixels are read
+    Make_Subimages     : square cutout around the target with the sources inside it
+    Image_Differencing : subimages minus the earliest (reference) subimage
+    Choose_Refstars    : brightest clean sources of the template
+    Photometry         : aperture photometry of the target on the difference images
+
+Images are in counts with a zero point of MOCK_ZP, the magnitude of one count.
+"""
+import os
+import glob
+import zlib
+import numpy as np
+from rotseproc import rlogger
+from rotseproc.io.output import makedirs, atomic_output, write_table
+from rotseproc.pa.backends import register_backend
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Magnitude of one count of the synthetic images and catalogs
+MOCK_ZP = 25.
+
+#- ROTSE-III pixel scale (deg/pixel) and saturation level (counts)
+PIXSCALE = 3.3 / 3600.
+SATLEVEL = 60000.
+
+#- Reference stars chosen by the mock Choose_Refstars, read by the mock Photometry
+REFSTAR_FILE = 'refstars.fits'
+
+#- Light curve written by the photometry backends
+LC_FILE = 'lightcurve_subtract_target_psf.dat'
+
+def field_center(field):
+    """
+    RA and DEC (degrees) of a field from its name, e.g. sks0246+3652
+    """
+    coords = field[-9:]
+    ra = (int(coords[:2]) + int(coords[2:4])/60.) * 15.
+    dec = int(coords[5:7]) + int(coords[7:9])/60.
+    return ra, -dec if coords[4] == '-' else dec
+
+def field_stars(field, nstars=300, radius=0.8):
+    """
+    Synthetic stars of a field, the same for every call with the same field
+
+    Returns:
+        RA, DEC (degrees) and MAG arrays of stars within radius degrees of the field center
+    """
+    rng = np.random.default_rng(zlib.crc32(field[-9:].encode()))
+    ra0, dec0 = field_center(field)
+    dec = dec0 + rng.uniform(-radius, radius, nstars)
+    ra = (ra0 + rng.uniform(-radius, radius, nstars) / np.cos(np.radians(dec0))) % 360.
+    mag = rng.uniform(11., 18.5, nstars)
+    return ra, dec, mag
+
+def night_mjd(night):
+    """
+    MJD of the middle of a night given as yymmdd
+    """
+    from astropy.time import Time
+    return Time('20{}-{}-{}'.format(night[:2], night[2:4], night[4:6])).mjd + 0.25
+
+def mock_header(ra, dec, shape, mjd, fwhm=2.5, background=500., exptime=60.):
+    """
+    Image header with a TAN WCS centered on ra, dec and the keywords the pipeline reads
+    """
+    from astropy.io import fits
+    from astropy.time import Time
+    header = fits.Header()
+    header['CTYPE1'] = 'RA---TAN'
+    header['CTYPE2'] = 'DEC--TAN'
+    header['CRVAL1'] = ra
+    header['CRVAL2'] = dec
+    header['CRPIX1'] = (shape[1] + 1) / 2.
+    header['CRPIX2'] = (shape[0] + 1) / 2.
+    header['CD1_1'] = -PIXSCALE
+    header['CD1_2'] = 0.
+    header['CD2_1'] = 0.
+    header['CD2_2'] = PIXSCALE
+    header['MJD'] = mjd
+    header['MJD-OBS'] = mjd
+    header['DATE-OBS'] = Time(mjd, format='mjd').isot
+    header['EXPTIME'] = exptime
+    header['SATCNTS'] = SATLEVEL
+    header['FWHM'] = (fwhm, 'Synthetic seeing (pixels)')
+    header['SKYLEVEL'] = (background, 'Synthetic background (counts)')
+    return header
+
+def _pixels(header, ra, dec):
+    from astropy.wcs import WCS
+    return WCS(header).all_world2pix(ra, dec, 0, quiet=True)
+
+def render_image(header, shape, ra, dec, mag, rng):
+    """
+    Image of point sources with Gaussian profiles on a flat background with Poisson noise
+    """
+    fwhm, background = header['FWHM'], header['SKYLEVEL']
+    sigma = fwhm / 2.3548
+    x, y = _pixels(header, ra, dec)
+    flux = 10**(-0.4*(mag - MOCK_ZP))
+
+    # Add a stamp of every source at once
+    half = int(np.ceil(4*sigma))
+    dy, dx = np.mgrid[-half:half+1, -half:half+1]
+    ix = np.round(x).astype(int)[:, None, None] + dx
+    iy = np.round(y).astype(int)[:, None, None] + dy
+    weight = np.exp(-((ix - x[:, None, None])**2 + (iy - y[:, None, None])**2) / (2*sigma**2))
+    weight *= (flux / weight.sum(axis=(1, 2)))[:, None, None]
+    inside = (ix >= 0) & (ix < shape[1]) & (iy >= 0) & (iy < shape[0])
+    image = np.full(shape, background, dtype=float)
+    np.add.at(image, (iy[inside], ix[inside]), weight[inside])
+
+    image = rng.poisson(np.clip(image, 0, None)).astype(np.float32)
+    return np.minimum(image, SATLEVEL)
+
+def mock_catalog(header, shape, ra, dec, mag, rng, satlevel=SATLEVEL, snr_limit=3.):
+    """
+    Source catalog with the SExtractor columns of the sources detectable on an image
+
+    Returns:
+        astropy Table, X_IMAGE and Y_IMAGE are 1-based like SExtractor's
+    """
+    from astropy.table import Table
+    fwhm, background = header['FWHM'], header['SKYLEVEL']
+    x, y = _pixels(header, ra, dec)
+    flux = 10**(-0.4*(mag - MOCK_ZP))
+    npix = np.pi * fwhm**2
+    snr = flux / np.sqrt(flux + npix*background)
+    keep = (x >= 0) & (x < shape[1]) & (y >= 0) & (y < shape[0]) & (snr > snr_limit)
+    n = int(keep.sum())
+    magerr = 1.0857 / snr[keep]
+    peak = flux[keep] / (2*np.pi*(fwhm/2.3548)**2) + background
+
+    # Measurement scatter of positions (0.3 arcsec), magnitudes and shapes
+    table = Table()
+    table['X_IMAGE'] = x[keep] + 1.
+    table['Y_IMAGE'] = y[keep] + 1.
+    table['ALPHA_J2000'] = ra[keep] + rng.normal(0., 0.3/3600., n) / np.cos(np.radians(dec[keep]))
+    table['DELTA_J2000'] = dec[keep] + rng.normal(0., 0.3/3600., n)
+    table['MAG_AUTO'] = mag[keep] + rng.normal(0., 1., n) * magerr
+    table['MAGERR_AUTO'] = magerr
+    table['FWHM_IMAGE'] = fwhm * (1. + rng.normal(0., 0.05, n))
+    table['BACKGROUND'] = np.full(n, background)
+    table['ELLIPTICITY'] = np.abs(rng.normal(0.05, 0.03, n))
+    table['FLAGS'] = np.where(peak >= satlevel, 4, 0).astype(np.int16)
+    return table
+
+def make_synthetic_data(datadir, tempdir, telescope, field, nights, nframes=3, shape=(512, 512), nstars=300,
+                        target=None, peak=None, seed=0):
+    """
+    Write synthetic preprocessed frames, their cobj catalogs and a reference image
+
+    Args:
+        datadir   : data directory, frames go to datadir/telescope/yy/mm/dd/{image,prod}
+        tempdir   : template directory, the reference goes to tempdir/telescope/reference/{image,prod}
+        telescope : e.g. 3b
+        field     : field name with its survey prefix, e.g. sks0246+3652
+        nights    : list of nights (yymmdd)
+    Optional:
+        nframes   : frames per night
+        shape     : (ny, nx) of the frames
+        nstars    : number of stars of the field
+        target    : (ra, dec) of the transient, default 2 arcmin from the field center
+        peak      : night of the transient's peak, default the middle night
+        seed      : seed of the noise
+
+    Returns:
+        dictionary of RA, DEC of the target and the lists of IMAGES, PRODS and REFERENCE files
+    """
+    if len(field) != 12:
+        raise ValueError("Field {} should include its survey prefix, e.g. sks0246+3652".format(field))
+    rng = np.random.default_rng(seed)
+    ra0, dec0 = field_center(field)
+    if target is None:
+        target = (ra0 + 2./60./np.cos(np.radians(dec0)), dec0 + 1./60.)
+    nights = sorted(nights)
+    peak = nights[len(nights)//2] if peak is None else peak
+    starra, stardec, starmag = field_stars(field, nstars)
+
+    def transient_mag(mjd):
+        # Rises 0.3 mag/day to 15.5 mag, then declines 0.05 mag/day
+        dt = mjd - night_mjd(peak)
+        return 15.5 - 0.3*dt if dt < 0 else 15.5 + 0.05*dt
+
+    def write(image, prod, header, ra, dec, mag):
+        makedirs(os.path.dirname(image), os.path.dirname(prod))
+        from astropy.io import fits
+        with atomic_output(image) as tmpfile:
+            fits.writeto(tmpfile, render_image(header, shape, ra, dec, mag, rng), header)
+        write_table(mock_catalog(header, shape, ra, dec, mag, rng), prod, format='fits')
+
+    out = {'RA': target[0], 'DEC': target[1], 'IMAGES': [], 'PRODS': []}
+    for night in nights:
+        mjd = night_mjd(night)
+        nightdir = os.path.join(datadir, telescope, night[:2], night[2:4], night[4:6])
+        ra = np.append(starra, target[0])
+        dec = np.append(stardec, target[1])
+        mag = np.append(starmag, transient_mag(mjd))
+        for k in range(1, nframes+1):
+            # Pointings scatter by a few pixels, seeing and sky change from frame to frame
+            jitter = rng.normal(0., 3.*PIXSCALE, 2)
+            header = mock_header(ra0 + jitter[0]/np.cos(np.radians(dec0)), dec0 + jitter[1], shape,
+                                 mjd + k*0.001, fwhm=rng.uniform(2., 3.2), background=rng.uniform(400., 600.))
+            name = '{}_{}_{}{:03d}'.format(night, field, telescope, k)
+            image = os.path.join(nightdir, 'image', name + '_c.fit')
+            prod = os.path.join(nightdir, 'prod', name + '_cobj.fit')
+            write(image, prod, header, ra, dec, mag)
+            out['IMAGES'].append(image)
+            out['PRODS'].append(prod)
+
+    # Deep reference image a year before the first night, without the transient
+    refnight = str(int(nights[0][:2]) - 1).zfill(2) + nights[0][2:]
+    refname = '{}_{}_{}000-000'.format(refnight, field, telescope)
+    refdir = os.path.join(tempdir, telescope, 'reference')
+    header = mock_header(ra0, dec0, shape, night_mjd(refnight), fwhm=2.5, background=500., exptime=60.*nframes)
+    image = os.path.join(refdir, 'image', refname + '_c.fit')
+    prod = os.path.join(refdir, 'prod', refname + '_cobj.fit')
+    write(image, prod, header, starra, stardec, starmag)
+    out['REFERENCE'] = [image, prod]
+
+    log.info("Wrote {} synthetic frames of {} on {} nights to {}".format(len(out['IMAGES']), field, len(nights), datadir))
+
+    return out
+
+def _root(filename):
+    return os.path.basename(filename).split('000-000')[0] + '000-000'
+
+@register_backend('Coaddition', 'mock')
+def coadd(images, preprocdir, coadddir, mapcache=None):
+    """
+    Average the frames of each night without registering them
+    """
+    from rotseproc.io.fitsimage import read_image, write_image
+
+    bynight = {}
+    for i in sorted(images):
+        bynight.setdefault(os.path.basename(i)[:6], []).append(i)
+    for night, files in bynight.items():
+        frames = [read_image(f) for f in files]
+        ny = min(d.shape[0] for d, h in frames)
+        nx = min(d.shape[1] for d, h in frames)
+        data = np.mean([d[:ny, :nx] for d, h in frames], axis=0, dtype=np.float32)
+        header = frames[0][1].copy()
+        header['NCOMBINE'] = (len(frames), 'Number of coadded frames')
+        coadd = os.path.join(coadddir, 'image', os.path.basename(files[0])[:22] + '000-000_c.fit')
+        with atomic_output(coadd) as tmpfile:
+            write_image(tmpfile, data, header, overwrite=True)
+        log.debug("Coadded {} frames of {}".format(len(frames), night))
+
+@register_backend('Source_Extraction', 'mock')
+def extract(cimgs, coadddir, satcnts):
+    """
+    Catalog the synthetic stars of the field that fall on each coadd, without reading its pixels
+    """
+    from rotseproc.io.fitsimage import read_header
+
+    for cimg, satlevel in zip(cimgs, satcnts):
+        header = read_header(cimg)
+        header.setdefault('FWHM', 2.5)
+        header.setdefault('SKYLEVEL', 500.)
+        field = os.path.basename(cimg)[7:19]
+        ra, dec, mag = field_stars(field)
+        rng = np.random.default_rng(zlib.crc32(os.path.basename(cimg).encode()))
+        catalog = mock_catalog(header, (header['NAXIS2'], header['NAXIS1']), ra, dec, mag, rng,
+                               satlevel=float(satlevel) if satlevel is not None else SATLEVEL)
+        root = os.path.join(coadddir, 'prod', _root(cimg))
+        write_table(catalog, root + '_sobj.fit', format='fits')
+        write_table(catalog, root + '_cobj.fit', format='fits')
+
+@register_backend('Make_Subimages', 'mock')
+def subimages(coadddir, subdir, ra, dec, pixrad):
+    """
+    Cut a square of 2*pixrad+1 pixels around the target out of each coadd, with the sources inside it
+    """
+    from astropy.table import Table
+    from astropy.wcs import WCS
+    from astropy.nddata import Cutout2D
+    from astropy.nddata.utils import NoOverlapError
+    from rotseproc.io.fitsimage import read_image, write_image
+
+    for cimg in sorted(glob.glob(os.path.join(coadddir, 'image', '*_c.fit'))):
+        data, header = read_image(cimg)
+        wcs = WCS(header)
+        try:
+            cutout = Cutout2D(data, wcs.world_to_pixel_values(ra, dec), 2*pixrad+1, wcs=wcs,
+                              mode='partial', fill_value=np.nan, copy=True)
+        except NoOverlapError:
+            log.warning("Target is not in {}, skipping".format(os.path.basename(cimg)))
+            continue
+        header.update(cutout.wcs.to_header())
+        with atomic_output(os.path.join(subdir, 'image', os.path.basename(cimg))) as tmpfile:
+            write_image(tmpfile, cutout.data.astype(np.float32), header, overwrite=True)
+
+        # Sources of the coadd inside the subimage, in subimage pixels
+        catalogs = [os.path.join(coadddir, 'prod', _root(cimg) + suffix) for suffix in ('_cobj.fit', '_sobj.fit')]
+        catalogs = [c for c in catalogs if os.path.exists(c)]
+        if len(catalogs) == 0:
+            continue
+        catalog = Table.read(catalogs[0], hdu=1)
+        x0, y0 = cutout.origin_original
+        x = np.asarray(catalog['X_IMAGE']) - 1. - x0
+        y = np.asarray(catalog['Y_IMAGE']) - 1. - y0
+        inside = (x >= 0) & (x < cutout.shape[1]) & (y >= 0) & (y < cutout.shape[0])
+        catalog = catalog[inside]
+        catalog['X_IMAGE'] = x[inside] + 1.
+        catalog['Y_IMAGE'] = y[inside] + 1.
+        write_table(catalog, os.path.join(subdir, 'prod', _root(cimg) + '_cobj.fit'), format='fits')
+
+@register_backend('Image_Differencing', 'mock')
+def difference(subdir):
+    """
+    Subtract the earliest subimage, the reference, from the others after removing their backgrounds
+    """
+    from rotseproc.io.fitsimage import read_image, write_image
+
+    images = sorted(i for i in glob.glob(os.path.join(subdir, 'image', '*_c.fit')) if 'sub' not in os.path.basename(i))
+    if len(images) < 2:
+        log.warning("Need a reference and at least one subimage to difference")
+        return
+    template, header = read_image(images[0])
+    template = template - np.nanmedian(template)
+    for image in images[1:]:
+        data, header = read_image(image)
+        diff = (data - np.nanmedian(data) - template).astype(np.float32)
+        with atomic_output(image.replace('_c.fit', '_sub.fit')) as tmpfile:
+            write_image(tmpfile, diff, header, overwrite=True)
+    log.info("Differenced {} subimages against {}".format(len(images) - 1, os.path.basename(images[0])))
+
+@register_backend('Choose_Refstars', 'mock')
+def refstars(subdir, template, ra, dec, nstars=12):
+    """
+    Take the brightest clean sources of the template, away from the target, as reference stars
+    """
+    from astropy.table import Table
+    from rotseproc.io.catalog import read_catalog
+
+    catalog = os.path.join(subdir, 'prod', _root(template) + '_cobj.fit')
+    output = Table(names=['RA', 'DEC', 'MAG'])
+    if os.path.exists(catalog):
+        cat = read_catalog(catalog, ['RA', 'DEC', 'MAG', 'FLAGS'])
+        dist = np.hypot((cat['RA'] - ra) * np.cos(np.radians(dec)), cat['DEC'] - dec) * 3600.
+        clean = np.flatnonzero((np.nan_to_num(cat['FLAGS'], nan=0.) == 0) & (dist > 10.))
+        best = clean[np.argsort(cat['MAG'][clean])[:nstars]]
+        output = Table([cat['RA'][best], cat['DEC'][best], cat['MAG'][best]], names=['RA', 'DEC', 'MAG'])
+    output.meta['TARGRA'] = ra
+    output.meta['TARGDEC'] = dec
+    write_table(output, os.path.join(subdir, REFSTAR_FILE), format='fits')
+    log.info("Chose {} reference stars on {}".format(len(output), template))
+
+@register_backend('Photometry', 'mock')
+def photometry(subdir, pattern, radius=2.):
+    """
+    Aperture photometry of the target on the difference images matching pattern
+
+    The aperture radius is in units of the FWHM of the image. Images without a
+    positive flux of the target get no light curve point.
+    """
+    from astropy.table import Table
+    from rotseproc.io.fitsimage import read_image
+
+    refstarfile = os.path.join(subdir, REFSTAR_FILE)
+    target = None
+    if os.path.exists(refstarfile):
+        meta = Table.read(refstarfile).meta
+        target = (meta['TARGRA'], meta['TARGDEC'])
+
+    rows = []
+    for image in sorted(glob.glob(os.path.join(subdir, pattern))):
+        data, header = read_image(image)
+        if target is not None:
+            x, y = _pixels(header, np.atleast_1d(target[0]), np.atleast_1d(target[1]))
+            x, y = x[0], y[0]
+        else: # Subimages are centered on the target
+            y, x = (data.shape[0] - 1) / 2., (data.shape[1] - 1) / 2.
+        yy, xx = np.indices(data.shape)
+        r = radius * header.get('FWHM', 2.5)
+        aperture = (np.hypot(xx - x, yy - y) <= r) & np.isfinite(data)
+        sky = data[np.isfinite(data) & ~aperture]
+        noise = 1.4826 * np.median(np.abs(sky - np.median(sky))) if sky.size > 0 else np.nan
+        flux = np.sum(data[aperture])
+        if not flux > 0:
+            continue
+        mag = MOCK_ZP - 2.5*np.log10(flux)
+        magerr = 1.0857 * np.sqrt(flux + aperture.sum()*noise**2) / flux
+        rows.append((header['MJD'], flux, mag, mag - magerr))
+
+    if len(rows) > 0:
+        with atomic_output(os.path.join(subdir, LC_FILE)) as tmpfile:
+            np.savetxt(tmpfile, np.array(rows), fmt='%.6f')
@@ -0,0 +1,159 @@
+"""
+Native python backends of the PAs
+
+    Coaddition        : frames of each night reprojected onto the grid of the
+                        first one (see rotseproc.reproject) and median combined,
+                        the field maps are kept in the mapcache directory
+    Source_Extraction : sources detected above a threshold on the smoothed,
+                        background subtracted coadd, measured from their pixel moments
+
+Both write the same products as the legacy tools, so they can be compared with
+them for speed and accuracy on the same data. Image differencing, reference
+star selection and PSF photometry have no native backend yet.
+"""
+import os
+import numpy as np
+from rotseproc import rlogger
+from rotseproc.governor import get_governor
+from rotseproc.io.output import atomic_output, write_table
+from rotseproc.pa.backends import register_backend
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Magnitude of one count of extracted sources, like SExtractor's MAG_ZEROPOINT
+MAG_ZEROPOINT = 25.
+
+#- Pixel maps shared by the nights of a run
+_reprojection = None
+
+def _robust_sigma(values):
+    values = values[np.isfinite(values)]
+    if values.size == 0:
+        return np.nan
+    return 1.4826 * np.median(np.abs(values - np.median(values)))
+
+@register_backend('Coaddition', 'native')
+def coadd(images, preprocdir, coadddir, mapcache=None):
+    """
+    Reproject the frames of each night onto the first one and take their median
+    """
+    global _reprojection
+    from rotseproc.io.fitsimage import read_image, write_image
+    from rotseproc.reproject import ReprojectionCache
+    if _reprojection is None or _reprojection.cachedir != mapcache:
+        _reprojection = ReprojectionCache(mapcache)
+
+    bynight = {}
+    for i in sorted(images):
+        bynight.setdefault(os.path.basename(i)[:6], []).append(i)
+    for night, files in bynight.items():
+        # Frames, their reprojections and the median are in memory at once
+        memory = 3 * sum(os.path.getsize(f) for f in files)
+        with get_governor().reserve(procs=1, memory=memory, label='native coadd'):
+            frames = [read_image(f) for f in files]
+            header = frames[0][1].copy()
+            stack = _reprojection.reproject_frames([(d.astype(np.float32), h) for d, h in frames], header,
+                                                   shape_out=frames[0][0].shape)
+            data = np.nanmedian(stack, axis=0).astype(np.float32)
+
+        header['NCOMBINE'] = (len(frames), 'Number of coadded frames')
+        if 'EXPTIME' in header:
+            header['EXPTIME'] = sum(h.get('EXPTIME', 0.) for d, h in frames)
+        coadd = os.path.join(coadddir, 'image', os.path.basename(files[0])[:22] + '000-000_c.fit')
+        with atomic_output(coadd) as tmpfile:
+            write_image(tmpfile, data, header, overwrite=True)
+        log.debug("Coadded {} frames of {}".format(len(frames), night))
+
+    log.info("Reprojected with {} cached and {} new field maps, {} frames were on the output grid".format(
+        _reprojection.hits, _reprojection.misses, _reprojection.identities))
+
+def detect_sources(data, header, satlevel=None, nsigma=3., minpix=5, smooth=1.):
+    """
+    Detect and measure sources on an image
+
+    Args:
+        data     : image
+        header   : image header with its WCS
+    Optional:
+        satlevel : sources with a pixel at or above it are flagged 4 like SExtractor does
+        nsigma   : detection threshold over the noise of the smoothed image
+        minpix   : smallest number of connected pixels above the threshold
+        smooth   : sigma (pixels) of the Gaussian detection filter
+
+    Returns:
+        astropy Table with the SExtractor columns of the ROTSE-III sobj files
+    """
+    from scipy import ndimage
+    from astropy.table import Table
+    from astropy.wcs import WCS
+
+    data = np.asarray(data, dtype=np.float32)
+    good = np.isfinite(data)
+    sample = data[::4, ::4]
+    background = float(np.nanmedian(sample))
+    sub = np.where(good, data - background, 0.)
+
+    # Threshold the smoothed image, its noise is measured on the same sample grid
+    smoothed = ndimage.gaussian_filter(sub, smooth)
+    labels, nsrc = ndimage.label(smoothed > nsigma * _robust_sigma(smoothed[::4, ::4]))
+    idx = np.arange(1, nsrc + 1)
+    npix = ndimage.sum(np.ones_like(sub), labels, idx)
+    idx = idx[npix >= minpix]
+    npix = npix[npix >= minpix]
+
+    # Flux weighted moments of the pixels of each source
+    yy, xx = np.indices(sub.shape, dtype=np.float32)
+    w = np.clip(sub, 0., None)
+    flux = ndimage.sum(sub, labels, idx)
+    wsum = ndimage.sum(w, labels, idx)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = ndimage.sum(w*xx, labels, idx) / wsum
+        y = ndimage.sum(w*yy, labels, idx) / wsum
+        x2 = ndimage.sum(w*xx*xx, labels, idx) / wsum - x*x
+        y2 = ndimage.sum(w*yy*yy, labels, idx) / wsum - y*y
+        xy = ndimage.sum(w*xx*yy, labels, idx) / wsum - x*y
+        # Semi axes from the eigenvalues of the second moment matrix
+        root = np.sqrt(((x2 - y2) / 2.)**2 + xy**2)
+        a = np.sqrt(np.clip((x2 + y2) / 2. + root, 0., None))
+        b = np.sqrt(np.clip((x2 + y2) / 2. - root, 0., None))
+        noise = _robust_sigma(sub[::4, ::4])
+        mag = np.where(flux > 0, MAG_ZEROPOINT - 2.5*np.log10(np.abs(flux)), 99.)
+        magerr = np.where(flux > 0, 1.0857 * np.sqrt(np.abs(flux) + npix*noise**2) / np.abs(flux), 99.)
+        ellipticity = np.where(a > 0, 1. - b/a, np.nan)
+
+    flags = np.zeros(len(idx), dtype=np.int16)
+    if satlevel is not None and len(idx) > 0:
+        flags[ndimage.maximum(data, labels, idx) >= float(satlevel)] = 4
+    ra, dec = WCS(header).all_pix2world(x, y, 0)
+
+    table = Table()
+    table['X_IMAGE'] = x + 1.
+    table['Y_IMAGE'] = y + 1.
+    table['ALPHA_J2000'] = ra
+    table['DELTA_J2000'] = dec
+    table['MAG_AUTO'] = mag
+    table['MAGERR_AUTO'] = magerr
+    table['FWHM_IMAGE'] = 2.3548 * np.sqrt((a**2 + b**2) / 2.)
+    table['BACKGROUND'] = np.full(len(idx), background)
+    table['ELLIPTICITY'] = ellipticity
+    table['FLAGS'] = flags
+    return table
+
+@register_backend('Source_Extraction', 'native')
+def extract(cimgs, coadddir, satcnts):
+    """
+    Detect the sources of each coadd, writing the same catalog as sobj and cobj file
+    """
+    from rotseproc.io.fitsimage import read_image
+
+    for cimg, satlevel in zip(cimgs, satcnts):
+        basename = os.path.basename(cimg).split('000-000')[0]
+        with rlogger.log_context(epoch=basename), \
+             get_governor().reserve(procs=1, memory=8*os.path.getsize(cimg), label='native extraction'):
+            data, header = read_image(cimg)
+            catalog = detect_sources(data, header, satlevel)
+        root = os.path.join(coadddir, 'prod', basename + '000-000')
+        write_table(catalog, root + '_sobj.fit', format='fits')
+        write_table(catalog, root + '_cobj.fit', format='fits')
+        log.debug("Extracted {} sources".format(len(catalog)))
@@ -8,6 +8,7 @@ from astropy.io import fits
 from astropy.table import Table
 from rotseproc.pa import pas
 from rotseproc import exceptions, rlogger
+from rotseproc.io.output import makedirs, write_table
 
 rlog = rlogger.rotseLogger("ROTSE-III",20)
 log = rlog.getlog()
@@ -44,12 +45,27 @@ class Find_Data(pas.PipelineAlg):
         t_before  = kwargs['TimeBeforeDiscovery']
         t_after   = kwargs['TimeAfterDiscovery']
         datadir   = kwargs['datadir']
-        datadir   = kwargs['datadir']
-        outdir   = kwargs['outdir']
-
-        return self.run_pa(program, night, telescope, field, ra, dec, t_before, t_after, datadir, outdir)
+        outdir    = kwargs['outdir']
 
-    def run_pa(self, program, night, telescope, field, ra, dec, t_before, t_after, datadir, outdir):
+        # Optionally stage cutouts around the target instead of full frames
+        cutrad = None
+        if 'Cutout' in kwargs and kwargs['Cutout']:
+            if ra is None or dec is None or kwargs['PixelRadius'] is None:
+                log.critical("Cutouts require target coordinates and PixelRadius!")
+                sys.exit("The Find_Data PA needs RA, DEC and PixelRadius to make cutouts...")
+            margin = kwargs['CutoutMargin'] if 'CutoutMargin' in kwargs else 0
+            cutrad = kwargs['PixelRadius'] + margin
+
+        # Optionally stage night by night while later steps work on earlier nights
+        streaming = kwargs['Streaming'] if 'Streaming' in kwargs else False
+        depth     = kwargs['PrefetchNights'] if 'PrefetchNights' in kwargs else 2
+        keep      = kwargs['KeepStaged'] if 'KeepStaged' in kwargs else False
+
+        return self.run_pa(program, night, telescope, field, ra, dec, t_before, t_after, datadir, outdir, cutrad,
+                           streaming, depth, keep)
+
+    def run_pa(self, program, night, telescope, field, ra, dec, t_before, t_after, datadir, outdir, cutrad=None,
+               streaming=False, depth=2, keep=False):
         # Get data
         if program == 'supernova':
             from rotseproc.io.supernova import find_supernova_field, find_supernova_data
@@ -64,22 +80,122 @@ class Find_Data(pas.PipelineAlg):
                 if field is None:
                     log.critical("No supernova fields contain data for these coordinates.")
 
-            allimages, allprods, field = find_supernova_data(night, telescope, field, t_before, t_after, datadir)
+            if streaming:
+                # The nights are listed as the stream stages them
+                from rotseproc.io.supernova import matched_supernova_nights
+                nights = matched_supernova_nights(night, telescope, field, t_before, t_after, datadir)
+            else:
+                allimages, allprods, field = find_supernova_data(night, telescope, field, t_before, t_after, datadir)
+
+                # Remove image files without corresponding prod file
+                images, prods = match_image_prod(allimages, allprods, telescope, field)
 
-            # Remove image files without corresponding prod file
-            images, prods = match_image_prod(allimages, allprods, telescope, field)
+                from rotseproc.planner import data_workload
+                self.workload = data_workload(images, prods)
 
         else:
             log.critical("Program {} is not valid, can't find data...".format(program))
             sys.exit()
 
-        # Copy preprocessed images to output directory
-        from rotseproc.io.preproc import copy_preproc
-        copy_preproc(images, prods, outdir)
+        # Copy preprocessed images (or cutouts around the target) to output directory
+        if cutrad is not None:
+            from rotseproc.io.preproc import cutout_preproc
+            stage = lambda images, prods: cutout_preproc(images, prods, outdir, ra, dec, cutrad)
+        else:
+            from rotseproc.io.preproc import copy_preproc
+            stage = lambda images, prods: copy_preproc(images, prods, outdir)
+
+        if streaming:
+            # Leave staging to the steps consuming the nights, the workload fills in as they are listed
+            from rotseproc.io.preproc import NightStream
+            stream = NightStream(nights, stage, outdir, depth, keep)
+            self.workload = stream.workload
+            return stream
+
+        from rotseproc.governor import get_governor
+        with get_governor().reserve(io=1, label='staging'):
+            stage(images, prods)
 
         return
 
 
+class Frame_Quality(pas.PipelineAlg):
+    """
+    This PA rejects bad frames before coaddition using their prod catalogs
+    """
+    def __init__(self, name, config, logger=None):
+        if name is None or name.strip() == "":
+            name = "Frame_Quality"
+        datatype = fits.hdu.hdulist.HDUList
+        pas.PipelineAlg.__init__(self, name, datatype, datatype, config, logger)
+
+    def run(self, *args, **kwargs):
+        if len(args) == 0 :
+            log.critical("Missing input parameter!")
+            sys.exit()
+        if not self.is_compatible(type(args[0])):
+            log.critical("Incompatible input!")
+            sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
+
+        from rotseproc.io.preproc import find_stream
+
+        outdir = kwargs['outdir']
+        bounds = kwargs['Bounds'] if 'Bounds' in kwargs else None
+        nsigma = kwargs['NSigma'] if 'NSigma' in kwargs else None
+
+        return self.run_pa(outdir, bounds, nsigma, find_stream(args[0]))
+
+    def run_pa(self, outdir, bounds=None, nsigma=None, stream=None):
+        from rotseproc.io.catalog import stack_catalogs
+        from rotseproc.io.preproc import frame_key
+        from rotseproc.pa.palib import frame_quality, reject_frames
+
+        # Pair each preprocessed image with its cobj file by night, field, telescope and exposure,
+        # streamed nights are judged on their source files before they are staged
+        preprocdir = os.path.join(outdir, 'preproc')
+        if stream is None:
+            allimages = glob.glob(os.path.join(preprocdir, 'image', '*'))
+            allprods = glob.glob(os.path.join(preprocdir, 'prod', '*_cobj.fit'))
+        else:
+            allimages = stream.images
+            allprods = [p for p in stream.prods if p.endswith('_cobj.fit')]
+        prods = {frame_key(p): p for p in allprods}
+        images = [i for i in sorted(allimages) if frame_key(i) in prods]
+        cobjs = [prods[frame_key(i)] for i in images]
+
+        # Frame metrics from the catalogs only, no pixels are read
+        seg, data = stack_catalogs(cobjs, ['FWHM', 'BACKGROUND', 'MAG', 'MAGERR', 'FLAGS'])
+        quality = frame_quality(seg, len(images), data)
+        reject, reason = reject_frames(quality, bounds, nsigma)
+
+        # Move rejected frames out of the way of coaddition
+        rejectdir = os.path.join(preprocdir, 'rejected')
+        for i in np.flatnonzero(reject):
+            if stream is not None:
+                log.info("Rejecting {} ({})".format(os.path.basename(images[i]), reason[i]))
+                continue
+            makedirs(os.path.join(rejectdir, 'image'), os.path.join(rejectdir, 'prod'))
+            log.info("Rejecting {} ({})".format(os.path.basename(images[i]), reason[i]))
+            os.replace(images[i], os.path.join(rejectdir, 'image', os.path.basename(images[i])))
+            os.replace(cobjs[i], os.path.join(rejectdir, 'prod', os.path.basename(cobjs[i])))
+        log.info("Rejected {} of {} frames".format(int(reject.sum()), len(images)))
+
+        output = Table()
+        output['FRAME'] = [os.path.basename(i) for i in images]
+        for key in quality:
+            output[key] = quality[key]
+        output['REJECTED'] = reject
+        output['REASON'] = reason
+        makedirs(preprocdir)
+        write_table(output, os.path.join(preprocdir, 'frame_quality.fits'))
+
+        if stream is not None:
+            stream.reject([images[i] for i in np.flatnonzero(reject)])
+            return output, stream
+
+        return output
+
+
 class Coaddition(pas.PipelineAlg):
     """
     This PA coadds preprocessed images for each night
@@ -98,31 +214,34 @@ class Coaddition(pas.PipelineAlg):
             log.critical("Incompatible input!")
             sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
 
-        outdir = kwargs['outdir']
+        from rotseproc.io.preproc import find_stream
 
-        return self.run_pa(outdir)
+        outdir   = kwargs['outdir']
+        backend  = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
+        mapcache = kwargs['mapcache'] if 'mapcache' in kwargs else None
 
-    def run_pa(self, outdir):
-        # Set up IDL commands
-        idl = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
+        return self.run_pa(outdir, find_stream(args[0]), backend, mapcache)
+
+    def run_pa(self, outdir, stream=None, backend='legacy', mapcache=None):
+        from rotseproc.pa.backends import get_backend
+        coadd = get_backend('Coaddition', backend)
         preprocdir = outdir + '/preproc/'
         imagedir = preprocdir + 'image/'
-        files = "file_search('{}*')".format(imagedir)
-
-        # Run coaddition
-        os.chdir(preprocdir)
-        os.system('{} -32 -e "coadd_all,{}"'.format(idl, files))
 
         # Make coadd directories
         coadddir = outdir + '/coadd/'
-        os.mkdir(coadddir)
-        os.mkdir(coadddir + '/image')
-        os.mkdir(coadddir + '/prod')
+        makedirs(coadddir + 'image', coadddir + 'prod')
 
-        # Move coadds to coadd directory
-        coadds = glob.glob('*000-000_c.fit')
-        for c in coadds:
-            os.replace(c, os.path.join(coadddir, 'image', c))
+        if stream is None:
+            coadd(sorted(glob.glob(imagedir + '*')), preprocdir, coadddir, mapcache)
+        else:
+            # Coadd each night as soon as it is staged, later nights are staged meanwhile
+            for date, images, prods in stream:
+                with rlogger.log_context(epoch=date):
+                    if len(images) == 0:
+                        log.info("No frames left to coadd")
+                        continue
+                    coadd(images, preprocdir, coadddir, mapcache)
 
         # Find coadded images to pass to QAs
         coadd_files = glob.glob(coadddir + 'image/*')
@@ -149,54 +268,128 @@ class Source_Extraction(pas.PipelineAlg):
             log.critical("Incompatible input!")
             sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
 
-        outdir = kwargs['outdir']
+        outdir      = kwargs['outdir']
+        headercache = kwargs['headercache'] if 'headercache' in kwargs else None
+        backend     = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
 
-        return self.run_pa(outdir)
+        return self.run_pa(outdir, headercache, backend)
 
-    def run_pa(self, outdir):
-        # Set up sextractor environment
-        extract_par = '/scratch/group/astro/rotse/software/products/idltools/umrotse_idl/tools/sex/'
-        extract_config = '/scratch/group/astro/rotse/software/products/idltools/umrotse_idl/tools/sex/'
+    def run_pa(self, outdir, headercache=None, backend='legacy'):
+        from rotseproc.pa.backends import get_backend
+        extract = get_backend('Source_Extraction', backend)
 
-        # Run sextractor on each coadded image
+        # Extract sources from each coadded image
         coadddir = outdir + '/coadd'
-        os.chdir(coadddir)
         coadds = os.listdir(coadddir+'/image')
-        n_files = len(coadds)
-        idl = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
-        singularity = "singularity shell --bind /scratch /hpc/applications/rotsesoftware/rotsesoftware.simg"
-        for i in range(n_files):
-            # Set up output files
-            conf = {'sobjdir':'', 'root':'', 'cimg':'', 'sobj':'', 'cobj':''}
-            conf['sobjdir'] = coadddir+'/prod/'
-            basename = coadds[i].split('000-000')[0]
-            coaddname = basename + '000-000'
-            conf['root'] = coaddname
-            conf['cimg'] = coadddir + '/image/' + coaddname + '_c.fit'
-            conf['sobj'] = coadddir + '/prod/' + coaddname + '_sobj.fit'
-            conf['cobj'] = coadddir + '/prod/' + coaddname + '_cobj.fit'
-            skyname = coadddir + '/prod/' + coaddname + '_sky.fit'
-
-            # Get saturation level
-            chdr = fits.open(conf['cimg'])[0].header
-            satlevel = str(chdr['SATCNTS'])
-
-            # Run sextractor
-            cmd = 'sex ' + conf['cimg'] + ' -c ' + extract_par + '/rotse3.sex -PARAMETERS_NAME ' + extract_par + '/rotse3.par -FILTER_NAME ' + extract_config + '/gauss_2.0_5x5.conv -PHOT_APERTURES 7 -SATUR_LEVEL ' + satlevel + ' -CATALOG_NAME ' + conf['sobj'] + ' -CHECKIMAGE_NAME ' + skyname
-            os.system(cmd)
-
-           # Calibrate sobj file
-           # os.system('{} -32 -e "run_cal,{}"'.format(idl, [coadds[i]]))
-
-        # Login to singularity and generate cobj files
-        log.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        log.info("!!! Logging into singularity. Make cobj files !!!")
-        log.info("!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-        os.system(singularity)
+
+        # Get saturation levels of all coadds at once
+        cimgs = [coadddir + '/image/' + c.split('000-000')[0] + '000-000_c.fit' for c in coadds]
+        # Values keep their header type, so SExtractor gets them as written
+        if headercache is not None:
+            from rotseproc.io.headercache import HeaderCache
+            cache = HeaderCache(headercache)
+            satcnts = [h['SATCNTS'] for h in cache.headers(cimgs, ['SATCNTS'])]
+            cache.close()
+        else:
+            from rotseproc.io.fitsimage import read_header
+            satcnts = [read_header(c).get('SATCNTS') for c in cimgs]
+        missing = [os.path.basename(c) for c, s in zip(cimgs, satcnts) if s is None]
+        if len(missing) > 0:
+            raise exceptions.ParameterException("No SATCNTS in the header of {}".format(', '.join(missing)))
+
+        extract(cimgs, coadddir, satcnts)
 
         return
 
 
+class Zero_Points(pas.PipelineAlg):
+    """
+    This PA solves the photometric zero points of all coadds in one fit
+    """
+    def __init__(self, name, config, logger=None):
+        if name is None or name.strip() == "":
+            name = "Zero_Points"
+        datatype = fits.hdu.hdulist.HDUList
+        pas.PipelineAlg.__init__(self, name, datatype, datatype, config, logger)
+
+    def run(self, *args, **kwargs):
+        if len(args) == 0 :
+            log.critical("Missing input parameter!")
+            sys.exit()
+        if not self.is_compatible(type(args[0])):
+            log.critical("Incompatible input!")
+            sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
+
+        outdir      = kwargs['outdir']
+        zpfile      = kwargs['zpfile']
+        refcat      = kwargs['RefCatalog'] if 'RefCatalog' in kwargs else None
+        colorterm   = kwargs['ColorTerm'] if 'ColorTerm' in kwargs else False
+        radius      = kwargs['MatchRadius'] if 'MatchRadius' in kwargs else 5.
+        nsigma      = kwargs['NSigma'] if 'NSigma' in kwargs else 3.
+        maxerr      = kwargs['MaxMagErr'] if 'MaxMagErr' in kwargs else 0.1
+        headercache = kwargs['headercache'] if 'headercache' in kwargs else None
+
+        return self.run_pa(outdir, zpfile, refcat, colorterm, radius, nsigma, maxerr, headercache)
+
+    def run_pa(self, outdir, zpfile, refcat=None, colorterm=False, radius=5., nsigma=3., maxerr=0.1, headercache=None):
+        from rotseproc.io.catalog import stack_catalogs, read_catalog
+        from rotseproc.pa.palib import match_sources, solve_zero_points
+
+        # Source catalogs of the coadds
+        coadddir = os.path.join(outdir, 'coadd')
+        sobjs = sorted(glob.glob(os.path.join(coadddir, 'prod', '*_sobj.fit')))
+        epochs = [os.path.basename(s).replace('_sobj.fit', '') for s in sobjs]
+        cimgs = [os.path.join(coadddir, 'image', e + '_c.fit') for e in epochs]
+        seg, data = stack_catalogs(sobjs, ['RA', 'DEC', 'MAG', 'MAGERR', 'FLAGS'])
+        clean = (np.nan_to_num(data['FLAGS'], nan=0.) == 0) & (data['MAGERR'] < maxerr)
+
+        # Reference stars from a catalog, or the clean sources of the richest epoch
+        if refcat is not None:
+            ref = read_catalog(refcat, ['RA', 'DEC', 'MAG', 'COLOR'])
+            refra, refdec, refmag = ref['RA'], ref['DEC'], ref['MAG']
+            color = ref['COLOR'] if colorterm else None
+        else:
+            nclean = np.bincount(seg[clean], minlength=len(sobjs))
+            best = clean & (seg == np.argmax(nclean)) if len(sobjs) > 0 else clean
+            refra, refdec, refmag, color = data['RA'][best], data['DEC'][best], None, None
+            if colorterm:
+                log.warning("A color term needs a reference catalog with colors, fitting zero points only")
+
+        star = match_sources(data['RA'], data['DEC'], refra, refdec, radius)
+        star[~clean] = -1
+        zp = solve_zero_points(seg, star, data['MAG'], data['MAGERR'], len(sobjs), len(refra),
+                               refmag=refmag, color=color, nsigma=nsigma)
+
+        # Epoch times for photometry to look up the zero points
+        keys = ['MJD', 'DATE-OBS']
+        if headercache is not None:
+            from rotseproc.io.headercache import HeaderCache
+            cache = HeaderCache(headercache)
+            headers = cache.headers(cimgs, keys)
+            cache.close()
+        else:
+            from rotseproc.io.fitsimage import read_header
+            headers = [{k: h[k] if k in h else None for k in keys} for h in map(read_header, cimgs)]
+        from astropy.time import Time
+        mjd = [h['MJD'] if h['MJD'] is not None else Time(h['DATE-OBS']).mjd if h['DATE-OBS'] is not None else np.nan
+               for h in headers]
+
+        output = Table()
+        output['EPOCH'] = epochs
+        output['NIGHT'] = [e[:6] for e in epochs]
+        output['MJD'] = np.asarray(mjd, dtype=float)
+        for key in ['ZP', 'ZP_ERR', 'NSTARS', 'NCLIP']:
+            output[key] = zp[key]
+        if np.isfinite(zp['COLOR_TERM']):
+            output.meta['COLORTRM'] = zp['COLOR_TERM']
+        output.meta['ABSOLUTE'] = refmag is not None
+        write_table(output, zpfile)
+        log.info("Solved zero points of {} epochs from {} measurements of {} stars".format(
+            len(epochs), int(zp['USED'].sum()), len(refra)))
+
+        return output
+
+
 class Make_Subimages(pas.PipelineAlg):
     """
     This PA makes subimages centered around transient
@@ -223,33 +416,22 @@ class Make_Subimages(pas.PipelineAlg):
         pixrad    = kwargs['PixelRadius']
         tempdir   = kwargs['tempdir']
         outdir    = kwargs['outdir']
+        backend   = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
 
-        return self.run_pa(program, telescope, ra, dec, pixrad, tempdir, outdir)
+        return self.run_pa(program, telescope, ra, dec, pixrad, tempdir, outdir, backend)
 
-    def run_pa(self, program, telescope, ra, dec, pixrad, tempdir, outdir):
+    def run_pa(self, program, telescope, ra, dec, pixrad, tempdir, outdir, backend='legacy'):
+        from rotseproc.pa.backends import get_backend
+        subimages = get_backend('Make_Subimages', backend)
         if program == 'supernova':
             from rotseproc.io.supernova import find_reference_image
             find_reference_image(telescope, tempdir, outdir)
 
-        # Make subimages
-        idl = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
+        # Make subimages of the coadds and the reference image in the sub directory
         coadddir = outdir + '/coadd/'
-        files = os.listdir(coadddir+'/image')
-        os.chdir(coadddir)
-        os.system('{} -32 -e "make_rotse3_subimage,{},racent={},deccent={},pixrad={}"'.format(idl, files, ra, dec, pixrad))
-
-        # Move subimages to sub directory
         subdir = os.path.join(outdir, 'sub')
-        os.mkdir(subdir)
-        os.mkdir(os.path.join(subdir, 'image'))
-        os.mkdir(os.path.join(subdir, 'prod'))
-
-        images = glob.glob('*_c.fit')
-        for i in images:
-            os.replace(i, os.path.join(subdir, 'image', i))
-        prods = glob.glob('*_cobj.fit')
-        for p in prods:
-            os.replace(p, os.path.join(subdir, 'prod', p))
+        makedirs(os.path.join(subdir, 'image'), os.path.join(subdir, 'prod'))
+        subimages(coadddir, subdir, ra, dec, pixrad)
 
         return
 
@@ -273,16 +455,18 @@ class Image_Differencing(pas.PipelineAlg):
             log.critical("Incompatible input!")
             sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
 
-        outdir = kwargs['outdir']
+        outdir  = kwargs['outdir']
+        backend = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
+
+        return self.run_pa(outdir, backend)
 
-        return self.run_pa(outdir)
+    def run_pa(self, outdir, backend='legacy'):
+        from rotseproc.pa.backends import get_backend
+        difference = get_backend('Image_Differencing', backend)
 
-    def run_pa(self, outdir):
         # Run image differencing on all subimages
         subdir = os.path.join(outdir, 'sub')
-        imdir = os.path.join(subdir, 'image')
-        os.chdir(subdir)
-        os.system('module swap python/2; difference_all.py -i {}; module swap python/3'.format(imdir))
+        difference(subdir)
 
         return
 
@@ -306,13 +490,17 @@ class Choose_Refstars(pas.PipelineAlg):
             log.critical("Incompatible input!")
             sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
 
-        ra     = kwargs['RA']
-        dec    = kwargs['DEC']
-        outdir = kwargs['outdir']
+        ra      = kwargs['RA']
+        dec     = kwargs['DEC']
+        outdir  = kwargs['outdir']
+        backend = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
+
+        return self.run_pa(ra, dec, outdir, backend)
 
-        return self.run_pa(ra, dec, outdir)
+    def run_pa(self, ra, dec, outdir, backend='legacy'):
+        from rotseproc.pa.backends import get_backend
+        refstars = get_backend('Choose_Refstars', backend)
 
-    def run_pa(self, ra, dec, outdir):
         # Find template subimage
         subdir = os.path.join(outdir, 'sub')
         images = sorted(os.listdir(os.path.join(subdir, 'image')))
@@ -324,11 +512,8 @@ class Choose_Refstars(pas.PipelineAlg):
         else:
             template = images[-1]
 
-        # Open rphot GUI and choose ref stars
-        idl = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
-        os.chdir(subdir)
-        ref = "file_search('image/{}')".format(template)
-        os.system('{} -32 -e "rphot,data,imlist={},refname={},targetra={},targetdec={},/small"'.format(idl, ref, ref, ra, dec))
+        # Choose the reference stars on the template
+        refstars(subdir, template, ra, dec)
 
         return
 
@@ -354,44 +539,49 @@ class Photometry(pas.PipelineAlg):
 
         outdir   = kwargs['outdir']
         dumpfile = kwargs['dumpfile']
+        target   = kwargs['Target'] if 'Target' in kwargs else os.path.basename(os.path.normpath(outdir))
+        lcstore  = kwargs['lcstore'] if 'lcstore' in kwargs else None
+        zpfile   = kwargs['zpfile'] if 'zpfile' in kwargs else None
+        backend  = kwargs['Backend'] if 'Backend' in kwargs else 'legacy'
 
-        return self.run_pa(outdir, dumpfile)
+        return self.run_pa(outdir, dumpfile, target, lcstore, zpfile, backend)
+
+    def run_pa(self, outdir, dumpfile, target=None, lcstore=None, zpfile=None, backend='legacy'):
+        from rotseproc.pa.backends import get_backend
+        photometry = get_backend('Photometry', backend)
 
-    def run_pa(self, outdir, dumpfile):
         # Do photometry
-        idl = "singularity run --bind /scratch /hpc/applications/idl/idl_8.0.simg"
         subdir = os.path.join(outdir, 'sub')
         imdir = os.path.join(subdir, 'image')
         images = glob.glob(imdir + '/*sub*')
-        os.chdir(subdir)
 
         # Make sure photometry runs on each image, move images that don't work
         nophotdir = os.path.join(subdir, 'nophot')
-        os.mkdir(nophotdir)
+        makedirs(nophotdir)
         for image in images:
             night = os.path.basename(image)[:6]
-            imfile = "file_search('image/{}*sub*')".format(night)
-            os.system('{} -32 -e "run_phot,{}"'.format(idl, imfile))
+            with rlogger.log_context(epoch=night):
+                photometry(subdir, 'image/{}*sub*'.format(night))
 
-            lcfile = os.path.join(subdir, 'lightcurve_subtract_target_psf.dat')
-            if os.path.exists(lcfile):
-                os.remove(lcfile)
-            else:
-                os.replace(image, os.path.join(nophotdir, os.path.basename(image)))
+                lcfile = os.path.join(subdir, 'lightcurve_subtract_target_psf.dat')
+                if os.path.exists(lcfile):
+                    os.remove(lcfile)
+                else:
+                    log.warning("Photometry failed on {}, moving it to {}".format(os.path.basename(image), nophotdir))
+                    os.replace(image, os.path.join(nophotdir, os.path.basename(image)))
 
         if len(os.listdir(nophotdir)) == 0:
             os.rmdir(nophotdir)
 
         # Run photometry on all good images
-        imgood = "file_search('image/*sub*')"
-        os.system('{} -32 -e "run_phot,{}"'.format(idl, imgood))
+        photometry(subdir, 'image/*sub*')
 
         ndata = len(glob.glob(imdir + '/*sub*'))
         log.info("Ran photometry on {} nights of data".format(ndata))
 
         # Output light curve data and plot
         from rotseproc.pa.palib import get_light_curve_data
-        from rotseproc.pa.paplots import plot_light_curve
+        from rotseproc.plotservice import submit_plot
 
         lc_data_file = os.path.join(subdir, 'lightcurve_subtract_target_psf.dat')
         mjd, mag, magerr = get_light_curve_data(lc_data_file)
@@ -399,9 +589,35 @@ class Photometry(pas.PipelineAlg):
         output['MJD'] = mjd
         output['ROTSE_MAG'] = mag
         output['MAG_ERR'] = magerr
-        output.write(os.path.join(outdir, 'lightcurve.fits'))
 
-        plot_light_curve(mjd, mag, magerr, dumpfile)
+        # Calibrate with the zero point of each epoch from Zero_Points. Zero points
+        # solved without a reference catalog are relative offsets between epochs,
+        # they are attached but the magnitudes are left instrumental.
+        if zpfile is not None and os.path.exists(zpfile):
+            from rotseproc.pa.palib import calibrate_light_curve
+            zp = Table.read(zpfile)
+            absolute = bool(zp.meta.get('ABSOLUTE', False))
+            mag, magerr, output['ZP'], output['ZP_ERR'] = calibrate_light_curve(mjd, mag, magerr, zp, absolute)
+            output.meta['ZPAPPLD'] = absolute
+            if absolute:
+                output['INST_MAG'] = output['ROTSE_MAG']
+                output['INST_ERR'] = output['MAG_ERR']
+                output['ROTSE_MAG'] = mag
+                output['MAG_ERR'] = magerr
+                nmissing = int(np.sum(~np.isfinite(output['ZP'])))
+                if nmissing > 0:
+                    log.warning("{} of {} light curve points have no zero point and no calibrated magnitude".format(
+                        nmissing, len(mjd)))
+            else:
+                log.info("Zero points are relative, attaching them as offsets between epochs without calibrating")
+        write_table(output, os.path.join(outdir, 'lightcurve.fits'))
+
+        # Add light curve to the multi-target light curve store
+        if lcstore is not None:
+            from rotseproc.io.lightcurve import LightCurveStore
+            LightCurveStore(lcstore).upsert(target, mjd, mag, magerr)
+
+        submit_plot('rotseproc.pa.paplots', 'plot_light_curve', mjd, mag, magerr, dumpfile)
 
         return
 
@@ -18,3 +18,441 @@ def get_light_curve_data(lc_data_file):
 
     return mjd, mag, magerr
 
+def _segment_sums(seg, nseg, weights, *columns):
+    """
+    Weighted per-segment sums of each column
+    """
+    return [np.bincount(seg, weights=weights*c, minlength=nseg) for c in columns]
+
+def _segment_slope(seg, nseg, w, x, y):
+    """
+    Per-segment least squares slope of y against x using points with weight w
+    """
+    sw, sx, sy, sxx, sxy = _segment_sums(seg, nseg, w, np.ones_like(x), x, y, x*x, x*y)
+    denom = sw*sxx - sx*sx
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where((sw >= 2) & (denom > 0), (sw*sxy - sx*sy)/denom, np.nan)
+    return slope
+
+def fit_light_curve_peaks(seg, nseg, dt, mag, window=30., nsigma=3., niter=3):
+    """
+    Robust quadratic fit of all light curve peaks at once
+
+    Args:
+        seg    : segment (target) index of each point
+        nseg   : number of segments
+        dt     : time of each point relative to the observed peak of its segment
+        mag    : magnitude of each point
+    Optional:
+        window : fit points within +/- window days of the observed peak
+        nsigma : clip points deviating more than nsigma times the fit rms
+        niter  : number of clipping iterations
+
+    Returns:
+        dt_peak, mag_peak : fitted peak time offset and magnitude per segment (NaN if the fit fails)
+    """
+    w = ((np.abs(dt) <= window) & np.isfinite(mag)).astype(float)
+    y = np.where(w > 0, mag, 0.)
+    x = np.where(w > 0, dt, 0.)
+    coeffs = np.full((nseg, 3), np.nan)
+
+    for it in range(niter + 1):
+        # Normal equations of y = c0 + c1*x + c2*x^2 for every segment
+        s = _segment_sums(seg, nseg, w, np.ones_like(x), x, x**2, x**3, x**4, y, x*y, x*x*y)
+        A = np.stack([np.stack([s[0], s[1], s[2]], -1),
+                      np.stack([s[1], s[2], s[3]], -1),
+                      np.stack([s[2], s[3], s[4]], -1)], -2)
+        b = np.stack([s[5], s[6], s[7]], -1)
+        good = (s[0] >= 4) & (np.abs(np.linalg.det(A)) > 1e-12)
+        coeffs[:] = np.nan
+        if good.any():
+            coeffs[good] = np.linalg.solve(A[good], b[good][..., None])[..., 0]
+
+        if it == niter:
+            break
+
+        # Clip outliers from each segment's fit
+        model = coeffs[seg, 0] + coeffs[seg, 1]*x + coeffs[seg, 2]*x*x
+        resid = np.where(w > 0, y - model, 0.)
+        nfit = np.bincount(seg, weights=w, minlength=nseg)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rms = np.sqrt(np.bincount(seg, weights=resid**2, minlength=nseg) / np.maximum(nfit - 3, 1))
+        clip = np.abs(resid) > nsigma * rms[seg]
+        w = np.where(clip | ~np.isfinite(model), 0., w)
+
+    # The peak is the parabola minimum (brightest magnitude), which must open upward and lie in the window
+    c0, c1, c2 = coeffs[:, 0], coeffs[:, 1], coeffs[:, 2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dt_peak = np.where(c2 > 0, -c1/(2*c2), np.nan)
+    dt_peak = np.where(np.abs(dt_peak) <= window, dt_peak, np.nan)
+    mag_peak = c0 + c1*dt_peak + c2*dt_peak**2
+
+    return dt_peak, mag_peak
+
+def light_curve_features(target_ids, mjd, mag, magerr, window=30.):
+    """
+    Compute light curve features for many targets at once
+
+    Light curves are given as flat arrays with one entry per point, e.g. the
+    output of rotseproc.io.lightcurve.LightCurveStore.query.
+
+    Args:
+        target_ids : target id of each point
+        mjd, mag, magerr : light curve points
+    Optional:
+        window : days around the observed peak used for the peak fit
+
+    Returns:
+        dictionary of per-target feature arrays: TARGET_ID, NDET, MJD_FIRST, MJD_LAST,
+        PEAK_MAG, PEAK_MJD, FIT_PEAK_MAG, FIT_PEAK_MJD, RISE_RATE and DECLINE_RATE
+        (rates in mag/day, positive when brightening before and fading after peak)
+    """
+    target_ids = np.asarray(target_ids)
+    mjd = np.asarray(mjd, dtype=float)
+    mag = np.asarray(mag, dtype=float)
+    magerr = np.asarray(magerr, dtype=float)
+
+    # Sort points by target then time and find the segment of each point
+    order = np.lexsort((mjd, target_ids))
+    target_ids, mjd, mag, magerr = target_ids[order], mjd[order], mag[order], magerr[order]
+    ids, start, seg = np.unique(target_ids, return_index=True, return_inverse=True)
+    nseg = len(ids)
+
+    detected = np.isfinite(mag) & np.isfinite(magerr)
+    ndet = np.bincount(seg, weights=detected, minlength=nseg).astype(int)
+
+    # Observed peak: first brightest detection of each segment
+    brightness = np.where(detected, mag, np.inf)
+    peak_mag = np.minimum.reduceat(brightness, start)
+    is_peak = detected & (brightness == peak_mag[seg])
+    peak_idx = np.full(nseg, -1)
+    first = np.flatnonzero(is_peak)
+    segs, where = np.unique(seg[first], return_index=True)
+    peak_idx[segs] = first[where]
+    peak_mjd = np.where(peak_idx >= 0, mjd[peak_idx], np.nan)
+    peak_mag = np.where(peak_idx >= 0, peak_mag, np.nan)
+
+    # Linear rise and decline rates on either side of the peak
+    dt = mjd - peak_mjd[seg]
+    w = detected.astype(float)
+    yy = np.where(detected, mag, 0.)
+    rise_rate = -_segment_slope(seg, nseg, w*(dt <= 0), dt, yy)
+    decline_rate = _segment_slope(seg, nseg, w*(dt >= 0), dt, yy)
+
+    dt_fit, fit_peak_mag = fit_light_curve_peaks(seg, nseg, np.where(detected, dt, np.inf), mag, window=window)
+
+    features = {'TARGET_ID'    : ids,
+                'NDET'         : ndet,
+                'MJD_FIRST'    : mjd[start],
+                'MJD_LAST'     : np.maximum.reduceat(mjd, start),
+                'PEAK_MAG'     : peak_mag,
+                'PEAK_MJD'     : peak_mjd,
+                'FIT_PEAK_MAG' : fit_peak_mag,
+                'FIT_PEAK_MJD' : peak_mjd + dt_fit,
+                'RISE_RATE'    : rise_rate,
+                'DECLINE_RATE' : decline_rate}
+
+    return features
+
+def _segment_median(seg, nseg, values):
+    """
+    Median of the finite values of each segment (NaN for empty segments)
+    """
+    good = np.isfinite(values)
+    seg, values = seg[good], values[good]
+    order = np.lexsort((values, seg))
+    values = values[order]
+    counts = np.bincount(seg, minlength=nseg)
+    start = np.cumsum(counts) - counts
+    lo = start + np.maximum(counts - 1, 0) // 2
+    hi = start + counts // 2
+    median = np.full(nseg, np.nan)
+    has = counts > 0
+    median[has] = 0.5*(values[lo[has]] + values[hi[has]])
+
+    return median
+
+def frame_quality(seg, nframes, data, snr_limit=5., min_slope=0.05, min_sources=10):
+    """
+    Per-frame quality metrics from the source catalogs of all frames at once
+
+    Args:
+        seg     : frame index of each source
+        nframes : number of frames
+        data    : dictionary of FWHM, BACKGROUND, MAG, MAGERR and FLAGS arrays
+                  over all sources, e.g. from rotseproc.io.catalog.stack_catalogs
+    Optional:
+        snr_limit   : signal to noise of the limiting magnitude
+        min_slope   : smallest slope of log10(magerr) with magnitude (0.4 for background
+                      limited sources) that gives a limiting magnitude
+        min_sources : fewest clean sources of a frame that give a limiting magnitude
+
+    Returns:
+        dictionary of per-frame NSOURCES, FWHM, BACKGROUND and LIMITING_MAG arrays,
+        LIMITING_MAG is NaN for frames whose fit can't be extrapolated
+    """
+    flags = np.nan_to_num(data['FLAGS'], nan=0.)
+    mag, magerr = data['MAG'], data['MAGERR']
+    detected = np.isfinite(mag) & np.isfinite(magerr) & (magerr > 0) & (mag < 90.)
+    clean = detected & (flags == 0)
+
+    nsources = np.bincount(seg, weights=detected, minlength=nframes).astype(int)
+
+    # Seeing and sky from clean, well measured sources
+    bright = clean & (magerr < 0.1)
+    fwhm = _segment_median(seg, nframes, np.where(bright & (data['FWHM'] > 0), data['FWHM'], np.nan))
+    background = _segment_median(seg, nframes, np.where(clean, data['BACKGROUND'], np.nan))
+
+    # Limiting magnitude from a per-frame fit of log10(magerr) = a + b*mag
+    w = clean.astype(float)
+    x = np.where(clean, mag, 0.)
+    y = np.where(clean, np.log10(np.where(clean, magerr, 1.)), 0.)
+    sw, sx, sy = _segment_sums(seg, nframes, w, np.ones_like(x), x, y)
+    slope = _segment_slope(seg, nframes, w, x, y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intercept = (sy - slope*sx) / sw
+        # Flat errors (nearly zero slope) extrapolate to absurd limits
+        fit = (slope >= min_slope) & (sw >= min_sources)
+        limiting_mag = np.where(fit, (np.log10(1.0857/snr_limit) - intercept) / slope, np.nan)
+
+    return {'NSOURCES'     : nsources,
+            'FWHM'         : fwhm,
+            'BACKGROUND'   : background,
+            'LIMITING_MAG' : limiting_mag}
+
+#- Direction in which each frame quality metric gets worse
+FRAME_QUALITY_BAD = {'NSOURCES': -1, 'FWHM': 1, 'BACKGROUND': 1, 'LIMITING_MAG': -1}
+
+def reject_frames(quality, bounds=None, nsigma=None, minframes=5):
+    """
+    Flag frames outside configured bounds or statistical outliers
+
+    Args:
+        quality : dictionary of per-frame metrics from frame_quality
+    Optional:
+        bounds    : dictionary of [min, max] per metric, None entries are not applied
+        nsigma    : also reject frames worse than the median by more than nsigma
+                    robust standard deviations (needs at least minframes frames)
+
+    Returns:
+        reject : boolean array of rejected frames
+        reason : list of comma separated metrics that rejected each frame
+    """
+    nframes = len(quality['NSOURCES'])
+    bad = {}
+    for key, sign in FRAME_QUALITY_BAD.items():
+        values = np.asarray(quality[key], dtype=float)
+        flag = np.zeros(nframes, dtype=bool)
+        if bounds is not None and key in bounds and bounds[key] is not None:
+            lo, hi = bounds[key]
+            if lo is not None:
+                flag |= values < lo
+            if hi is not None:
+                flag |= values > hi
+        finite = np.isfinite(values)
+        if nsigma is not None and finite.sum() >= minframes:
+            med = np.median(values[finite])
+            sigma = 1.4826 * np.median(np.abs(values[finite] - med))
+            if sigma > 0:
+                flag |= finite & (sign*(values - med) > nsigma*sigma)
+        bad[key] = flag
+
+    reject = np.zeros(nframes, dtype=bool)
+    for flag in bad.values():
+        reject |= flag
+    reason = [','.join(k for k in bad if bad[k][i]) for i in range(nframes)]
+
+    return reject, reason
+
+def match_sources(ra, dec, refra, refdec, radius=5.):
+    """
+    Match sources of any number of epochs to a reference list at once
+
+    Args:
+        ra, dec       : source coordinates in degrees
+        refra, refdec : reference star coordinates in degrees
+    Optional:
+        radius        : match radius in arcsec
+
+    Returns:
+        index of the matched reference star of each source, -1 if unmatched
+    """
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+
+    ra, dec = np.asarray(ra, dtype=float), np.asarray(dec, dtype=float)
+    star = np.full(len(ra), -1)
+    good = np.isfinite(ra) & np.isfinite(dec)
+    if good.sum() == 0 or len(refra) == 0:
+        return star
+
+    src = SkyCoord(ra[good]*u.deg, dec[good]*u.deg)
+    ref = SkyCoord(np.asarray(refra)*u.deg, np.asarray(refdec)*u.deg)
+    idx, sep, _ = src.match_to_catalog_sky(ref)
+    star[good] = np.where(sep.arcsec <= radius, idx, -1)
+
+    return star
+
+def solve_zero_points(epoch, star, mag, magerr, nepoch, nstar, refmag=None, color=None,
+                      nsigma=3., niter=5, errfloor=0.01):
+    """
+    Solve the zero points of all epochs in one sparse robust least squares fit
+
+    Calibrated magnitudes are mag + ZP[epoch] (+ COLOR_TERM*color[star]). With
+    reference magnitudes the fit is refmag[star] - mag = ZP[epoch] (+ k*color[star]).
+    Without them the star magnitudes are fitted as well, mag = m[star] - ZP[epoch],
+    and the zero points are relative with a mean of zero.
+
+    Args:
+        epoch, star : epoch and reference star index of each measurement
+        mag, magerr : instrumental magnitudes and errors
+        nepoch      : number of epochs
+        nstar       : number of reference stars
+    Optional:
+        refmag   : reference magnitude of each star
+        color    : color of each star, fits a color term (needs refmag)
+        nsigma   : clip measurements deviating more than nsigma robust sigmas
+        niter    : maximum number of clipping iterations
+        errfloor : floor added in quadrature to magerr
+
+    Returns:
+        dictionary with per-epoch ZP, ZP_ERR, NSTARS and NCLIP arrays, the
+        COLOR_TERM (NaN if not fitted) and the boolean USED mask of measurements
+    """
+    from scipy import sparse
+    from scipy.sparse.linalg import lsqr
+
+    epoch, star = np.asarray(epoch), np.asarray(star)
+    mag, magerr = np.asarray(mag, dtype=float), np.asarray(magerr, dtype=float)
+    sigma = np.sqrt(magerr**2 + errfloor**2)
+    use = (star >= 0) & np.isfinite(mag) & np.isfinite(sigma)
+    fitcolor = color is not None and refmag is not None
+    if refmag is not None:
+        refmag = np.asarray(refmag, dtype=float)
+        use &= np.isfinite(refmag[np.maximum(star, 0)])
+    if fitcolor:
+        color = np.asarray(color, dtype=float)
+        use &= np.isfinite(color[np.maximum(star, 0)])
+
+    nrow = len(mag)
+    rows = np.arange(nrow)
+    if refmag is not None:
+        # refmag - mag = ZP[epoch] (+ k*color)
+        y = np.where(use, refmag[np.maximum(star, 0)] - mag, 0.)
+        cols, vals = [epoch], [np.ones(nrow)]
+        if fitcolor:
+            cols.append(np.full(nrow, nepoch))
+            vals.append(color[np.maximum(star, 0)])
+        nvar = nepoch + int(fitcolor)
+    else:
+        # mag = m[star] - ZP[epoch], with sum(ZP) = 0 fixing the free offset
+        y = np.where(use, mag, 0.)
+        cols, vals = [nepoch + np.maximum(star, 0), epoch], [np.ones(nrow), -np.ones(nrow)]
+        nvar = nepoch + nstar
+
+    A0 = sparse.csr_matrix((np.concatenate(vals), (np.tile(rows, len(cols)), np.concatenate(cols))), shape=(nrow, nvar))
+
+    def clip(chi, clipped):
+        # Measurements deviating by more than nsigma robust sigmas (at least nsigma errors)
+        used = use & ~clipped
+        scale = 1.4826*np.median(np.abs(chi[used])) if used.any() else 1.
+        return use & (np.abs(chi) > nsigma*max(scale, 1.))
+
+    # Robust start: the median offset of each epoch (and star) isn't pulled by outliers,
+    # whereas one outlier can shift a least squares zero point enough to clip its whole epoch
+    if refmag is not None:
+        model = _segment_median(epoch, nepoch, np.where(use, y, np.nan))[epoch]
+    else:
+        # Median polish, alternating star and epoch medians so the spread of
+        # the zero points doesn't enter the star magnitudes
+        zp0 = np.zeros(nepoch)
+        for _ in range(3):
+            mstar = _segment_median(np.maximum(star, 0), nstar, np.where(use, mag + zp0[epoch], np.nan))
+            zp0 = _segment_median(epoch, nepoch, np.where(use, mstar[np.maximum(star, 0)] - mag, np.nan))
+        model = mstar[np.maximum(star, 0)] - zp0[epoch]
+    clipped = clip(np.where(use, (model - y)/sigma, 0.), np.zeros(nrow, dtype=bool))
+
+    # Clipping is cumulative, so the iterations converge
+    for it in range(niter + 1):
+        w = np.where(use & ~clipped, 1./sigma, 0.)
+        A = sparse.diags(w) @ A0
+        b = y*w
+        if refmag is None:
+            gauge = sparse.csr_matrix((np.full(nepoch, 1.e3), (np.zeros(nepoch, dtype=int), np.arange(nepoch))),
+                                      shape=(1, nvar))
+            A = sparse.vstack([A, gauge])
+            b = np.append(b, 0.)
+        x = lsqr(A, b, atol=1e-10, btol=1e-10)[0]
+
+        # Normalized residuals of all measurements, clipped ones included
+        chi = np.where(use, (A0 @ x - y)/sigma, 0.)
+        if it == niter or not (use & ~clipped).any():
+            break
+        newclip = clip(chi, clipped) & ~clipped
+        if not newclip.any():
+            break
+        clipped |= newclip
+
+    used = use & ~clipped
+    zp = x[:nepoch]
+    nused = np.bincount(epoch[used], minlength=nepoch)
+    sumw = np.bincount(epoch[used], weights=1./sigma[used]**2, minlength=nepoch)
+    chi2 = np.bincount(epoch[used], weights=chi[used]**2, minlength=nepoch)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2red = np.where(nused > 1, chi2/np.maximum(nused - 1, 1), 1.)
+        zperr = np.sqrt(np.maximum(chi2red, 1.)/sumw)
+    if refmag is None and (nused > 0).any():
+        zp = zp - zp[nused > 0].mean()
+    zp = np.where(nused > 0, zp, np.nan)
+    zperr = np.where(nused > 0, zperr, np.nan)
+
+    return {'ZP'         : zp,
+            'ZP_ERR'     : zperr,
+            'NSTARS'     : nused,
+            'NCLIP'      : np.bincount(epoch[use & clipped], minlength=nepoch),
+            'COLOR_TERM' : float(x[nepoch]) if fitcolor else np.nan,
+            'USED'       : used}
+
+def match_epochs(mjd, epoch_mjd, tolerance=0.5):
+    """
+    Index of the nearest epoch of each time, -1 if none is within tolerance days
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    epoch_mjd = np.asarray(epoch_mjd, dtype=float)
+    good = np.flatnonzero(np.isfinite(epoch_mjd))
+    if len(good) == 0:
+        return np.full(len(mjd), -1)
+    order = good[np.argsort(epoch_mjd[good])]
+    t = epoch_mjd[order]
+    pos = np.clip(np.searchsorted(t, mjd), 1, max(len(t)-1, 1))
+    lo = np.maximum(pos - 1, 0)
+    hi = np.minimum(pos, len(t)-1)
+    nearest = np.where(np.abs(mjd - t[lo]) <= np.abs(mjd - t[hi]), lo, hi)
+    return np.where(np.abs(mjd - t[nearest]) <= tolerance, order[nearest], -1)
+
+def calibrate_light_curve(mjd, mag, magerr, zp, absolute=True):
+    """
+    Apply the zero points of the epochs to light curve points
+
+    Args:
+        mjd, mag, magerr : light curve points
+        zp               : table of the epoch MJD, ZP and ZP_ERR from Zero_Points
+    Optional:
+        absolute : zero points were solved against reference magnitudes; relative
+                   zero points are only offsets between epochs and aren't applied
+
+    Returns:
+        mag, magerr : calibrated magnitudes with the zero point error added in quadrature
+                      (NaN for points without a zero point), the input if not absolute
+        zp, zperr   : zero point and its error of each point (NaN without one)
+    """
+    mag = np.asarray(mag, dtype=float)
+    magerr = np.asarray(magerr, dtype=float)
+    idx = match_epochs(mjd, zp['MJD'])
+    zpoint = np.where(idx >= 0, np.asarray(zp['ZP'], dtype=float)[idx], np.nan)
+    zperr = np.where(idx >= 0, np.asarray(zp['ZP_ERR'], dtype=float)[idx], np.nan)
+    if absolute:
+        mag = mag + zpoint
+        magerr = np.hypot(magerr, zperr)
+
+    return mag, magerr, zpoint, zperr
@@ -1,6 +1,8 @@
 """
 Functions to make plots based on PA output
 """
+import matplotlib
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 from rotseproc.plotlib import plot_2d
 
@@ -14,6 +16,7 @@ def plot_light_curve(mjd, mag, magerr, dumpfile):
     ax  = plot_2d(ax, mjd, mag, "MJD", "ROTSE Magnitude", yerr=magerr)
     plt.gca().invert_yaxis()
     fig.savefig(dumpfile)
+    plt.close(fig)
 
     return
 
@@ -15,6 +15,7 @@ class PipelineAlg:
         self.__outType__=type(outtype)
         self.name=name
         self.config=config
+        self.workload=None
         self.m_log.debug("initializing Monitoring alg {}".format(name))
     def __call__(self,*args,**kwargs):
         return self.run(*args,**kwargs)
@@ -24,6 +25,12 @@ class PipelineAlg:
         return isinstance(Type,self.__inpType__)
     def get_output_type(self):
         return self.__outType__
+    def get_workload(self):
+        """
+        Dictionary of NFRAMES, NNIGHTS and NBYTES found by the last run, or None
+        if this PA doesn't determine the amount of data to process
+        """
+        return self.workload
 
     def get_default_config(self):
         """
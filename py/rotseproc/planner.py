@@ -0,0 +1,190 @@
+"""
+Workload planning and cost estimation before running the pipeline
+
+The planner resolves a target to its field, lists the matched image/prod
+pairs of every night without copying anything and estimates the run time of
+each pipeline step from the timings recorded in the metrics store.
+"""
+import os
+import numpy as np
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Workload quantities recorded with every step timing
+WORKLOAD_KEYS = ['NFRAMES', 'NNIGHTS', 'NBYTES']
+
+def data_workload(images, prods):
+    """
+    Number of frames, nights and bytes of a set of preprocessed files
+    """
+    nights = set(os.path.split(i)[1][:6] for i in images)
+    nbytes = sum(os.path.getsize(f) for f in list(images) + list(prods))
+
+    return {'NFRAMES': len(images), 'NNIGHTS': len(nights), 'NBYTES': nbytes}
+
+class CostModel:
+    """
+    Linear run time model of each step, ELAPSED = c0 + c1*NFRAMES + c2*NNIGHTS
+    """
+    def __init__(self, coeffs=None):
+        self.coeffs = coeffs if coeffs is not None else {}
+
+    @classmethod
+    def from_store(cls, store, steps, telescope=None, window=100):
+        """
+        Calibrate the model on the step timings of the last window runs in a MetricsStore
+        """
+        coeffs = {}
+        for step in steps:
+            runs = store.query_runs(step, ['ELAPSED', 'NFRAMES', 'NNIGHTS'], telescope=telescope, limit=window)
+            good = np.isfinite(runs['ELAPSED']) & np.isfinite(runs['NFRAMES']) & (runs['NFRAMES'] > 0)
+            runs = runs[good]
+            if len(runs) >= 3:
+                A = np.stack([np.ones(len(runs)), runs['NFRAMES'], np.nan_to_num(runs['NNIGHTS'])], -1)
+                c = np.linalg.lstsq(A, runs['ELAPSED'], rcond=None)[0]
+                coeffs[step] = [float(x) for x in np.maximum(c, 0.)]
+            elif len(runs) > 0:
+                coeffs[step] = [0., float(np.median(runs['ELAPSED'] / runs['NFRAMES'])), 0.]
+            log.debug("Cost model for {} from {} runs: {}".format(step, len(runs), coeffs.get(step)))
+
+        return cls(coeffs)
+
+    def estimate(self, step, workload):
+        """
+        Estimated run time of a step in seconds, None if the step was never timed
+        """
+        if step not in self.coeffs:
+            return None
+        c = self.coeffs[step]
+        return c[0] + c[1]*workload['NFRAMES'] + c[2]*workload['NNIGHTS']
+
+def find_target_data(night, telescope, field, ra, dec, t_before, t_after, datadir):
+    """
+    List matched image and prod files of a target night by night, without copying
+
+    Returns:
+        field, dictionary of night to (images, prods)
+    """
+    from rotseproc.io.supernova import find_supernova_field, supernova_date_range, find_night_data
+    from rotseproc.io.preproc import match_image_prod
+
+    if field is None:
+        field = find_supernova_field(ra, dec)
+        if field is None:
+            log.critical("No supernova fields contain data for these coordinates.")
+            return None, {}
+
+    allimages, allprods = [], []
+    for date in supernova_date_range(night, t_before, t_after):
+        images, prods = find_night_data(date, telescope, field, datadir)
+        allimages += images
+        allprods += prods
+
+    if len(allimages) == 0:
+        return field, {}
+
+    # Add TLA to field if not present
+    if len(field) == 9:
+        field = os.path.split(allimages[0])[1][7:19]
+
+    images, prods = match_image_prod(allimages, allprods, telescope, field)
+
+    nights = {}
+    for i in images:
+        nights.setdefault(os.path.split(i)[1][:6], ([], []))[0].append(i)
+    for p in prods:
+        date = os.path.split(p)[1][:6]
+        if date in nights:
+            nights[date][1].append(p)
+
+    return field, nights
+
+def plan_target(target, night, telescope, field, ra, dec, t_before, t_after, datadir, steps, model=None):
+    """
+    Plan the processing of one target
+
+    Returns:
+        dictionary with the target field, per night frame and byte counts,
+        the total workload and the estimated seconds per step
+    """
+    field, nights = find_target_data(night, telescope, field, ra, dec, t_before, t_after, datadir)
+
+    plan = {'TARGET': target, 'FIELD': field, 'TELESCOPE': telescope, 'NIGHTS': {}}
+    allimages, allprods = [], []
+    for date in sorted(nights):
+        images, prods = nights[date]
+        plan['NIGHTS'][date] = data_workload(images, prods)
+        allimages += images
+        allprods += prods
+    workload = data_workload(allimages, allprods)
+    plan.update(workload)
+
+    plan['STEPS'] = {}
+    total = 0.
+    for step in steps:
+        est = model.estimate(step, workload) if model is not None else None
+        plan['STEPS'][step] = est
+        if est is not None:
+            total += est
+    plan['ESTIMATED_SECONDS'] = total
+
+    log.info("Planned {}: {} frames in {} nights, {:.1f} MB, about {:.0f} s".format(
+        target, workload['NFRAMES'], workload['NNIGHTS'], workload['NBYTES']/1.e6, total))
+
+    return plan
+
+def plan_targets(targets, conf, datadir, metricsdb=None):
+    """
+    Plan a list of targets
+
+    Targets sharing a field (shared_field arg) only run the target steps, and
+    the field job (steps arg) only the field steps, so the frames of a shared
+    field are counted once in the totals, by its field job.
+
+    Args:
+        targets  : list of (name, args) with night, telescope, field, ra and dec args
+                   as queued by rotseproc.jobqueue (ra and dec in degrees or hh:mm:ss),
+                   and optionally steps and shared_field
+        conf     : pipeline configuration read from the yaml file
+        datadir  : directory containing data
+    Optional:
+        metricsdb : metrics store with recorded step timings to calibrate the cost model
+
+    Returns:
+        dictionary with one plan per target and the totals over all targets
+    """
+    from rotseproc.rotse_config import parse_coordinates
+    from rotseproc.fieldshare import FIELD_STEPS
+
+    steps = conf["Pipeline"]
+    find = conf["Algorithms"]["Find_Data"]
+
+    model = None
+    if metricsdb is not None and os.path.exists(metricsdb):
+        from rotseproc.io.metricsdb import MetricsStore
+        store = MetricsStore(metricsdb)
+        model = CostModel.from_store(store, steps)
+        store.close()
+    else:
+        log.warning("No recorded step timings, only the workload is estimated")
+
+    plans = []
+    for name, args in targets:
+        ra, dec = parse_coordinates(args['ra'], args['dec'])
+        runsteps = args['steps'] if 'steps' in args and args['steps'] is not None else steps
+        shared = args['shared_field'] if 'shared_field' in args else None
+        if shared is not None:
+            runsteps = [s for s in runsteps if s not in FIELD_STEPS]
+        plan = plan_target(name, args['night'], args['telescope'], args['field'], ra, dec,
+                           find["TimeBeforeDiscovery"], find["TimeAfterDiscovery"], datadir, runsteps, model)
+        plan['SHARED_FIELD'] = shared
+        plans.append(plan)
+
+    summary = {'NTARGETS': len(plans)}
+    for key in WORKLOAD_KEYS:
+        summary[key] = sum(p[key] for p in plans if p['SHARED_FIELD'] is None)
+    summary['ESTIMATED_SECONDS'] = sum(p['ESTIMATED_SECONDS'] for p in plans)
+
+    return {'TARGETS': plans, 'TOTAL': summary}
@@ -2,6 +2,8 @@
 Generic plotting algorithms for ROTSE-III QAs
 """
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 
 def rotse_qaplot(fig, plotconf, qadict, camera, expid, outfile):
@@ -63,7 +65,7 @@ def rotse_qaplot(fig, plotconf, qadict, camera, expid, outfile):
                 zlim=plot['ZRANGE']
 
             #- Generate subplots
-            ax=fig.add_subplot('{}{}{}'.format(nrow,ncol,p+1))
+            ax=fig.add_subplot(nrow,ncol,p+1)
             if plottype == 'PATCH':
                 vals=np.array(qadict['METRICS'][plot['VALS']])
                 grid=plot['GRID']
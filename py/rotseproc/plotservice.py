@@ -0,0 +1,156 @@
+"""
+Background rendering service for PA and QA plots
+
+Pipeline steps submit lightweight plot specs (a plotting function given by
+module and name, plus its arrays and options) instead of drawing with pyplot
+in the pipeline thread. Depending on the mode the plots are rendered
+
+    async    : in a separate worker process while the pipeline keeps running
+    deferred : in the worker process once the batch is finished
+    failures : like async, but QA plots only for WARNING or ALARM status,
+               plots of PA products (submitted without a status) are always rendered
+    inline   : immediately in the calling process
+    off      : never
+"""
+import importlib
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+MODES = ('async', 'deferred', 'failures', 'inline', 'off')
+
+def render(module, function, args, kwargs):
+    """
+    Render one plot spec and close all its figures
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    func = getattr(importlib.import_module(module), function)
+    try:
+        func(*args, **kwargs)
+    finally:
+        plt.close('all')
+
+    return args[0] if len(args) > 0 else None
+
+def _worker_init(logqueue, level, limits, statefile):
+    rlogger.worker_logging(logqueue, level)
+    from rotseproc.governor import setup_governor
+    setup_governor(limits['procs'], limits['memory'], limits['io'], statefile)
+
+def render_governed(module, function, args, kwargs):
+    """
+    Render a plot spec in the plot worker, holding a process of the node governor while drawing
+    """
+    from rotseproc.governor import get_governor
+    with get_governor().reserve(procs=1, label='plot {}'.format(function)):
+        return render(module, function, args, kwargs)
+
+class PlotService:
+    """
+    Queue plot specs and render them according to the plotting mode
+    """
+    def __init__(self, mode='inline'):
+        if mode not in MODES:
+            raise ValueError("Plot mode {} is not one of {}".format(mode, MODES))
+        self.mode = mode
+        self._executor = None
+        self._pending = []
+        self._deferred = []
+
+    def _get_executor(self):
+        if self._executor is None:
+            import logging
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            from rotseproc.governor import get_governor
+            # Spawn a fresh interpreter so the worker doesn't inherit pipeline state or threads,
+            # its log records are sent back to this process and it shares the node limits
+            governor = get_governor()
+            self._executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_worker_init,
+                                                 initargs=(rlogger.process_queue(), logging.getLogger().level,
+                                                           governor.limits, governor.statefile))
+        return self._executor
+
+    def submit(self, module, function, *args, status=None, **kwargs):
+        """
+        Submit a plot spec
+
+        Args:
+            module   : module containing the plotting function (e.g. rotseproc.qa.qaplots)
+            function : name of the plotting function, called as function(*args, **kwargs)
+        Optional:
+            status   : QA status of the plotted metrics, used by the failures mode,
+                       None for plots of PA products
+        """
+        spec = (module, function, args, kwargs)
+        if self.mode == 'off':
+            return
+        elif self.mode == 'failures' and status is not None and status not in ('WARNING', 'ALARM'):
+            return
+        elif self.mode == 'inline':
+            try:
+                render(*spec)
+            except Exception as e:
+                log.warning("Failed to render plot {}.{}. Got Exception {}".format(module, function, e))
+        elif self.mode == 'deferred':
+            self._deferred.append(spec)
+        else:
+            self._pending.append((spec, self._get_executor().submit(render_governed, *spec)))
+
+    def flush(self):
+        """
+        Render deferred plot specs and wait for all submitted plots to finish
+        """
+        for spec in self._deferred:
+            self._pending.append((spec, self._get_executor().submit(render_governed, *spec)))
+        self._deferred = []
+
+        for spec, future in self._pending:
+            try:
+                outfile = future.result()
+                log.debug("Rendered plot {}".format(outfile))
+            except Exception as e:
+                log.warning("Failed to render plot {}.{}. Got Exception {}".format(spec[0], spec[1], e))
+        self._pending = []
+
+    def shutdown(self):
+        """
+        Flush all plots and stop the worker process
+        """
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+#- Plot service shared by all PAs and QAs of this process
+_service = None
+
+def setup_plot_service(mode):
+    """
+    Replace the shared plot service by one with the given mode
+    """
+    global _service
+    if _service is not None:
+        _service.shutdown()
+    _service = PlotService(mode)
+    return _service
+
+def get_plot_service():
+    """
+    Return the shared plot service, rendering inline if none was set up
+    """
+    global _service
+    if _service is None:
+        _service = PlotService('inline')
+    return _service
+
+def submit_plot(module, function, *args, **kwargs):
+    """
+    Submit a plot spec to the shared plot service
+    """
+    get_plot_service().submit(module, function, *args, **kwargs)
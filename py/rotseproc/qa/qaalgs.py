@@ -3,15 +3,12 @@ Monitoring algorithms for the ROTSE-III pipeline
 """
 
 import os, sys
+import abc
 import numpy as np
-import datetime
 from astropy.io import fits
 from rotseproc.io.qa import write_qa_file
-from rotseproc.qa import qaplots
 from rotseproc.qa.qas import check_QA_status, MonitoringAlg, QASeverity
 from rotseproc import exceptions, rlogger
-from astropy.time import Time
-from rotseproc.qa import qalib
 
 rlog = rlogger.rotseLogger("ROTSE-III",0)
 log = rlog.getlog()
@@ -43,6 +40,12 @@ def get_inputs(*args,**kwargs):
     if "refmetrics" in kwargs: inputs["refmetrics"] = kwargs["refmetrics"]
     else: inputs["refmetrics"] = None
 
+    if "plotconf" in kwargs: inputs["plotconf"] = kwargs["plotconf"]
+    else: inputs["plotconf"] = None
+
+    if "catalogs" in kwargs: inputs["catalogs"] = kwargs["catalogs"]
+    else: inputs["catalogs"] = None
+
     return inputs
 
 class Count_Pixels(MonitoringAlg):
@@ -51,17 +54,17 @@ class Count_Pixels(MonitoringAlg):
             name="Count_Pixels"
         kwargs = config['kwargs']
         parms = kwargs['param']
-        key = kwargs['refKey'] if 'refKey' in kwargs else "NOISE"
-        status = kwargs['statKey'] if 'statKey' in kwargs else "NOISE_STATUS"
+        key = kwargs['refKey'] if 'refKey' in kwargs else "COUNT"
+        status = kwargs['statKey'] if 'statKey' in kwargs else "COUNT_STATUS"
         kwargs["RESULTKEY"] = key
         kwargs["QASTATUSKEY"] = status
         if "ReferenceMetrics" in kwargs:
             r = kwargs["ReferenceMetrics"]
             if key in r:
                 kwargs["REFERENCE"] = r[key]
-        if "NOISE_WARN_RANGE" in parms and "NOISE_NORMAL_RANGE" in parms:
-            kwargs["RANGES"] = [(np.asarray(parms["NOISE_WARN_RANGE"]),QASeverity.WARNING),
-                               (np.asarray(parms["NOISE_NORMAL_RANGE"]),QASeverity.NORMAL)]
+        if "COUNT_WARN_RANGE" in parms and "COUNT_NORMAL_RANGE" in parms:
+            kwargs["RANGES"] = [(np.asarray(parms["COUNT_WARN_RANGE"]),QASeverity.WARNING),
+                               (np.asarray(parms["COUNT_NORMAL_RANGE"]),QASeverity.NORMAL)]
         im = fits.hdu.hdulist.HDUList
         MonitoringAlg.__init__(self, name, im, config, logger)
     def run(self, *args, **kwargs):
@@ -109,15 +112,329 @@ class Count_Pixels(MonitoringAlg):
         retval["PANAME"]  = paname
         retval["PARAMS"]  = param
         retval["STATUS"]  = status
-        retval["METRICS"] = {"COUNT" : str(count),
-                             "COUNT_PER_IMAGE" : str(im_count)}
+        retval["METRICS"] = {"COUNT" : float(count),
+                             "COUNT_PER_IMAGE" : np.asarray(im_count)}
 
         # Write QA output files
+        from rotseproc.plotservice import submit_plot
         write_qa_file(qafile, retval)
-        qaplots.plot_Count_Pixels(qafig, im_count)
+        submit_plot('rotseproc.qa.qaplots', 'plot_Count_Pixels', qafig, np.asarray(im_count), status=status)
 
         return retval
 
     def get_default_config(self):
         return {}
 
+class Frame_Rejection(MonitoringAlg):
+    def __init__(self, name, config, logger=None):
+        if name is None or name.strip() == "":
+            name="Frame_Rejection"
+        kwargs = config['kwargs']
+        parms = kwargs['param']
+        key = kwargs['refKey'] if 'refKey' in kwargs else "REJECT_FRACTION"
+        status = kwargs['statKey'] if 'statKey' in kwargs else "REJECT_FRACTION_STATUS"
+        kwargs["RESULTKEY"] = key
+        kwargs["QASTATUSKEY"] = status
+        if "ReferenceMetrics" in kwargs:
+            r = kwargs["ReferenceMetrics"]
+            if key in r:
+                kwargs["REFERENCE"] = r[key]
+        if "REJECT_FRACTION_WARN_RANGE" in parms and "REJECT_FRACTION_NORMAL_RANGE" in parms:
+            kwargs["RANGES"] = [(np.asarray(parms["REJECT_FRACTION_WARN_RANGE"]),QASeverity.WARNING),
+                               (np.asarray(parms["REJECT_FRACTION_NORMAL_RANGE"]),QASeverity.NORMAL)]
+        im = fits.hdu.hdulist.HDUList
+        MonitoringAlg.__init__(self, name, im, config, logger)
+    def run(self, *args, **kwargs):
+        if len(args) == 0 :
+            log.critical("No parameter is found for this QA")
+            sys.exit("Update the configuration file for the parameters")
+
+        if not self.is_compatible(type(args[0])):
+            log.critical("Incompatible input!")
+            sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
+
+        quality = args[0]
+        inputs = get_inputs(*args,**kwargs)
+
+        return self.run_qa(quality, inputs)
+
+    def run_qa(self, quality, inputs):
+        # Get relevant inputs
+        param = inputs['param']
+        if param is None:
+                log.critical("No parameter is found for this QA")
+                sys.exit("Update the configuration file for the parameters")
+        paname     = inputs['paname']
+        program    = inputs['program']
+        qafile     = inputs['qafile']
+        qafig      = inputs['qafig']
+
+        # Fraction of frames rejected by Frame_Quality
+        reject = np.asarray(quality['REJECTED'], dtype=bool)
+        nframes = len(reject)
+        fraction = reject.sum() / nframes if nframes > 0 else np.nan
+
+        # Compare fraction to reference value and get QA status
+        reference = param['REJECT_FRACTION_REF']
+        norm_range = param['REJECT_FRACTION_NORMAL_RANGE']
+        warn_range = param['REJECT_FRACTION_WARN_RANGE']
+        status = check_QA_status(fraction, reference, norm_range, warn_range)
+
+        # Set up output dictionary
+        retval = {}
+        retval["PROGRAM"] = program
+        retval["PANAME"]  = paname
+        retval["PARAMS"]  = param
+        retval["STATUS"]  = status
+        retval["METRICS"] = {"REJECT_FRACTION" : float(fraction),
+                             "NFRAMES"         : nframes,
+                             "NREJECTED"       : int(reject.sum()),
+                             "REJECTED_FRAMES" : [str(f) for f in np.asarray(quality['FRAME'])[reject]],
+                             "REJECT_REASONS"  : [str(r) for r in np.asarray(quality['REASON'])[reject]]}
+        for key in ['NSOURCES', 'FWHM', 'BACKGROUND', 'LIMITING_MAG']:
+            retval["METRICS"][key] = np.asarray(quality[key])
+
+        # Write QA output files
+        from rotseproc.plotservice import submit_plot
+        write_qa_file(qafile, retval)
+        metrics = {key: np.asarray(quality[key]) for key in ['NSOURCES', 'FWHM', 'BACKGROUND', 'LIMITING_MAG']}
+        submit_plot('rotseproc.qa.qaplots', 'plot_Frame_Rejection', qafig, metrics, reject, status=status)
+
+        return retval
+
+    def get_default_config(self):
+        return {}
+
+class Fused_QA(MonitoringAlg, metaclass=abc.ABCMeta):
+    """
+    Abstract base class of the QAs reading their metrics from a result shared
+    by all QAs of a step, so the inputs are read once for all of them
+
+    Subclasses set the default name and metric key, and implement stats
+    (the shared result) and metrics. Fused_QA, Image_QA and Catalog_QA can't
+    be configured as QAs themselves.
+    """
+    defname = None
+    defkey = None
+    def __init__(self, name, config, logger=None):
+        if name is None or name.strip() == "":
+            name=self.defname
+        kwargs = config['kwargs']
+        parms = kwargs['param']
+        key = kwargs['refKey'] if 'refKey' in kwargs else self.defkey
+        status = kwargs['statKey'] if 'statKey' in kwargs else self.defkey + "_STATUS"
+        kwargs["RESULTKEY"] = key
+        kwargs["QASTATUSKEY"] = status
+        if "ReferenceMetrics" in kwargs:
+            r = kwargs["ReferenceMetrics"]
+            if key in r:
+                kwargs["REFERENCE"] = r[key]
+        if key + "_WARN_RANGE" in parms and key + "_NORMAL_RANGE" in parms:
+            kwargs["RANGES"] = [(np.asarray(parms[key + "_WARN_RANGE"]),QASeverity.WARNING),
+                               (np.asarray(parms[key + "_NORMAL_RANGE"]),QASeverity.NORMAL)]
+        im = fits.hdu.hdulist.HDUList
+        MonitoringAlg.__init__(self, name, im, config, logger)
+    def run(self, *args, **kwargs):
+        if len(args) == 0 :
+            log.critical("No parameter is found for this QA")
+            sys.exit("Update the configuration file for the parameters")
+
+        if not self.is_compatible(type(args[0])):
+            log.critical("Incompatible input!")
+            sys.exit("Was expecting {} got {}".format(type(self.__inpType__),type(args[0])))
+
+        inp = args[0]
+        inputs = get_inputs(*args,**kwargs)
+
+        return self.run_qa(inp, inputs)
+
+    def run_qa(self, inp, inputs):
+        # Get relevant inputs
+        param = inputs['param']
+        if param is None:
+                log.critical("No parameter is found for this QA")
+                sys.exit("Update the configuration file for the parameters")
+        paname     = inputs['paname']
+        program    = inputs['program']
+        qafile     = inputs['qafile']
+        qafig      = inputs['qafig']
+
+        # Metrics shared with the other QAs of this step
+        stats = self.stats(inp, param, inputs)
+        value, metrics = self.metrics(stats)
+
+        # Compare metric to reference value and get QA status
+        key = self.defkey
+        status = check_QA_status(value, param[key + '_REF'], param[key + '_NORMAL_RANGE'], param[key + '_WARN_RANGE'])
+
+        # Set up output dictionary
+        retval = {}
+        retval["PROGRAM"] = program
+        retval["PANAME"]  = paname
+        retval["PARAMS"]  = param
+        retval["STATUS"]  = status
+        retval["METRICS"] = {key : float(value)}
+        retval["METRICS"].update(metrics)
+
+        # Write QA output files
+        write_qa_file(qafile, retval)
+        self.plot(qafig, stats, status, param, inputs)
+
+        return retval
+
+    @abc.abstractmethod
+    def stats(self, inp, param, inputs):
+        """
+        Return the shared result the metrics are read from
+        """
+
+    @abc.abstractmethod
+    def metrics(self, stats):
+        """
+        Return the metric compared to the reference and a dictionary of other metrics
+        """
+
+    def plot(self, qafig, stats, status, param, inputs):
+        from rotseproc.plotservice import submit_plot
+        metrics = self.metrics(stats)[1]
+        submit_plot('rotseproc.qa.qaplots', 'plot_Metrics', qafig, self.name, metrics, status=status)
+
+    def get_default_config(self):
+        return {}
+
+class Image_QA(Fused_QA):
+    """
+    Base class of the QAs of the fused image QA (qalib.image_qa) of the images
+    returned by a PA, which reads each image once for all of them
+    """
+    def stats(self, images, param, inputs):
+        from rotseproc.qa.qalib import image_qa, NOISE_GRID
+        grid = param['NOISE_GRID'] if 'NOISE_GRID' in param else NOISE_GRID
+        return image_qa(images, grid)
+
+class Image_Noise(Image_QA):
+    """
+    Median robust RMS of the images and the noise across a grid of patches
+    """
+    defname = "Image_Noise"
+    defkey = "RMS"
+    def metrics(self, stats):
+        # Median noise of each patch over all images, for the PATCH plots of the plot configuration
+        noise = np.median(stats['NOISE'], axis=0) if len(stats['NOISE']) > 0 else np.zeros(0)
+        return np.median(stats['RMS']), {"RMS_PER_IMAGE"   : stats['RMS'],
+                                         "BACKGROUND"      : stats['BACKGROUND'],
+                                         "NOISE"           : noise,
+                                         "NOISE_PER_IMAGE" : stats['NOISE']}
+
+    def plot(self, qafig, stats, status, param, inputs):
+        from rotseproc.plotservice import submit_plot
+        from rotseproc.qa.qalib import NOISE_GRID
+        grid = param['NOISE_GRID'] if 'NOISE_GRID' in param else NOISE_GRID
+        noise = self.metrics(stats)[1]['NOISE']
+        submit_plot('rotseproc.qa.qaplots', 'plot_Image_Noise', qafig, noise, grid, inputs['plotconf'],
+                    inputs['paname'], len(stats['RMS']), status=status)
+
+class Saturation(Image_QA):
+    """
+    Largest fraction of saturated pixels (above SATCNTS) of the images
+    """
+    defname = "Saturation"
+    defkey = "SAT_FRACTION"
+    def metrics(self, stats):
+        return np.nanmax(stats['SAT_FRACTION']) if np.isfinite(stats['SAT_FRACTION']).any() else np.nan, \
+               {"SAT_FRACTION_PER_IMAGE" : stats['SAT_FRACTION']}
+
+class Bad_Pixels(Image_QA):
+    """
+    Largest fraction of NaN or zero pixels of the images
+    """
+    defname = "Bad_Pixels"
+    defkey = "BAD_FRACTION"
+    def metrics(self, stats):
+        bad = stats['NAN_FRACTION'] + stats['ZERO_FRACTION']
+        return np.max(bad) if len(bad) > 0 else np.nan, {"NAN_FRACTION"  : stats['NAN_FRACTION'],
+                                                        "ZERO_FRACTION" : stats['ZERO_FRACTION']}
+
+class Background_Gradient(Image_QA):
+    """
+    Largest background change across the images along rows or columns
+    """
+    defname = "Background_Gradient"
+    defkey = "GRADIENT"
+    def metrics(self, stats):
+        gradient = np.fmax(np.abs(stats['ROW_GRADIENT']), np.abs(stats['COL_GRADIENT']))
+        return np.nanmax(gradient) if np.isfinite(gradient).any() else np.nan, \
+               {"ROW_GRADIENT" : stats['ROW_GRADIENT'],
+                "COL_GRADIENT" : stats['COL_GRADIENT']}
+
+class Catalog_QA(Fused_QA):
+    """
+    Base class of the QAs of the fused catalog QA (qalib.catalog_qa), which
+    reads only the needed columns of the step's source catalogs once for all
+    of them. The catalogs are found with the catalogs pattern of the step.
+    """
+    def stats(self, inp, param, inputs):
+        import glob
+        from rotseproc.qa.qalib import catalog_qa
+        if inputs['catalogs'] is None:
+            log.critical("No source catalogs are defined for {}".format(inputs['paname']))
+            sys.exit("Catalog QAs can only run on steps that write source catalogs")
+        radius = param['MATCH_RADIUS'] if 'MATCH_RADIUS' in param else 5.
+        return catalog_qa(sorted(glob.glob(inputs['catalogs'])), radius)
+
+class Source_Count(Catalog_QA):
+    """
+    Median number of detected sources per epoch
+    """
+    defname = "Source_Count"
+    defkey = "NSOURCES"
+    def metrics(self, stats):
+        return np.median(stats['NSOURCES']) if len(stats['NSOURCES']) > 0 else np.nan, \
+               {"NSOURCES_PER_EPOCH" : stats['NSOURCES'],
+                "EPOCHS"             : stats['EPOCHS']}
+
+class Seeing(Catalog_QA):
+    """
+    Median FWHM (pixels) of the bright clean sources over all epochs
+    """
+    defname = "Seeing"
+    defkey = "FWHM"
+    def metrics(self, stats):
+        return np.nanmedian(stats['FWHM']) if np.isfinite(stats['FWHM']).any() else np.nan, \
+               {"FWHM_PER_EPOCH" : stats['FWHM'],
+                "EPOCHS"         : stats['EPOCHS']}
+
+class Ellipticity(Catalog_QA):
+    """
+    Median ellipticity of the bright clean sources over all epochs
+    """
+    defname = "Ellipticity"
+    defkey = "ELLIPTICITY"
+    def metrics(self, stats):
+        return np.nanmedian(stats['ELLIPTICITY']) if np.isfinite(stats['ELLIPTICITY']).any() else np.nan, \
+               {"ELLIPTICITY_PER_EPOCH" : stats['ELLIPTICITY'],
+                "EPOCHS"                : stats['EPOCHS']}
+
+class Limiting_Magnitude(Catalog_QA):
+    """
+    Median limiting magnitude of the epochs
+    """
+    defname = "Limiting_Magnitude"
+    defkey = "LIMITING_MAG"
+    def metrics(self, stats):
+        return np.nanmedian(stats['LIMITING_MAG']) if np.isfinite(stats['LIMITING_MAG']).any() else np.nan, \
+               {"LIMITING_MAG_PER_EPOCH" : stats['LIMITING_MAG'],
+                "EPOCHS"                 : stats['EPOCHS']}
+
+class Astrometry(Catalog_QA):
+    """
+    Largest median astrometric residual (arcsec) of an epoch against the deepest epoch
+    """
+    defname = "Astrometry"
+    defkey = "ASTROM_RESID"
+    def metrics(self, stats):
+        return np.nanmax(stats['ASTROM_RESID']) if np.isfinite(stats['ASTROM_RESID']).any() else np.nan, \
+               {"ASTROM_RESID_PER_EPOCH" : stats['ASTROM_RESID'],
+                "ASTROM_DRA"             : stats['ASTROM_DRA'],
+                "ASTROM_DDEC"            : stats['ASTROM_DDEC'],
+                "EPOCHS"                 : stats['EPOCHS']}
@@ -1,19 +1,216 @@
 """
 simple low level library functions for QAs
 """
+import os
+import warnings
 import numpy as np
-from astropy.io import fits
 
-def count_avg_pixels(images):
+#- Default patch grid (rows, columns) of the noise map, see config/plot_config.yaml
+NOISE_GRID = (2, 2)
+
+#- Results of the last image_qa and catalog_qa calls, shared by all QAs of a step
+_image_qa_cache = {}
+_catalog_qa_cache = {}
+
+def _robust_sigma(values, center=None):
+    if values.size == 0:
+        return np.nan
+    if center is None:
+        center = np.median(values)
+    return 1.4826 * np.median(np.abs(values - center))
+
+def _gradient(profile):
     """
-    Count pixels for each coadded image
+    Change of a row or column profile across the image from a linear fit
+    """
+    x = np.arange(len(profile))
+    good = np.isfinite(profile)
+    if good.sum() < 2:
+        return np.nan
+    slope = np.polyfit(x[good], profile[good], 1)[0]
+    return slope * (len(profile) - 1)
+
+def _file_key(filenames):
+    return tuple((os.path.abspath(f), os.path.getsize(f), os.path.getmtime(f)) for f in filenames)
+
+def image_stats(filename, grid=NOISE_GRID):
+    """
+    All image QA metrics of one image from a single read of its pixels
+
+    The memory mapped pixels are read once, into a float32 working copy, and
+    every metric is computed from that copy in place: bad pixels are set to
+    NaN for the background profiles and noise patches, then one partition of
+    the copy gives the medians of all and of the good pixels, and the robust
+    RMS reuses the partitioned good pixels. No further copy of the image is
+    made, except transient ones of single rows, columns and noise patches.
+
+    Args:
+        filename : FITS image, SATCNTS in its header sets the saturation level
+    Optional:
+        grid     : (rows, columns) of the patch grid of the noise map
+
+    Returns:
+        dictionary of MEDIAN (of all pixels), BACKGROUND and RMS (robust, of the
+        finite non-zero pixels), SAT_FRACTION, NAN_FRACTION, ZERO_FRACTION,
+        ROW_GRADIENT and COL_GRADIENT (background change from the first to the
+        last row or column) and NOISE (robust RMS of each patch, row major)
+    """
+    from astropy.io import fits
+    from rotseproc.io.fitsimage import image_hdu
+
+    with fits.open(filename, memmap=True) as hdul:
+        hdu = image_hdu(hdul)
+        satlevel = hdu.header.get('SATCNTS')
+        data = np.array(hdu.data, dtype=np.float32)
+
+    stats = {}
+    npix = data.size
+    good = np.isfinite(data)
+    nfinite = int(np.count_nonzero(good))
+    good &= data != 0
+    ngood = int(np.count_nonzero(good))
+    nzero = nfinite - ngood
+    nneg = int(np.count_nonzero(data < 0))
+    stats['NAN_FRACTION'] = 1. - nfinite / npix
+    stats['ZERO_FRACTION'] = nzero / npix
+    if satlevel is not None:
+        stats['SAT_FRACTION'] = np.count_nonzero(good & (data >= float(satlevel))) / npix
+    else:
+        stats['SAT_FRACTION'] = np.nan
+
+    # Bad pixels become NaN, background profiles along rows and columns and the noise patches ignore them
+    np.copyto(data, np.nan, where=~good)
+    del good
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        stats['ROW_GRADIENT'] = float(_gradient(np.nanmedian(data, axis=1)))
+        stats['COL_GRADIENT'] = float(_gradient(np.nanmedian(data, axis=0)))
+
+    noise = []
+    for band in np.array_split(data, grid[0], axis=0):
+        for patch in np.array_split(band, grid[1], axis=1):
+            noise.append(_robust_sigma(patch[np.isfinite(patch)]))
+    stats['NOISE'] = np.array(noise)
+
+    # Order statistics from one partition of the copy, the NaN (bad) pixels go last
+    # and the good pixels fill its first ngood elements
+    flat = data.reshape(-1)
+    mid = [(ngood - 1) // 2, ngood // 2]
+    # All pixels are the good ones plus nzero zeros, which sort after the nneg negative ones
+    allmid = [r if r < nneg else r - nzero for r in [(npix - 1) // 2, npix // 2] if not nneg <= r < nneg + nzero]
+    if ngood > 0:
+        flat.partition(sorted(set(mid + allmid + [ngood - 1])))
+
+    def order_stat(r):
+        return 0. if nneg <= r < nneg + nzero else float(flat[r if r < nneg else r - nzero])
+
+    if npix > 0 and nfinite == npix:
+        stats['MEDIAN'] = 0.5 * (order_stat((npix - 1) // 2) + order_stat(npix // 2))
+    else:
+        stats['MEDIAN'] = np.nan
+    if ngood > 0:
+        stats['BACKGROUND'] = 0.5 * (float(flat[mid[0]]) + float(flat[mid[1]]))
+        values = flat[:ngood]
+        np.subtract(values, np.float32(stats['BACKGROUND']), out=values)
+        np.abs(values, out=values)
+        values.partition(sorted(set(mid)))
+        stats['RMS'] = 1.4826 * 0.5 * (float(values[mid[0]]) + float(values[mid[1]]))
+    else:
+        stats['BACKGROUND'] = np.nan
+        stats['RMS'] = np.nan
+
+    return stats
+
+def image_qa(images, grid=NOISE_GRID):
     """
-    # Calculate average pixel value per image
-    im_count = []
-    for i in range(len(images)):
-        pixdata = fits.open(images[i])[0].data
-        pixmed = np.median(pixdata)
-        im_count.append(pixmed)
+    Fused image QA metrics of a list of images
 
-    return im_count
+    Each image is read once for all metrics. The result of the last call is
+    kept, so every QA of a step asking for the same (unchanged) images and grid
+    shares it instead of reading the images again.
 
+    Returns:
+        dictionary of per-image arrays, see image_stats, NOISE has shape (nimages, ngrid)
+    """
+    grid = tuple(int(g) for g in grid)
+    key = (_file_key(images), grid)
+    if key in _image_qa_cache:
+        return _image_qa_cache[key]
+
+    stats = [image_stats(f, grid) for f in images]
+    result = {}
+    for k in ['MEDIAN', 'BACKGROUND', 'RMS', 'SAT_FRACTION', 'NAN_FRACTION', 'ZERO_FRACTION',
+              'ROW_GRADIENT', 'COL_GRADIENT']:
+        result[k] = np.array([s[k] for s in stats], dtype=float)
+    result['NOISE'] = np.array([s['NOISE'] for s in stats], dtype=float).reshape(len(stats), grid[0]*grid[1])
+
+    _image_qa_cache.clear()
+    _image_qa_cache[key] = result
+
+    return result
+
+def catalog_qa(catalogs, radius=5.):
+    """
+    Fused catalog QA metrics of the source catalogs of all epochs
+
+    Only the needed columns are read, through memory mapped tables, and every
+    metric is computed for all epochs at once. Like image_qa the result of the
+    last call is shared by the QAs asking for the same catalogs.
+
+    Args:
+        catalogs : sobj/cobj files, one per epoch
+    Optional:
+        radius   : match radius (arcsec) of the astrometric residuals
+
+    Returns:
+        dictionary of per-epoch arrays: EPOCHS (file names), NSOURCES, FWHM,
+        BACKGROUND, LIMITING_MAG (see pa.palib.frame_quality), ELLIPTICITY
+        (median of the bright clean sources), ASTROM_RESID (median distance in
+        arcsec of the bright sources to their match in the epoch with most
+        sources), ASTROM_DRA and ASTROM_DDEC (median offsets in arcsec)
+    """
+    from rotseproc.io.catalog import stack_catalogs
+    from rotseproc.pa.palib import frame_quality, match_sources, _segment_median
+
+    key = (_file_key(catalogs), float(radius))
+    if key in _catalog_qa_cache:
+        return _catalog_qa_cache[key]
+
+    nepoch = len(catalogs)
+    seg, data = stack_catalogs(catalogs, ['RA', 'DEC', 'MAG', 'MAGERR', 'FWHM', 'BACKGROUND', 'ELLIPTICITY', 'FLAGS'])
+    result = frame_quality(seg, nepoch, data)
+    result['EPOCHS'] = [os.path.basename(c) for c in catalogs]
+
+    flags = np.nan_to_num(data['FLAGS'], nan=0.)
+    bright = (flags == 0) & (data['MAGERR'] < 0.1) & (data['MAG'] < 90.)
+    result['ELLIPTICITY'] = _segment_median(seg, nepoch, np.where(bright, data['ELLIPTICITY'], np.nan))
+
+    # Astrometric residuals of the bright sources against the epoch with most of them
+    result['ASTROM_RESID'] = np.full(nepoch, np.nan)
+    result['ASTROM_DRA'] = np.full(nepoch, np.nan)
+    result['ASTROM_DDEC'] = np.full(nepoch, np.nan)
+    nbright = np.bincount(seg[bright], minlength=nepoch)
+    if nepoch > 1 and nbright.max() > 0:
+        ref = np.argmax(nbright)
+        isref = bright & (seg == ref)
+        refra, refdec = data['RA'][isref], data['DEC'][isref]
+        src = np.flatnonzero(bright & (seg != ref))
+        star = match_sources(data['RA'][src], data['DEC'][src], refra, refdec, radius)
+        src, star = src[star >= 0], star[star >= 0]
+        dra = ((data['RA'][src] - refra[star] + 180.) % 360. - 180.) * np.cos(np.radians(refdec[star])) * 3600.
+        ddec = (data['DEC'][src] - refdec[star]) * 3600.
+        result['ASTROM_RESID'] = _segment_median(seg[src], nepoch, np.hypot(dra, ddec))
+        result['ASTROM_DRA'] = _segment_median(seg[src], nepoch, dra)
+        result['ASTROM_DDEC'] = _segment_median(seg[src], nepoch, ddec)
+
+    _catalog_qa_cache.clear()
+    _catalog_qa_cache[key] = result
+
+    return result
+
+def count_avg_pixels(images):
+    """
+    Count pixels for each coadded image
+    """
+    # Median pixel value per image
+    return list(image_qa(images)['MEDIAN'])
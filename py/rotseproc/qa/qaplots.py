@@ -2,6 +2,8 @@
 Functions to make plots based on QA output
 """
 import numpy as np
+import matplotlib
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 
 def plot_Count_Pixels(outfile, im_count):
@@ -9,8 +11,8 @@ def plot_Count_Pixels(outfile, im_count):
     Plot metrics
 
     Args:
-        qa_dict: dictionary of QA outputs from running qaalgs.Count_Pixels
         outfile: name of output figure figure
+        im_count: average pixel count per coadded image from qaalgs.Count_Pixels
     """
     fig = plt.figure()
 
@@ -22,6 +24,85 @@ def plot_Count_Pixels(outfile, im_count):
     plt.ylabel("Average Pixel Count")
     plt.plot(xdata, ydata, '.')
     fig.savefig(outfile)
+    plt.close(fig)
 
     return
 
+def plot_Frame_Rejection(outfile, metrics, reject):
+    """
+    Plot per-frame quality metrics with the rejected frames highlighted
+
+    Args:
+        outfile: name of output figure
+        metrics: dictionary of per-frame metric arrays from pa.palib.frame_quality
+        reject: boolean array of frames rejected by Frame_Quality
+    """
+    fig, axes = plt.subplots(len(metrics), 1, sharex=True, figsize=(6, 2*len(metrics)))
+    axes = np.atleast_1d(axes)
+
+    reject = np.asarray(reject, dtype=bool)
+    xdata = np.arange(len(reject))
+    plt.suptitle("Frame quality ({} of {} frames rejected)".format(reject.sum(), len(reject)))
+    for ax, (key, values) in zip(axes, metrics.items()):
+        ax.plot(xdata[~reject], np.asarray(values)[~reject], '.', color='k')
+        ax.plot(xdata[reject], np.asarray(values)[reject], 'x', color='r')
+        ax.set_ylabel(key)
+    axes[-1].set_xlabel("Frame #")
+    fig.savefig(outfile)
+    plt.close(fig)
+
+    return
+
+def plot_Image_Noise(outfile, noise, grid, plotconf=None, paname=None, nimages=None):
+    """
+    Patch plot of the noise across the images
+
+    Args:
+        outfile: name of output figure
+        noise: median noise of each patch from qaalgs.Image_Noise, row major
+        grid: (rows, columns) of the patches
+    Optional:
+        plotconf: plotting configuration, its PATCH plots of NOISE are used when present
+        paname, nimages: PA and number of images for the figure title
+    """
+    from rotseproc.plotlib import rotse_qaplot, patchplot
+
+    fig = plt.figure()
+    noise = np.asarray(noise)
+    hardplots = True
+    if plotconf is not None:
+        hardplots = rotse_qaplot(fig, plotconf, {'METRICS': {'NOISE': noise}}, paname, nimages, outfile)
+    if hardplots:
+        ax = fig.add_subplot(1, 1, 1)
+        patch = patchplot(ax, noise, "Noise across sections of {} images".format(nimages), grid)
+        fig.colorbar(patch)
+        fig.savefig(outfile)
+    plt.close(fig)
+
+    return
+
+def plot_Metrics(outfile, title, metrics):
+    """
+    Plot per-image or per-epoch metrics of the fused image and catalog QAs
+
+    Args:
+        outfile: name of output figure
+        title: figure title, the QA name
+        metrics: dictionary of per-image or per-epoch metric arrays, with the
+                 EPOCHS names for catalog QAs
+    """
+    xlabel = "Epoch #" if 'EPOCHS' in metrics else "Image #"
+    metrics = {key: values for key, values in metrics.items() if key != 'EPOCHS'}
+    fig, axes = plt.subplots(len(metrics), 1, sharex=True, figsize=(6, 2*len(metrics)))
+    axes = np.atleast_1d(axes)
+
+    plt.suptitle(title)
+    for ax, (key, values) in zip(axes, metrics.items()):
+        values = np.asarray(values)
+        ax.plot(np.arange(len(values)), values, '.', color='k')
+        ax.set_ylabel(key)
+    axes[-1].set_xlabel(xlabel)
+    fig.savefig(outfile)
+    plt.close(fig)
+
+    return
@@ -0,0 +1,365 @@
+"""
+WCS reprojection with cached pixel maps
+
+Frames of a field from one telescope land on nearly the same pixel grid every
+night, offset by the pointing jitter of each exposure. The output-pixel to sky
+to input-pixel transform is therefore computed once per field grid, as a field
+map holding the input pixel coordinates of every output pixel, and reused for
+all frames of the field. The transform of a frame differs from its field map by
+a smooth residual (mostly the jitter shift), which is measured on a 5x5 grid of
+output pixels and fit with a quadratic polynomial. The frame's coordinates are
+the field map's plus the polynomial, and reprojecting the frame is a gather of
+four neighbouring pixels per output pixel.
+
+A field grid is identified by a signature: the offsets of the 5x5 grid from the
+output geometry, relative to its central pixel, quantized to a couple of pixels,
+so frames jittered by up to tens of pixels share it. A cached field map is only
+used for a frame if the polynomial matches the residual at the grid to within
+the tolerance, otherwise another field map is computed from the frame. Field
+maps are kept in memory and, if a cache directory is given, on disk between
+runs. Frames already on the output grid (within the tolerance) are copied
+without resampling.
+"""
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+from rotseproc import rlogger
+
+rlog = rlogger.rotseLogger("ROTSE-III",20)
+log = rlog.getlog()
+
+#- Output pixels are sampled on a NSAMPLE x NSAMPLE grid to identify and correct transforms
+NSAMPLE = 5
+
+def _wcs(header):
+    from astropy.wcs import WCS
+    return header if isinstance(header, WCS) else WCS(header)
+
+def _transform(wcs_in, wcs_out, x, y):
+    """
+    Input pixel coordinates of output pixels (x, y)
+    """
+    ra, dec = wcs_out.all_pix2world(x, y, 0)
+    return wcs_in.all_world2pix(ra, dec, 0, quiet=True)
+
+def sample_transform(header_in, header_out, shape_out):
+    """
+    Input pixel coordinates of a NSAMPLE x NSAMPLE grid of output pixels
+
+    Returns:
+        x, y, xin, yin of the grid, flattened with the central pixel in the middle
+    """
+    ny, nx = shape_out
+    y, x = np.meshgrid(np.linspace(0., ny-1., NSAMPLE), np.linspace(0., nx-1., NSAMPLE), indexing='ij')
+    xin, yin = _transform(_wcs(header_in), _wcs(header_out), x.ravel(), y.ravel())
+    return x.ravel(), y.ravel(), xin, yin
+
+def wcs_signature(sample, shape_in, shape_out, quantum=2.):
+    """
+    Quantized signature of the field grid of a transform, unchanged by shifts
+
+    Args:
+        sample              : x, y, xin, yin from sample_transform
+        shape_in, shape_out : (ny, nx) of the input and output images
+    Optional:
+        quantum : pixel size of the quantization of the offsets from the output geometry
+    """
+    x, y, xin, yin = sample
+    c = len(xin) // 2
+    offsets = np.concatenate([(xin - xin[c]) - (x - x[c]), (yin - yin[c]) - (y - y[c])])
+    grid = np.round(offsets / quantum).astype(np.int64)
+
+    h = hashlib.sha1()
+    h.update(np.asarray(list(shape_in) + list(shape_out), dtype=np.int64).tobytes())
+    h.update(grid.tobytes())
+    return h.hexdigest()
+
+def is_identity(sample, shape_in, shape_out, tolerance=0.05):
+    """
+    Check whether the input grid is the output grid, to within tolerance pixels
+    """
+    if tuple(shape_in) != tuple(shape_out):
+        return False
+    x, y, xin, yin = sample
+    return bool(np.all(np.abs(xin - x) < tolerance) and np.all(np.abs(yin - y) < tolerance))
+
+def _quadratic(x, y, shape):
+    """
+    Terms of a quadratic polynomial in output pixel coordinates scaled to [0, 1]
+    """
+    u, v = x / max(shape[1]-1, 1), y / max(shape[0]-1, 1)
+    return [np.ones_like(u), u, v, u*u, u*v, v*v]
+
+class IdentityMap:
+    """
+    Pixel map of an input grid that is the output grid
+    """
+    def __init__(self, shape):
+        self.shape_in = self.shape_out = tuple(shape)
+
+    def apply(self, data, fill=np.nan):
+        return np.array(data, dtype=np.float32)
+
+class PixelMap:
+    """
+    Bilinear gather map from an input grid onto an output grid
+
+    Attributes:
+        index  : flat input index of the lower left neighbour of each output pixel
+        fx, fy : interpolation weights along x and y
+        valid  : output pixels that fall inside the input image
+    """
+    def __init__(self, index, fx, fy, valid, shape_in, shape_out):
+        self.index = index
+        self.fx = fx
+        self.fy = fy
+        self.valid = valid
+        self.shape_in = tuple(shape_in)
+        self.shape_out = tuple(shape_out)
+
+    @classmethod
+    def compute(cls, header_in, shape_in, header_out, shape_out):
+        """
+        Compute the map by transforming every output pixel
+        """
+        y, x = np.indices(shape_out, dtype=float)
+        xin, yin = _transform(_wcs(header_in), _wcs(header_out), x.ravel(), y.ravel())
+        return cls.from_coords(xin, yin, shape_in, shape_out)
+
+    @classmethod
+    def from_coords(cls, xin, yin, shape_in, shape_out):
+        """
+        Map from the input pixel coordinates of every output pixel (flattened)
+        """
+        nyin, nxin = shape_in
+        valid = np.isfinite(xin) & np.isfinite(yin) & (xin >= 0) & (xin <= nxin-1) & (yin >= 0) & (yin <= nyin-1)
+        xin = np.where(valid, xin, 0.)
+        yin = np.where(valid, yin, 0.)
+        # Keep the lower left neighbour inside the image so the upper right one exists
+        x0 = np.minimum(np.floor(xin), nxin-2).astype(np.int64)
+        y0 = np.minimum(np.floor(yin), nyin-2).astype(np.int64)
+
+        return cls((y0*nxin + x0).astype(np.int32), (xin - x0).astype(np.float32), (yin - y0).astype(np.float32),
+                   valid, shape_in, shape_out)
+
+    def apply(self, data, fill=np.nan):
+        """
+        Reproject an image, or a stack of images of shape (n, ny, nx) sharing this map
+        """
+        data = np.asarray(data)
+        stack = data.reshape((-1,) + self.shape_in)
+        flat = stack.reshape(len(stack), -1)
+        nx = self.shape_in[1]
+        i, fx, fy = self.index, self.fx, self.fy
+
+        out = (1-fy)*((1-fx)*flat[:, i] + fx*flat[:, i+1]) + fy*((1-fx)*flat[:, i+nx] + fx*flat[:, i+nx+1])
+        out[:, ~self.valid] = fill
+        out = out.reshape((len(stack),) + self.shape_out)
+
+        return out[0] if data.ndim == 2 else out
+
+class FieldMap:
+    """
+    Input pixel coordinates of every output pixel for one field grid
+
+    Attributes:
+        xin, yin : input pixel coordinates of the output pixels (flattened),
+                   read on first use for maps loaded from disk
+        sample   : x, y, xin, yin of the transform on the sample grid
+        name     : identifier of the map among those sharing its signature
+    """
+    def __init__(self, xin, yin, sample, shape_in, shape_out, filename=None):
+        self._xin = xin
+        self._yin = yin
+        self._filename = filename
+        self.sample = tuple(np.asarray(s, dtype=float) for s in sample)
+        self.shape_in = tuple(int(n) for n in shape_in)
+        self.shape_out = tuple(int(n) for n in shape_out)
+        self.name = hashlib.sha1(np.array(self.sample).tobytes()).hexdigest()[:12]
+
+    @classmethod
+    def compute(cls, header_in, shape_in, header_out, shape_out, sample):
+        y, x = np.indices(shape_out, dtype=float)
+        xin, yin = _transform(_wcs(header_in), _wcs(header_out), x.ravel(), y.ravel())
+        return cls(xin.astype(np.float32), yin.astype(np.float32), sample, shape_in, shape_out)
+
+    @property
+    def xin(self):
+        if self._xin is None:
+            self._read()
+        return self._xin
+
+    @property
+    def yin(self):
+        if self._yin is None:
+            self._read()
+        return self._yin
+
+    def _read(self):
+        with np.load(self._filename) as f:
+            self._xin, self._yin = f['xin'], f['yin']
+
+    def residual(self, sample, tolerance=0.05):
+        """
+        Fit the difference of a frame's transform from the field map
+
+        Args:
+            sample : x, y, xin, yin of the frame's transform from sample_transform
+        Returns:
+            polynomial coefficients of the x and y differences, or None if they
+            don't fit the sample to within tolerance pixels
+        """
+        x, y, xin, yin = sample
+        terms = np.array(_quadratic(x, y, self.shape_out)).T
+        coeffs = []
+        for diff in (xin - self.sample[2], yin - self.sample[3]):
+            if not np.all(np.isfinite(diff)):
+                return None
+            c = np.linalg.lstsq(terms, diff, rcond=None)[0]
+            if np.max(np.abs(terms @ c - diff)) >= tolerance:
+                return None
+            coeffs.append(c)
+        return coeffs
+
+    def pixel_map(self, coeffs):
+        """
+        Pixel map of a frame from the residual coefficients of its transform
+        """
+        ny, nx = self.shape_out
+        terms = _quadratic(np.arange(nx, dtype=float)[None, :], np.arange(ny, dtype=float)[:, None], self.shape_out)
+        dx, dy = [sum(ci * t for ci, t in zip(c, terms)).astype(np.float32).ravel() for c in coeffs]
+        return PixelMap.from_coords(self.xin + dx, self.yin + dy, self.shape_in, self.shape_out)
+
+    def save(self, filename):
+        from rotseproc.io.output import atomic_output
+        with atomic_output(filename) as tmpfile:
+            with open(tmpfile, 'wb') as f:
+                np.savez(f, xin=self.xin, yin=self.yin, sample=np.array(self.sample), shape_in=self.shape_in,
+                         shape_out=self.shape_out)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Read the sample grid of a saved map, its coordinates are read when needed
+        """
+        with np.load(filename) as f:
+            return cls(None, None, f['sample'], f['shape_in'], f['shape_out'], filename)
+
+class ReprojectionCache:
+    """
+    Cache of field maps keyed by quantized WCS signature
+
+    Optional:
+        cachedir  : directory keeping the field maps between runs (None to only cache in memory)
+        maxmaps   : number of field maps kept in memory
+        tolerance : pixel accuracy of the maps of frames made from a field map
+        quantum   : quantization in pixels of the field grid signatures
+
+    Attributes:
+        hits, misses : field maps taken from the cache (memory or disk) and computed
+        identities   : frames found on the output grid, which need no map
+    """
+    def __init__(self, cachedir=None, maxmaps=8, tolerance=0.05, quantum=2.):
+        self.cachedir = cachedir
+        self.maxmaps = maxmaps
+        self.tolerance = tolerance
+        self.quantum = quantum
+        self._fields = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.identities = 0
+        if cachedir is not None and not os.path.exists(cachedir):
+            os.makedirs(cachedir, exist_ok=True)
+
+    def _candidates(self, sig):
+        """
+        Field maps with a signature, in memory and on disk
+        """
+        for key in [key for key in self._fields if key[0] == sig]:
+            yield key, self._fields[key]
+        if self.cachedir is not None:
+            import glob
+            for mapfile in sorted(glob.glob(os.path.join(self.cachedir, sig + '-*.npz'))):
+                key = (sig, os.path.basename(mapfile)[len(sig)+1:-4])
+                if key not in self._fields:
+                    yield key, FieldMap.load(mapfile)
+
+    def field_map(self, header_in, shape_in, header_out, shape_out, sample):
+        """
+        Field map fitting a transform, computed from the transform if no cached one fits
+
+        Returns:
+            field map, residual coefficients of the transform (see FieldMap.residual)
+        """
+        sig = wcs_signature(sample, shape_in, shape_out, self.quantum)
+        for key, fmap in self._candidates(sig):
+            coeffs = fmap.residual(sample, self.tolerance)
+            if coeffs is not None:
+                self.hits += 1
+                break
+        else:
+            fmap = FieldMap.compute(header_in, shape_in, header_out, shape_out, sample)
+            coeffs = fmap.residual(sample, self.tolerance)
+            key = (sig, fmap.name)
+            self.misses += 1
+            if self.cachedir is not None:
+                fmap.save(os.path.join(self.cachedir, '{}-{}.npz'.format(*key)))
+
+        self._fields[key] = fmap
+        self._fields.move_to_end(key)
+        if len(self._fields) > self.maxmaps:
+            self._fields.popitem(last=False)
+        return fmap, coeffs
+
+    def pixel_map(self, header_in, shape_in, header_out, shape_out):
+        """
+        Pixel map from an input to the output grid
+        """
+        wcs_in, wcs_out = _wcs(header_in), _wcs(header_out)
+        sample = sample_transform(wcs_in, wcs_out, shape_out)
+        if is_identity(sample, shape_in, shape_out, self.tolerance):
+            self.identities += 1
+            return IdentityMap(shape_out)
+        fmap, coeffs = self.field_map(wcs_in, shape_in, wcs_out, shape_out, sample)
+        return fmap.pixel_map(coeffs)
+
+    def reproject(self, data, header_in, header_out, shape_out=None, fill=np.nan):
+        """
+        Reproject one image onto the output grid
+
+        shape_out defaults to NAXIS2, NAXIS1 of header_out
+        """
+        if shape_out is None:
+            shape_out = (header_out['NAXIS2'], header_out['NAXIS1'])
+        return self.pixel_map(header_in, data.shape, header_out, shape_out).apply(data, fill)
+
+    def reproject_frames(self, frames, header_out, shape_out=None, fill=np.nan):
+        """
+        Reproject many frames, applying each map to all the frames that share it at once
+
+        Args:
+            frames     : list of (data, header)
+            header_out : header of the output grid
+        Returns:
+            array of shape (nframes, ny, nx)
+        """
+        if shape_out is None:
+            shape_out = (header_out['NAXIS2'], header_out['NAXIS1'])
+        wcs_out = _wcs(header_out)
+
+        # Frames with the same transform, up to the tolerance, share one gather
+        groups = OrderedDict()
+        for i, (data, header) in enumerate(frames):
+            wcs_in = _wcs(header)
+            x, y, xin, yin = sample_transform(wcs_in, wcs_out, shape_out)
+            key = (data.shape, np.round(np.concatenate([xin, yin]) / self.tolerance).astype(np.int64).tobytes())
+            groups.setdefault(key, (wcs_in, data.shape, []))[2].append(i)
+
+        out = np.empty((len(frames),) + tuple(shape_out), dtype=np.float32)
+        for key, (wcs_in, shape_in, idx) in groups.items():
+            pmap = self.pixel_map(wcs_in, shape_in, wcs_out, shape_out)
+            out[idx] = pmap.apply(np.stack([frames[i][0] for i in idx]), fill)
+        log.debug("Reprojected {} frames with {} gathers".format(len(frames), len(groups)))
+
+        return out
@@ -1,23 +1,197 @@
+"""
+Logging for the ROTSE-III pipeline
+
+Records are put on a queue by the emitting thread and written by a listener
+thread, so pipeline steps never block on slow (e.g. shared filesystem) log
+output. Each record carries the target, step and epoch being processed, set
+with log_context, and can be written as text or JSON lines. The level is set
+once per run with setup_logging.
+"""
+import sys
+import copy
+import json
+import atexit
 import logging
+import contextlib
+import contextvars
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = '%(asctime)-15s %(name)s %(levelname)s : %(context)s%(message)s'
+
+#- Context attributes added to every record
+CONTEXT_KEYS = ('target', 'step', 'epoch')
+
+_context = contextvars.ContextVar('rotse_log_context', default={})
+_handler = None
+_listeners = []
+_handlers = []
+_procqueue = None
+
+class ContextFilter(logging.Filter):
+    """
+    Add the current target, step and epoch to records
+    """
+    def filter(self, record):
+        ctx = _context.get()
+        for key in CONTEXT_KEYS:
+            if not hasattr(record, key):
+                setattr(record, key, ctx.get(key))
+        if not hasattr(record, 'context'):
+            tags = [str(getattr(record, k)) for k in CONTEXT_KEYS if getattr(record, k) is not None]
+            record.context = '[{}] '.format(' '.join(tags)) if len(tags) > 0 else ''
+        return True
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format records as one JSON object per line
+    """
+    def format(self, record):
+        out = {'time'    : self.formatTime(record),
+               'level'   : record.levelname,
+               'name'    : record.name,
+               'message' : record.getMessage()}
+        for key in CONTEXT_KEYS:
+            out[key] = getattr(record, key, None)
+        if record.exc_info:
+            out['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out['exception'] = record.exc_text
+        return json.dumps(out, default=str)
+
+class ContextQueueHandler(QueueHandler):
+    """
+    Queue handler keeping the traceback of a record apart from its message
+
+    QueueHandler.prepare merges the traceback into the message, so the JSON
+    exception field would stay empty. Here it goes to exc_text instead, which
+    both formatters write, and the unpicklable exc_info is dropped.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+def _queue_handler(logqueue):
+    handler = ContextQueueHandler(logqueue)
+    handler.addFilter(ContextFilter())
+    return handler
+
+def setup_logging(level=logging.INFO, jsonfmt=False, logfile=None, stream=None):
+    """
+    Configure logging for this run, replacing any earlier configuration
+
+    Args:
+        level   : log level (0=verbose, 50=critical)
+    Optional:
+        jsonfmt : write JSON lines instead of text
+        logfile : also write records to this file
+        stream  : stream for console output (default stderr)
+    """
+    import queue
+    global _handler, _handlers
+
+    shutdown_logging()
+
+    formatter = JSONFormatter() if jsonfmt else logging.Formatter(FORMAT)
+    _handlers = [logging.StreamHandler(stream if stream is not None else sys.stderr)]
+    if logfile is not None:
+        _handlers.append(logging.FileHandler(logfile))
+    for h in _handlers:
+        h.setFormatter(formatter)
+
+    logqueue = queue.SimpleQueue()
+    listener = QueueListener(logqueue, *_handlers)
+    listener.start()
+    _listeners.append(listener)
+
+    root = logging.getLogger()
+    if _handler is not None:
+        root.removeHandler(_handler)
+    _handler = _queue_handler(logqueue)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+    return root
+
+def shutdown_logging():
+    """
+    Flush queued records and stop the listener threads
+    """
+    global _procqueue
+    while len(_listeners) > 0:
+        _listeners.pop().stop()
+    for h in _handlers:
+        h.close()
+    _procqueue = None
+
+atexit.register(shutdown_logging)
+
+def is_configured():
+    return _handler is not None
+
+def process_queue():
+    """
+    Queue for worker processes to send their records to this process
+
+    Pass it to worker_logging as the initializer of a process pool.
+    """
+    global _procqueue
+    if _procqueue is None:
+        import multiprocessing
+        if not is_configured():
+            setup_logging()
+        _procqueue = multiprocessing.get_context('spawn').Queue()
+        listener = QueueListener(_procqueue, *_handlers)
+        listener.start()
+        _listeners.append(listener)
+    return _procqueue
+
+def worker_logging(logqueue, level=logging.INFO):
+    """
+    Send all records of a worker process to the queue from process_queue
+    """
+    global _handler
+    shutdown_logging()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    _handler = _queue_handler(logqueue)
+    root.addHandler(_handler)
+    root.setLevel(level)
+
+@contextlib.contextmanager
+def log_context(**kwargs):
+    """
+    Tag records logged inside the block with target, step and/or epoch
+    """
+    token = _context.set(dict(_context.get(), **kwargs))
+    try:
+        yield
+    finally:
+        _context.reset(token)
 
 class rotseLogger:
     """
     Simple logger class using logging
+
+    The first logger sets up queued logging at INFO level unless the
+    application configured logging already. The run level is set with
+    setup_logging, loglevel is only kept for backwards compatibility.
     """
-    __loglvl__ = None
     __loggername__ = "ROTSE-III"
-    def __init__(self, name=None, loglevel=logging.INFO):
+    def __init__(self, name=None, loglevel=None):
         if name is not None:
-            self.__loggername__=name
-        if rotseLogger.__loglvl__ is None:
-            rotseLogger.__loglvl__=loglevel
-        self.__loglvl__ = rotseLogger.__loglvl__
-        format = '%(asctime)-15s %(name)s %(levelname)s : %(message)s'
-        logging.basicConfig(format=format, level=self.__loglvl__)
+            self.__loggername__ = name
+        if not is_configured() and not logging.getLogger().handlers:
+            setup_logging(logging.INFO)
     def getlog(self, name=None):
         if name is None:
             loggername = self.__loggername__
         else:
             loggername = name
         return logging.getLogger(loggername)
-
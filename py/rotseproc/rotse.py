@@ -7,15 +7,14 @@ import threading,string
 import subprocess
 import importlib
 import yaml
-import astropy.io.fits as fits
 from rotseproc import rlogger
 from rotseproc import heartbeat as HB
 from rotseproc.merger import QAMerger
-from rotseproc.pa import paalgs
 
-def getobject(conf,log):
-    rlog = rlogger.rotseLogger("ROTSE-III",20)
-    log = rlog.getlog()
+rlog = rlogger.rotseLogger("ROTSE-III")
+log = rlog.getlog()
+
+def getobject(conf,log=log):
     log.debug("Running for {} {} {}".format(conf["ModuleName"],conf["ClassName"],conf))
     try:
         mod=__import__(conf["ModuleName"],fromlist=[conf["ClassName"]])
@@ -59,66 +58,93 @@ def runpipeline(pl, convdict, conf):
             e.g: conf=configdict=yaml.safe_load(open('configfile.yaml','rb'))
     """
 
-    rlog=rlogger.rotseLogger()
-    log=rlog.getlog()
     hb=HB.Heartbeat(log,conf["Timeout"])
 
     inp=None
     paconf=conf["Pipeline"]
     passqadict=None #- pass this dict to QAs downstream
-    schemaMerger=QAMerger(convdict)
+    mergedfile=conf["MergedQAFile"] if "MergedQAFile" in conf else None
+    schemaMerger=QAMerger(convdict,mergedfile)
+    metricsdb=None
+    if "MetricsDB" in conf and conf["MetricsDB"] is not None:
+        from rotseproc.io.metricsdb import MetricsStore
+        metricsdb=MetricsStore(conf["MetricsDB"])
     QAresults=[] 
     import numpy as np
     qa=None
     qas=[[],['Count_Pixels'],[],[],[],[],[]]
+    workload={} #- amount of data found by the first step, recorded with each step's timing
 
+    target=conf["Target"] if "Target" in conf else None
     for s,step in enumerate(pl):
-        log.info("Starting to run step {}".format(paconf[s]["StepName"]))
-        pa=step[0]
-        pargs=mapkeywords(step[0].config["kwargs"],convdict)
-        schemaStep=schemaMerger.addPipelineStep(paconf[s]["StepName"])
-        try:
-            hb.start("Running {}".format(step[0].name))
-            oldinp=inp #-  copy for QAs that need to see earlier input
-            inp=pa(inp,**pargs)
-        except Exception as e:
-            log.critical("Failed to run PA {} error was {}".format(step[0].name,e),exc_info=True)
-            sys.exit("Failed to run PA {}".format(step[0].name))
-        qaresult={}
-        for qa in step[1]:
+        with rlogger.log_context(target=target,step=paconf[s]["StepName"]):
+            log.info("Starting to run step {}".format(paconf[s]["StepName"]))
+            pa=step[0]
+            pargs=mapkeywords(step[0].config["kwargs"],convdict)
+            schemaStep=schemaMerger.addPipelineStep(paconf[s]["StepName"])
             try:
-                qargs=mapkeywords(qa.config["kwargs"],convdict)
-                hb.start("Running {}".format(qa.name))
-                qargs["dict_countbins"]=passqadict #- pass this to all QA downstream
-
-                if isinstance(inp,tuple):
-                    res=qa(inp[0],**qargs)
-                else:
-                    res=qa(inp,**qargs)
-
-#                if "qafile" in qargs:
-#                    qawriter.write_qa_file(qargs["qafile"],res)
-                log.debug("{} {}".format(qa.name,inp))
-                qaresult[qa.name]=res
-                schemaStep.addParams(res['PARAMS'])
-                schemaStep.addMetrics(res['METRICS'])
+                hb.start("Running {}".format(step[0].name))
+                oldinp=inp #-  copy for QAs that need to see earlier input
+                tstart=time.time()
+                inp=pa(inp,**pargs)
+                elapsed=time.time()-tstart
             except Exception as e:
-                log.warning("Failed to run QA {}. Got Exception {}".format(qa.name,e),exc_info=True)
-        hb.stop("Step {} finished.".format(paconf[s]["StepName"]))
-        QAresults.append([pa.name,qaresult])
+                log.critical("Failed to run PA {} error was {}".format(step[0].name,e),exc_info=True)
+                schemaMerger.abort()
+                if metricsdb is not None:
+                    metricsdb.close()
+                sys.exit("Failed to run PA {}".format(step[0].name))
+            if pa.get_workload() is not None:
+                workload=pa.get_workload()
+            if metricsdb is not None:
+                timing=dict(workload)
+                timing['ELAPSED']=elapsed
+                metricsdb.append(paconf[s]["StepName"],timing,target=conf["Target"],field=conf["Field"],
+                                 telescope=conf["Telescope"],night=conf["Night"],runtime=tstart)
+            qaresult={}
+            for qa in step[1]:
+                try:
+                    qargs=mapkeywords(qa.config["kwargs"],convdict)
+                    hb.start("Running {}".format(qa.name))
+                    qargs["dict_countbins"]=passqadict #- pass this to all QA downstream
+
+                    if isinstance(inp,tuple):
+                        res=qa(inp[0],**qargs)
+                    else:
+                        res=qa(inp,**qargs)
+
+    #                if "qafile" in qargs:
+    #                    qawriter.write_qa_file(qargs["qafile"],res)
+                    log.debug("{} {}".format(qa.name,inp))
+                    qaresult[qa.name]=res
+                    schemaStep.addParams(res['PARAMS'])
+                    schemaStep.addMetrics(res['METRICS'])
+                    if metricsdb is not None:
+                        metricsdb.append(paconf[s]["StepName"],res['METRICS'],target=conf["Target"],field=conf["Field"],
+                                         telescope=conf["Telescope"],night=conf["Night"])
+                except Exception as e:
+                    log.warning("Failed to run QA {}. Got Exception {}".format(qa.name,e),exc_info=True)
+            schemaMerger.finishPipelineStep()
+            hb.stop("Step {} finished.".format(paconf[s]["StepName"]))
+            QAresults.append([pa.name,qaresult])
     hb.stop("Pipeline processing finished. Serializing result")
 
-
-  #  # Merge QAs for this pipeline execution
-  #  log.debug("Dumping mergedQAs")
-  #  specprod_dir=os.environ['ROTSE_REDUX'] if 'ROTSE_REDUX' in os.environ else ""
-  #  destFile=None
-  #  schemaMerger.writeTojsonFile(destFile)
-  #  log.info("Wrote merged QA file {}".format(destFile))
-  #  if isinstance(inp,tuple):
-  #     return inp[0]
-  #  else:
-  #     return inp
+    # Merge QAs for this pipeline execution
+    log.debug("Dumping mergedQAs")
+    destFile=schemaMerger.close()
+    if destFile is not None:
+        log.info("Wrote merged QA file {}".format(destFile))
+    if metricsdb is not None:
+        metricsdb.close()
+
+    # Compress output images
+    if "Compression" in conf and conf["Compression"] is not None and conf["Compression"]["Type"] is not None:
+        from rotseproc.io.fitsimage import compress_products
+        compress_products(conf["OutputDir"],conf["Compression"]["Type"],conf["Compression"]["QuantizeLevel"])
+    if isinstance(inp,tuple):
+       return inp[0]
+    else:
+       return inp
 
 #- Setup pipeline from configuration
 
@@ -128,8 +154,6 @@ def setup_pipeline(config):
     conversion dictionary from the configuration dictionary so that Pipeline steps (PA) can
     take them. This is required for runpipeline.
     """
-    rlog=rlogger.rotseLogger()
-    log=rlog.getlog()
     if config is None:
         return None
     log.debug("Reading Configuration")
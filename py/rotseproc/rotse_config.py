@@ -1,16 +1,41 @@
 import os, sys
+import copy
 import json
+import hashlib
 import yaml
-import numpy as np
 from rotseproc.io.findfile import findfile
 from rotseproc import exceptions, rlogger
 
+def parse_coordinates(ra, dec):
+    """
+    Convert RA and DEC given in hh:mm:ss/dd:mm:ss or degrees to degrees
+
+    Returns (None, None) if no or badly formatted coordinates are given
+    """
+    if ra is None:
+        return None, None
+    elif ':' in ra:
+        ra_split = ra.split(':')
+        dec_split = dec.split(':')
+
+        ra = float(ra_split[0])*15. + float(ra_split[1])/4. + float(ra_split[2])/240.
+
+        if not dec_split[0].startswith('-'):
+            dec = float(dec_split[0]) + float(dec_split[1])/60. + float(dec_split[2])/3600.
+        else:
+            dec = float(dec_split[0]) - float(dec_split[1])/60. - float(dec_split[2])/3600.
+        return ra, dec
+    elif float(ra) > 0. and float(ra) < 360.:
+        return float(ra), float(dec)
+    else:
+        return None, None
+
 class Config(object):
     """ 
     A class to generate ROTSE configurations for a given exposure. 
     expand_config will expand out to full format as needed by rotse.setup
     """
-    def __init__(self, configfile, night, telescope, field, ra, dec, datadir=None, outdir=None, tempdir=None, plots=False):
+    def __init__(self, configfile, night, telescope, field, ra, dec, datadir=None, outdir=None, tempdir=None, plots=False, metricsdb=None, lcstore=None, headercache=None, mapcache=None):
         """
         configfile : ROTSE-III configuration file (e.g. rotseproc/config/config_science.yaml)
         night      : night for the data to process (e.g. 20130101)
@@ -20,6 +45,10 @@ class Config(object):
         dec        : target DEC
         datadir    : directory containing data
         outdir     : output directory
+        metricsdb  : QA metrics history database (see rotseproc.io.metricsdb)
+        lcstore    : multi-target light curve store (see rotseproc.io.lightcurve)
+        headercache : FITS header keyword cache (see rotseproc.io.headercache)
+        mapcache   : reprojection pixel map cache (see rotseproc.reproject)
         """
         rlog = rlogger.rotseLogger(name="RotseConfig")
         self.log = rlog.getlog()
@@ -38,25 +67,14 @@ class Config(object):
         self.datadir   = datadir
         self.outdir    = outdir
         self.tempdir   = tempdir
+        self.metricsdb = metricsdb
+        self.lcstore   = lcstore
+        self.headercache = headercache
+        self.mapcache  = mapcache
 
         # Convert RA and DEC to floating point numbers
-        if ra is None:
-            self.ra = ra
-            self.dec = dec
-        elif ':' in ra:
-            ra_split = ra.split(':')
-            dec_split = dec.split(':')
-    
-            self.ra = float(ra_split[0])*15. + float(ra_split[1])/4. + float(ra_split[2])/240.
-    
-            if float(dec_split[0]) >= 0.:
-                self.dec = float(dec_split[0]) + float(dec_split[1])/60. + float(dec_split[2])/3600.
-            else:
-                self.dec = float(dec_split[0]) - float(dec_split[1])/60. - float(dec_split[2])/3600.
-        elif float(ra) > 0. and float(ra) < 360.:
-            self.ra = float(ra)
-            self.dec = float(dec)
-        else:
+        self.ra, self.dec = parse_coordinates(ra, dec)
+        if ra is not None and self.ra is None:
             self.log.warning("RA and DEC are not in the right format, this could cause downstream issues.")
 
         self.plotconf = None
@@ -100,6 +118,7 @@ class Config(object):
             self.t_after   = self.algorithms["Find_Data"]["TimeAfterDiscovery"]
 
         self._qaRefKeys = qaRefKeys
+        self._plan = None
 
     @property
     def palist(self): 
@@ -116,24 +135,43 @@ class Config(object):
 
     @property
     def paargs(self):
+        """
+        PA arguments of each step, from the compiled plan
+        """
+        return {step['StepName']: step['PA']['kwargs'] for step in self.compile()['Pipeline']}
+
+    @property
+    def qaargs(self):
+        """
+        QA arguments of each QA, from the compiled plan
+        """
+        return {qa['ClassName']: qa['kwargs'] for step in self.compile()['Pipeline'] for qa in step['QAs']}
+
+    def _build_paargs(self):
         """
         Many arguments for the PAs are taken default. Some of these may need to be variable
         """
         paopt_find     = {'Night':self.night, 'Telescope':self.telescope, 'Field':self.field, 'RA':self.ra,
                           'DEC':self.dec, 'TimeBeforeDiscovery': self.t_before, 'TimeAfterDiscovery': self.t_after,
-                          'Program':self.program, 'datadir':self.datadir, 'outdir':self.outdir}
-        paopt_coadd    = {'outdir':self.outdir}
-        paopt_extract  = {'outdir':self.outdir}
+                          'Program':self.program, 'datadir':self.datadir, 'outdir':self.outdir, 'PixelRadius':self.pixrad}
+        paopt_quality  = {'outdir':self.outdir}
+        paopt_coadd    = {'outdir':self.outdir, 'mapcache':self.mapcache}
+        paopt_extract  = {'outdir':self.outdir, 'headercache':self.headercache}
+        paopt_zp       = {'outdir':self.outdir, 'zpfile':findfile('zeropoints', self.outdir), 'headercache':self.headercache}
         paopt_subimage = {'Program':self.program, 'Telescope':self.telescope, 'RA':self.ra, 'DEC':self.dec,
                           'PixelRadius':self.pixrad, 'tempdir':self.tempdir, 'outdir':self.outdir}
         paopt_imdiff   = {'outdir':self.outdir}
         paopt_refstars = {'RA':self.ra, 'DEC':self.dec, 'outdir':self.outdir}
-        paopt_phot     = {'outdir':self.outdir, 'dumpfile':self.dump_pa('Photometry')}
+        paopt_phot     = {'outdir':self.outdir, 'dumpfile':self.dump_pa('Photometry'), 'lcstore':self.lcstore,
+                          'zpfile':findfile('zeropoints', self.outdir),
+                          'Target':os.path.basename(os.path.normpath(self.outdir))}
 
         paopts={}
         defList={'Find_Data'          : paopt_find,
+                 'Frame_Quality'      : paopt_quality,
                  'Coaddition'         : paopt_coadd,
                  'Source_Extraction'  : paopt_extract,
+                 'Zero_Points'        : paopt_zp,
                  'Make_Subimages'     : paopt_subimage,
                  'Image_Differencing' : paopt_imdiff,
                  'Choose_Refstars'    : paopt_refstars,
@@ -191,14 +229,12 @@ class Config(object):
                 
                 #- make path if needed
                 path = os.path.normpath(os.path.dirname(qa_outfig[QA]))
-                if not os.path.exists(path):
-                    os.makedirs(path)
+                os.makedirs(path, exist_ok=True)
 
         return (qa_outfig)
 #        return ((qa_outfile,qa_outfig),(qa_pa_outfile,qa_pa_outfig))
 
-    @property
-    def qaargs(self):
+    def _build_qaargs(self):
         qaopts = {}
         referencemetrics = []        
         for PA in self.palist:
@@ -209,14 +245,15 @@ class Config(object):
                               'paname':PA.upper(),
                               'param':params,
                               'qafile':outfiles[0],
-                              'qafig':outfiles[1]}
-
-                if self.reference != None:
-                    refkey = qaopts[qa]['refKey']
-                    for padict in range(len(self.reference)):
-                        pa_metrics = self.reference[padict].keys()
-                        if refkey in pa_metrics:
-                            qaopts[qa]['ReferenceMetrics'] = {'{}'.format(refkey): self.reference[padict][refkey]}
+                              'qafig':outfiles[1],
+                              'plotconf':self.plotconf,
+                              'catalogs':self.qa_catalogs(PA)}
+
+                #- Replace static references with rolling values from the metrics history
+                if self.reference is not None and qa in self.reference:
+                    params = dict(params)
+                    params.update(self.reference[qa])
+                    qaopts[qa]['param'] = params
         return qaopts
 
     def _qaparams(self,qa):
@@ -253,7 +290,17 @@ class Config(object):
         """
         Specify the filenames: files for the given qa output
         """
-        filemap={'Count_Pixels': 'countpix'}
+        filemap={'Count_Pixels'        : 'countpix',
+                 'Frame_Rejection'     : 'framerej',
+                 'Image_Noise'         : 'imnoise',
+                 'Saturation'          : 'saturation',
+                 'Bad_Pixels'          : 'badpix',
+                 'Background_Gradient' : 'gradient',
+                 'Source_Count'        : 'nsources',
+                 'Seeing'              : 'seeing',
+                 'Ellipticity'         : 'ellipticity',
+                 'Limiting_Magnitude'  : 'limitmag',
+                 'Astrometry'          : 'astrometry'}
 
         if qaname in filemap:
             outfile = findfile('qafile', self.outdir)
@@ -265,6 +312,20 @@ class Config(object):
 
         return (outfile, outfig)
 
+    def qa_catalogs(self, paname):
+        """
+        Pattern of the source catalogs written by a PA, read by its catalog QAs
+
+        Photometry writes a light curve, not catalogs, so its depth is checked
+        on the subimage catalogs of Make_Subimages.
+        """
+        catmap={'Source_Extraction' : 'coadd/prod/*_sobj.fit',
+                'Make_Subimages'    : 'sub/prod/*_cobj.fit'}
+
+        if paname in catmap:
+            return os.path.join(self.outdir, catmap[paname])
+        return None
+
     def expand_config(self):
         """
         config: rotseproc.config.Config object
@@ -272,8 +333,10 @@ class Config(object):
         self.log.debug("Building Full Configuration")
         self.timeout = self.conf["Timeout"]
 
-        #- Get reference metrics from template json file
+        #- Get reference metrics from the QA metrics history
         self.reference=None
+        if self.metricsdb is not None:
+            self.reference = self._history_references()
 
         outconfig={}
         outconfig['Night']     = self.night
@@ -282,13 +345,17 @@ class Config(object):
         outconfig['Flavor']    = self.flavor
         outconfig['Program']   = self.program
 
+        #- Build the PA and QA options, the paargs and qaargs properties read them from the compiled plan
+        paargs = self._build_paargs()
+        qaargs = self._build_qaargs()
+
         pipeline = []
         for ii,PA in enumerate(self.palist):
             pipe={}
-            pipe['PA'] = {'ClassName': PA, 'ModuleName': self.pamodule, 'kwargs': self.paargs[PA]}
+            pipe['PA'] = {'ClassName': PA, 'ModuleName': self.pamodule, 'kwargs': paargs[PA]}
             pipe['QAs']=[]
             for jj, QA in enumerate(self.qalist[PA]):
-                pipe_qa={'ClassName': QA, 'ModuleName': self.qamodule, 'kwargs': self.qaargs[QA]}
+                pipe_qa={'ClassName': QA, 'ModuleName': self.qamodule, 'kwargs': qaargs[QA]}
                 pipe['QAs'].append(pipe_qa)
             pipe['StepName']=PA
             pipeline.append(pipe)
@@ -296,22 +363,166 @@ class Config(object):
         outconfig['Pipeline']   = pipeline
         outconfig['Timeout']    = self.timeout
         outconfig['PlotConfig'] = self.plotconf
-
-        #- Check if all the files exist for this configuraion
-       # check_config(outconfig)
+        outconfig['MergedQAFile'] = findfile('mergedqa', self.outdir)
+        outconfig['Target']       = os.path.basename(os.path.normpath(self.outdir))
+        outconfig['MetricsDB']    = self.metricsdb
+        outconfig['OutputDir']    = self.outdir
+        outconfig['Compression']  = self.conf["Compression"] if "Compression" in self.conf else None
+        outconfig['Resources']    = self.conf["Resources"] if "Resources" in self.conf else None
+
+        #- Check the expanded configuration against the plan schema
+        check_config(outconfig)
         return outconfig
 
+    def compile(self):
+        """
+        Expand the configuration once into an immutable PipelinePlan
+        """
+        if self._plan is None:
+            self._plan = PipelinePlan(self.expand_config())
+        return self._plan
+
+    def _history_references(self):
+        """
+        Rolling reference values and ranges for each QA from the metrics history
+        """
+        from rotseproc.io.metricsdb import MetricsStore
+
+        if not os.path.exists(self.metricsdb):
+            self.log.info("No QA metrics history in {}, using configured references".format(self.metricsdb))
+            return None
+        # References are per field, the field of targets given by coordinates is only found by Find_Data
+        if self.field is None:
+            self.log.info("No field given, using configured references")
+            return None
+
+        store = MetricsStore(self.metricsdb)
+        references = {}
+        for PA in self.palist:
+            for QA in self.qalist[PA]:
+                if QA not in self._qaRefKeys:
+                    continue
+                key = self._qaRefKeys[QA]
+                ref = store.reference(key, step=PA, field=self.field, telescope=self.telescope)
+                if ref is not None:
+                    references[QA] = {'{}_{}'.format(key, k): v for k, v in ref.items()}
+                    self.log.info("Using rolling {} reference {} for {}".format(key, ref['REF'], QA))
+        store.close()
+
+        return references
+
+#- Required keys and types of an expanded configuration
+PLAN_SCHEMA = {'Night'     : (list, str, type(None)),
+               'Field'     : (str, type(None)),
+               'Telescope' : (str,),
+               'Flavor'    : (str,),
+               'Program'   : (str,),
+               'Timeout'   : (int, float),
+               'Pipeline'  : (list,)}
+
+STEP_SCHEMA = {'PA'       : (dict,),
+               'QAs'      : (list,),
+               'StepName' : (str,)}
+
+ALG_SCHEMA = {'ClassName'  : (str,),
+              'ModuleName' : (str,),
+              'kwargs'     : (dict,)}
+
+def _check_keys(conf, schema, where):
+    for key, types in schema.items():
+        if key not in conf:
+            raise exceptions.ParameterException("{} is missing {}".format(where, key))
+        if not isinstance(conf[key], types):
+            raise exceptions.ParameterException("{} {} should be {}, got {}".format(
+                where, key, ' or '.join(t.__name__ for t in types), type(conf[key]).__name__))
+
 def check_config(outconfig):
     """
-    Given the expanded config, check for all possible file existence etc...
+    Given the expanded config, check that it matches the plan schema
+    """
+    _check_keys(outconfig, PLAN_SCHEMA, "Configuration")
+    for step in outconfig['Pipeline']:
+        _check_keys(step, STEP_SCHEMA, "Pipeline step")
+        _check_keys(step['PA'], ALG_SCHEMA, "PA of step {}".format(step['StepName']))
+        for qa in step['QAs']:
+            _check_keys(qa, ALG_SCHEMA, "QA of step {}".format(step['StepName']))
+
+    return
+
+def _canonical(conf):
+    """
+    Canonical JSON representation of a configuration, used for hashing
+    """
+    return json.dumps(conf, sort_keys=True, separators=(',', ':'))
+
+class PipelinePlan(object):
+    """
+    Immutable, fully expanded pipeline configuration with a stable content hash
+
+    The plan can be written to and read back from a JSON or YAML file so batch
+    and resumed runs don't need to expand the configuration again.
     """
-    self.log.info("Checking if all the necessary files exist.")
+    def __init__(self, outconfig):
+        check_config(outconfig)
+        # Round trip through JSON to drop tuples, dict views etc. and own a private copy
+        self._conf = json.loads(_canonical(outconfig))
+        self._hash = hashlib.sha256(_canonical(self._conf).encode()).hexdigest()
+
+    @property
+    def hash(self):
+        """ sha256 of the canonical JSON form of the plan """
+        return self._hash
 
-    # Perform necessary checks
+    def step_hash(self, stepname):
+        """
+        Hash of the plan up to and including stepname, e.g. to key step caches
+        """
+        head = {k: v for k, v in self._conf.items() if k != 'Pipeline'}
+        steps = []
+        for step in self._conf['Pipeline']:
+            steps.append(step)
+            if step['StepName'] == stepname:
+                head['Pipeline'] = steps
+                return hashlib.sha256(_canonical(head).encode()).hexdigest()
+        raise KeyError("No step {} in pipeline plan".format(stepname))
+
+    def __getitem__(self, key):
+        return copy.deepcopy(self._conf[key])
+
+    def __contains__(self, key):
+        return key in self._conf
+
+    def as_dict(self):
+        """ Mutable copy of the expanded configuration, as used by rotse.setup_pipeline """
+        return copy.deepcopy(self._conf)
+
+    def write(self, filename):
+        """
+        Write the plan and its hash to a JSON or YAML file (by extension)
+        """
+        out = {'PlanHash': self._hash, 'Plan': self._conf}
+        with open(filename, 'w') as f:
+            if filename.endswith(('.yaml', '.yml')):
+                yaml.safe_dump(out, f, default_flow_style=False)
+            else:
+                json.dump(out, f, sort_keys=True, indent=2)
+
+    @classmethod
+    def read(cls, filename):
+        """
+        Read a plan written by PipelinePlan.write and verify its hash
+        """
+        with open(filename, 'r') as f:
+            if filename.endswith(('.yaml', '.yml')):
+                saved = yaml.safe_load(f)
+            else:
+                saved = json.load(f)
 
-    log.info("All necessary files exist for {} configuration.".format(outconfig["Flavor"]))
+        plan = cls(saved['Plan'])
+        if 'PlanHash' in saved and saved['PlanHash'] != plan.hash:
+            raise exceptions.ParameterException("Pipeline plan {} does not match its hash".format(filename))
 
-    return 
+        return plan
 
 class Palist(object):
     """
@@ -0,0 +1,66 @@
+"""
+rotseproc.scripts.bench_compression
+===================================
+Compare read/write throughput of plain and tile-compressed FITS images
+
+Runs on real frames so the numbers reflect the data and the filesystem the
+pipeline uses (e.g. a scratch directory on the shared filesystem):
+
+    python -m rotseproc.scripts.bench_compression -i $ROTSE_DATA/3b/13/07/26/image -w /scratch/$USER/bench -n 10
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+def parse():
+    parser = argparse.ArgumentParser(description="Benchmark tile-compressed FITS I/O")
+    parser.add_argument('-i', '--indir', type=str, required=True, help="directory containing sample images")
+    parser.add_argument('-w', '--workdir', type=str, required=True, help="scratch directory on the filesystem to test")
+    parser.add_argument('-n', '--nfiles', type=int, default=10, help="number of images to use")
+    parser.add_argument('--compression', type=str, nargs='+', default=['none', 'RICE_1', 'GZIP_1', 'GZIP_2'],
+                        help="compression types to compare (none for uncompressed)")
+    parser.add_argument('--quantize', type=float, default=16., help="quantization level of floating point images")
+    args = parser.parse_args()
+    return args
+
+def bench_main(args=None):
+    import os, glob, time
+    from rotseproc.io.fitsimage import read_image, write_image
+
+    if args is None:
+        args = parse()
+
+    images = sorted(glob.glob(os.path.join(args.indir, '*.fit*')))[:args.nfiles]
+    if len(images) == 0:
+        raise IOError("No images found in {}".format(args.indir))
+    frames = [read_image(im) for im in images]
+    nbytes = sum(data.nbytes for data, header in frames)
+
+    if not os.path.exists(args.workdir):
+        os.makedirs(args.workdir)
+
+    print("{:>8s} {:>12s} {:>12s} {:>12s} {:>8s}".format('type', 'write MB/s', 'read MB/s', 'size MB', 'ratio'))
+    for ctype in args.compression:
+        compression = None if ctype.lower() == 'none' else ctype
+        outfiles = [os.path.join(args.workdir, 'bench_{}_{}.fits'.format(ctype, i)) for i in range(len(frames))]
+
+        t0 = time.time()
+        for outfile, (data, header) in zip(outfiles, frames):
+            write_image(outfile, data, header, compression=compression, quantize_level=args.quantize, overwrite=True)
+            with open(outfile, 'rb+') as f:
+                os.fsync(f.fileno())
+        twrite = time.time() - t0
+
+        t0 = time.time()
+        for outfile in outfiles:
+            read_image(outfile, header=False)
+        tread = time.time() - t0
+
+        size = sum(os.path.getsize(f) for f in outfiles)
+        for f in outfiles:
+            os.remove(f)
+
+        mb = nbytes / 1.e6
+        print("{:>8s} {:>12.1f} {:>12.1f} {:>12.1f} {:>8.2f}".format(ctype, mb/twrite, mb/tread, size/1.e6, nbytes/size))
+
+if __name__=='__main__':
+    bench_main()
@@ -0,0 +1,56 @@
+"""
+rotseproc.scripts.make_synthetic
+================================
+Write synthetic ROTSE-III data for running the pipeline without the ROTSE-III tools
+
+    rotse_synthetic --datadir /tmp/data --tempdir /tmp/template -f sks0246+3652 -n 130701 130831 --cadence 3
+
+writes frames of a synthetic star field with a transient on every third night
+from 130701 to 130831, then prints the rotse_pipeline command running all steps
+on them with the mock backends (see rotseproc.pa.mock) for profiling.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Write synthetic ROTSE-III data")
+    parser.add_argument('--datadir', type=str, required=True, help="data directory to write frames to")
+    parser.add_argument('--tempdir', type=str, required=True, help="template directory to write the reference image to")
+    parser.add_argument('-f', '--field', type=str, required=True, help="field with survey prefix, e.g. sks0246+3652")
+    parser.add_argument('-t', '--telescope', type=str, default='3b', help="which ROTSE-III telescope")
+    parser.add_argument('-n', '--night', type=str, nargs=2, required=True, help="first and last night (yymmdd)")
+    parser.add_argument('--cadence', type=int, default=1, help="days between observed nights")
+    parser.add_argument('--nframes', type=int, default=3, help="frames per night")
+    parser.add_argument('--size', type=int, default=512, help="frame size in pixels")
+    parser.add_argument('--nstars', type=int, default=300, help="number of stars in the field")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the image noise")
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+def synthetic_main(args=None):
+    import datetime
+    from rotseproc import rlogger
+    from rotseproc.pa.mock import make_synthetic_data
+
+    if args is None:
+        args = parse()
+    rlogger.setup_logging(20)
+
+    first, last = [datetime.datetime.strptime(n, '%y%m%d') for n in args.night]
+    nights = []
+    while first <= last:
+        nights.append(first.strftime('%y%m%d'))
+        first += datetime.timedelta(days=args.cadence)
+
+    out = make_synthetic_data(args.datadir, args.tempdir, args.telescope, args.field, nights, nframes=args.nframes,
+                              shape=(args.size, args.size), nstars=args.nstars, seed=args.seed)
+
+    print("rotse_pipeline -i $CONFIG_DIR/config_supernova.yaml -o {} -n {} {} -f {} -t {} -r {:.6f} -d {:.6f} "
+          "--datadir {} --tempdir {} --backend mock".format(args.field, args.night[0], args.night[1], args.field,
+                                                            args.telescope, out['RA'], out['DEC'],
+                                                            args.datadir, args.tempdir))
+    return out
@@ -0,0 +1,65 @@
+"""
+rotseproc.scripts.rotse_lcfeatures
+==================================
+Compute light curve features of all targets in the light curve store at once
+
+    rotse_lcfeatures
+    rotse_lcfeatures --lcstore $ROTSE_REDUX/lightcurves -o features.fits --mjd_range 56400 56700
+
+Writes one row per target with the number of detections, first and last
+MJD, observed and fitted peak magnitude and time, and rise and decline rates
+(see rotseproc.pa.palib.light_curve_features).
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Compute light curve features of the targets in the light curve store")
+    parser.add_argument('--lcstore', type=str, required=False, default=None,
+                        help="multi-target light curve store, defaults to $ROTSE_REDUX/lightcurves")
+    parser.add_argument('-o', '--output', type=str, required=False, default=None,
+                        help="features table, defaults to features.fits in the light curve store")
+    parser.add_argument('--targets', type=str, nargs='+', required=False, default=None, help="only these targets")
+    parser.add_argument('--mjd_range', type=float, nargs=2, required=False, default=None, help="only points in this MJD range")
+    parser.add_argument('--window', type=float, required=False, default=30., help="days around the observed peak used for the peak fit")
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+def lcfeatures_main(args=None):
+    import os
+    import sys
+    from rotseproc import rlogger
+    from rotseproc.io.lightcurve import LightCurveStore, write_light_curve_features
+    from rotseproc.pa.palib import light_curve_features
+
+    if args is None:
+        args = parse()
+
+    log = rlogger.rotseLogger("ROTSE-III",20).getlog()
+
+    if args.lcstore:
+        lcstore = args.lcstore
+    else:
+        if 'ROTSE_REDUX' not in os.environ:
+            log.critical("Must set $ROTSE_REDUX environment variable or provide lcstore")
+            sys.exit(1)
+        lcstore = os.path.join(os.getenv('ROTSE_REDUX'), 'lightcurves')
+    if not os.path.exists(os.path.join(lcstore, 'index.json')):
+        log.critical("No light curve store in {}".format(lcstore))
+        sys.exit(1)
+    output = args.output if args.output else os.path.join(lcstore, 'features.fits')
+
+    store = LightCurveStore(lcstore)
+    points = store.query(targets=args.targets, mjd_range=args.mjd_range)
+    features = light_curve_features(points['TARGET_ID'], points['MJD'], points['ROTSE_MAG'], points['MAG_ERR'],
+                                    window=args.window)
+    write_light_curve_features(output, features, store.target_ids())
+    log.info("Wrote features of {} targets from {} light curve points to {}".format(
+        len(features['TARGET_ID']), len(points['MJD']), output))
+
+if __name__=='__main__':
+    lcfeatures_main()
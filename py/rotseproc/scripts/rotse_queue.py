@@ -0,0 +1,181 @@
+"""
+rotseproc.scripts.rotse_queue
+=============================
+Distribute targets over rotse_pipeline workers through a shared job queue
+
+Add targets from a file with one target per line (name, night(s), RA, DEC,
+optionally field), lines starting with # are skipped:
+
+    rotse_queue --db queue.db add targets.txt
+
+    # sn2013ej 130725 01:36:48.16 15:45:31.00
+
+Targets in the same field with overlapping night ranges can share the field
+steps (Find_Data to Zero_Points), which then run once per field before the
+targets' own steps:
+
+    rotse_queue --db queue.db add targets.txt --share_fields -i $CONFIG_DIR/config_supernova.yaml
+
+Start any number of workers, locally or e.g. as SLURM array tasks, with the
+arguments shared by all targets after --:
+
+    rotse_queue --db queue.db work -- -i $CONFIG_DIR/config_supernova.yaml
+
+Estimate frames, bytes and run time of all queued targets before starting workers:
+
+    rotse_queue --db queue.db plan -i $CONFIG_DIR/config_supernova.yaml --json plan.json
+
+Check progress and return targets of crashed workers to the queue:
+
+    rotse_queue --db queue.db status
+    rotse_queue --db queue.db release
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Job queue for running the ROTSE-III pipeline on many targets")
+    parser.add_argument('--db', type=str, required=True, help="queue database")
+    parser.add_argument('--lease', type=float, default=600., help="seconds a claimed target stays leased without renewal")
+    parser.add_argument('--maxattempts', type=int, default=3, help="number of tries before a failing target is given up")
+    sub = parser.add_subparsers(dest='action')
+    add = sub.add_parser('add', help="add targets from a file")
+    add.add_argument('targets', type=str, help="file with one target per line: name night(s) ra dec [field]")
+    add.add_argument('-t', '--telescope', type=str, default='3b', help="which ROTSE-III telescope")
+    add.add_argument('--share_fields', action='store_true', help="run the field steps once for co-located targets")
+    add.add_argument('-i', '--config_file', type=str, default=None, help="yaml config with the Find_Data night range, needed with --share_fields", dest="config")
+    work = sub.add_parser('work', help="claim and run targets until the queue is empty")
+    work.add_argument('--maxjobs', type=int, default=None, help="stop after this many targets")
+    work.add_argument('--command', type=str, default='rotse_pipeline', help="pipeline command to run for each target")
+    work.add_argument('pipeline_args', nargs=argparse.REMAINDER, help="arguments passed to every pipeline run (after --)")
+    plan = sub.add_parser('plan', help="estimate the workload of the queued targets")
+    plan.add_argument('-i', '--config_file', type=str, required=True, help="yaml file containing config dictionary", dest="config")
+    plan.add_argument('--datadir', type=str, default=None, help="data directory, overrides $ROTSE_DATA")
+    plan.add_argument('--metricsdb', type=str, default=None, help="metrics store with recorded step timings, defaults to $ROTSE_REDUX/qa_metrics.db")
+    plan.add_argument('--json', type=str, default=None, help="write the plan to this JSON file")
+    sub.add_parser('status', help="show the number of targets in each state")
+    sub.add_parser('release', help="return targets with expired leases to the queue")
+    args = parser.parse_args(options)
+    if args.action is None:
+        parser.error("Must give an action: add, work, status or release")
+    return args
+
+def read_targets(filename):
+    """
+    Read target name, nights, RA, DEC and field from a targets file
+    """
+    targets = []
+    with open(filename, 'r') as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 0 or words[0].startswith('#'):
+                continue
+            name = words[0]
+            # Nights are the 6 digit words after the name
+            nights = []
+            for w in words[1:]:
+                if len(w) == 6 and w.isdigit():
+                    nights.append(w)
+                else:
+                    break
+            rest = words[1+len(nights):]
+            target = {'night': nights, 'ra': None, 'dec': None, 'field': None}
+            if len(rest) >= 2:
+                target['ra'], target['dec'] = rest[0], rest[1]
+            if len(rest) == 1 or len(rest) == 3:
+                target['field'] = rest[-1]
+            targets.append((name, target))
+    return targets
+
+def pipeline_command(command, pipeline_args):
+    """
+    Function building the rotse_pipeline command line for a target
+    """
+    import shlex
+    if len(pipeline_args) > 0 and pipeline_args[0] == '--':
+        pipeline_args = pipeline_args[1:]
+
+    def build(target, args):
+        cmd = shlex.split(command) + ['-o', target, '-t', args['telescope']]
+        if len(args['night']) > 0:
+            cmd += ['-n'] + args['night']
+        if args['ra'] is not None:
+            cmd += ['-r', args['ra'], '-d={}'.format(args['dec'])]
+        if args['field'] is not None:
+            cmd += ['-f', args['field']]
+        if 'steps' in args:
+            cmd += ['--steps'] + args['steps']
+        if 'shared_field' in args:
+            cmd += ['--shared_field', args['shared_field']]
+        return cmd + list(pipeline_args)
+
+    return build
+
+def queue_main(args=None):
+    import sys
+    from rotseproc.jobqueue import JobQueue, run_worker
+
+    if args is None:
+        args = parse()
+
+    queue = JobQueue(args.db, lease=args.lease, maxattempts=args.maxattempts)
+
+    if args.action == 'add':
+        nadd = 0
+        targets = read_targets(args.targets)
+        for name, target in targets:
+            target['telescope'] = args.telescope
+        if args.share_fields:
+            import yaml
+            from rotseproc.fieldshare import FIELD_STEPS, group_targets
+            if args.config is None:
+                sys.exit("Sharing fields needs the pipeline configuration (-i)")
+            with open(args.config, 'r') as f:
+                find = yaml.safe_load(f)["Algorithms"]["Find_Data"]
+            groups, single = group_targets(targets, find["TimeBeforeDiscovery"], find["TimeAfterDiscovery"])
+            shared = {}
+            for group in groups:
+                # The field job is queued under its product directory name
+                queue.add(group['DIR'], night=group['NIGHT'], telescope=group['TELESCOPE'], field=group['FIELD'],
+                          ra=None, dec=None, steps=list(FIELD_STEPS))
+                for name in group['TARGETS']:
+                    shared[name] = group['DIR']
+            print("Sharing {} fields between {} targets".format(len(groups), len(shared)))
+        else:
+            shared = {}
+        for name, target in targets:
+            if name in shared:
+                nadd += queue.add(name, after=shared[name], shared_field=shared[name], **target)
+            else:
+                nadd += queue.add(name, **target)
+        print("Added {} of {} targets".format(nadd, len(targets)))
+    elif args.action == 'work':
+        njobs = run_worker(queue, pipeline_command(args.command, args.pipeline_args), maxjobs=args.maxjobs)
+        print("Ran {} targets".format(njobs))
+    elif args.action == 'plan':
+        import os, json, yaml
+        from rotseproc.planner import plan_targets
+        with open(args.config, 'r') as f:
+            conf = yaml.safe_load(f)
+        datadir = args.datadir if args.datadir else os.getenv('ROTSE_DATA')
+        metricsdb = args.metricsdb
+        if metricsdb is None and 'ROTSE_REDUX' in os.environ:
+            metricsdb = os.path.join(os.getenv('ROTSE_REDUX'), 'qa_metrics.db')
+        # Frames of targets sharing a field are counted once, by the field job
+        targets = [(job['target'], json.loads(job['args'])) for job in queue.jobs() if job['state'] != 'done']
+        workload = plan_targets(targets, conf, datadir, metricsdb)
+        if args.json is not None:
+            with open(args.json, 'w') as f:
+                json.dump(workload, f, indent=2)
+        print(json.dumps(workload['TOTAL'], indent=2))
+    elif args.action == 'status':
+        for job in queue.jobs():
+            print("{id:5d} {target:20s} {state:8s} attempts={attempts} worker={worker} elapsed={elapsed}".format(**job))
+        print(queue.summary())
+    elif args.action == 'release':
+        print("Released {} targets".format(queue.release_stale()))
+
+    queue.close()
+
+if __name__=='__main__':
+    queue_main()
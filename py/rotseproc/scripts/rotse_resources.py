@@ -0,0 +1,57 @@
+"""
+rotseproc.scripts.rotse_resources
+=================================
+Show the live use of the node resource governor shared by all pipelines on a node
+
+    rotse_resources
+    rotse_resources --governor /scratch/rotse_governor.db --watch 10
+
+Limits are those of the running pipelines (see Resources in the configuration
+or the --max_procs, --memory and --max_io options of rotse_pipeline), only the
+use is stored in the governor database.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+
+def parse(options=None):
+    parser = argparse.ArgumentParser(description="Show the live use of the ROTSE-III node resource governor")
+    parser.add_argument('--governor', type=str, required=False, default=None,
+                        help="node governor database, defaults to the system temporary directory")
+    parser.add_argument('--watch', type=float, required=False, default=None, help="print again every this many seconds")
+    parser.add_argument('--json', action='store_true', help="print the utilization as JSON")
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+    return args
+
+def format_utilization(util):
+    """
+    Human readable summary of Governor.utilization
+    """
+    lines = ["processes: {}  memory: {:.2f} GB  I/O streams: {}".format(
+        util['PROCS']['USED'], util['MEMORY']['USED']/1e9, util['IO']['USED'])]
+    for lease in util['LEASES']:
+        lines.append("  pid {:>7}  procs {:>2}  memory {:6.2f} GB  io {:>2}  {:7.0f} s  {}".format(
+            lease['pid'], lease['procs'], lease['memory']/1e9, lease['io'], lease['held'], lease['label']))
+    return '\n'.join(lines)
+
+def resources_main(args=None):
+    import json
+    import time
+    from rotseproc.governor import Governor
+
+    if args is None:
+        args = parse()
+
+    governor = Governor(statefile=args.governor)
+    while True:
+        util = governor.utilization()
+        if args.json:
+            print(json.dumps(util))
+        else:
+            print(format_utilization(util))
+        if args.watch is None:
+            break
+        time.sleep(args.watch)
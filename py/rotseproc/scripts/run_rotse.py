@@ -19,7 +19,7 @@ This requires setting the following environment variables:
 
 Necessary command line arguments:
 
-    --config_file : path to ROTSE-III configuration file
+    --config_file : path to ROTSE-III configuration file (unless --load_plan is given)
 
 Optional arguments:
 
@@ -32,7 +32,24 @@ Optional arguments:
     --specprod_dir : directory for output (overrides $ROTSE_REDUX)
     --outdir       : output directory ($ROTSE_REDUX/{outdir})
     --tempdir      : directory containing template image
+    --save_plan    : write the expanded pipeline plan to a JSON or YAML file
+    --plan         : only estimate frames, bytes and run time, print as JSON (or write to the given file)
+    --load_plan    : run a previously saved pipeline plan instead of expanding config_file
+    --steps        : only run these pipeline steps
+    --backend      : run steps that have this backend (legacy, native, mock) with it, see rotseproc.pa.backends
+    --shared_field : link coadds from a shared field directory and only run the target steps
     --loglvl       : level of log information to show in the terminal
+    --logfile      : also write the log to this file
+    --logjson      : write the log as JSON lines
+    --plotmode     : when to render plots (async, deferred, failures, inline, off)
+    --metricsdb    : QA metrics history database (default $ROTSE_REDUX/qa_metrics.db)
+    --lcstore      : multi-target light curve store (default $ROTSE_REDUX/lightcurves)
+    --headercache  : FITS header keyword cache (default $ROTSE_REDUX/header_cache.db)
+    --mapcache     : reprojection pixel map cache of the native coaddition (default $ROTSE_REDUX/pixel_maps)
+    --max_procs    : processes all pipelines on this node may run at once (overrides Resources in the config)
+    --memory       : memory budget in GB of all pipelines on this node
+    --max_io       : concurrent I/O streams of all pipelines on this node
+    --governor     : node governor database (default in the system temporary directory)
     
   Plotting options:
 
@@ -47,7 +64,7 @@ def parse():
         Should have either a pre existing config file, or need to generate one using config module
     """
     parser = argparse.ArgumentParser(description="Run pipeline on ROTSE-III data")
-    parser.add_argument('-i', '--config_file', type=str, required=True, help="yaml file containing config dictionary", dest="config")
+    parser.add_argument('-i', '--config_file', type=str, required=False, default=None, help="yaml file containing config dictionary", dest="config")
     parser.add_argument('-n', '--night', type=str, nargs='+', required=False, default=None, help="night(s) of data")
     parser.add_argument('-t', '--telescope', type=str, required=False, default='3b', help="which ROTSE-III telescope")
     parser.add_argument('-f', '--field', type=str, required=False, default=None, help="field containing transient", dest="field")
@@ -58,21 +75,46 @@ def parse():
     parser.add_argument('-o', '--outdir', type=str, required=False, default='.', help="reduxdir/outdir directory")
     parser.add_argument('--tempdir', type=str, required=False, default=None, help="template directory, overrides $ROTSE_TEMPLATE")
     parser.add_argument('-p', nargs='?', default='noplots', help="generate static plots", dest='plots')
+    parser.add_argument('--metricsdb', type=str, required=False, default=None, help="QA metrics history database, defaults to reduxdir/qa_metrics.db")
+    parser.add_argument('--lcstore', type=str, required=False, default=None, help="multi-target light curve store, defaults to reduxdir/lightcurves")
+    parser.add_argument('--headercache', type=str, required=False, default=None, help="FITS header keyword cache, defaults to reduxdir/header_cache.db")
+    parser.add_argument('--mapcache', type=str, required=False, default=None, help="reprojection pixel map cache, defaults to reduxdir/pixel_maps")
+    parser.add_argument('--plotmode', type=str, default='async', choices=['async', 'deferred', 'failures', 'inline', 'off'],
+                        help="render plots in a background process (async), after the run (deferred), only for failed QAs (failures), in the pipeline process (inline) or not at all (off)")
+    parser.add_argument('--plan', nargs='?', const='-', default=None, help="estimate the workload instead of running, optionally write JSON to this file")
+    parser.add_argument('--save_plan', type=str, required=False, default=None, help="write expanded pipeline plan to this JSON/YAML file")
+    parser.add_argument('--load_plan', type=str, required=False, default=None, help="run a saved pipeline plan instead of expanding the config file")
+    parser.add_argument('--steps', type=str, nargs='+', required=False, default=None, help="only run these pipeline steps")
+    parser.add_argument('--backend', type=str, required=False, default=None,
+                        help="run the steps that have this backend (legacy, native, mock) with it")
+    parser.add_argument('--shared_field', type=str, required=False, default=None,
+                        help="link coadds from this shared field directory (relative to reduxdir) and skip the field steps")
+    parser.add_argument('--max_procs', type=int, required=False, default=None, help="processes all pipelines on this node may run at once")
+    parser.add_argument('--memory', type=float, required=False, default=None, help="memory budget in GB of all pipelines on this node")
+    parser.add_argument('--max_io', type=int, required=False, default=None, help="concurrent I/O streams of all pipelines on this node")
+    parser.add_argument('--governor', type=str, required=False, default=None, help="node governor database, defaults to the system temporary directory")
     parser.add_argument('--loglvl', default=20, type=int, help="log level (0=verbose, 50=Critical)")
+    parser.add_argument('--logfile', type=str, required=False, default=None, help="also write the log to this file")
+    parser.add_argument('--logjson', action='store_true', help="write the log as JSON lines tagged with target, step and epoch")
     args = parser.parse_args()
     return args
 
 def rotse_main(args=None):
     import os, sys
-    from rotseproc import rotse, rlogger, rotse_config
+    from rotseproc import rotse, rlogger, rotse_config, plotservice
 
     if args is None:
         args = parse()
 
-    rlog = rlogger.rotseLogger(name="ROTSE-III",loglevel=args.loglvl)
+    rlogger.setup_logging(args.loglvl, jsonfmt=args.logjson, logfile=args.logfile)
+    rlog = rlogger.rotseLogger(name="ROTSE-III")
     log = rlog.getlog()
 
-    if args.config is not None:
+    if args.load_plan is not None:
+        log.info("Running ROTSE-III pipeline using saved plan {}".format(args.load_plan))
+        plan = rotse_config.PipelinePlan.read(args.load_plan)
+        configdict = plan.as_dict()
+    elif args.config is not None:
 
         if args.datadir:
             datadir = args.datadir
@@ -92,6 +134,26 @@ def rotse_main(args=None):
 
         outdir = os.path.join(reduxdir, args.outdir)
 
+        if args.metricsdb:
+            metricsdb = args.metricsdb
+        else:
+            metricsdb = os.path.join(reduxdir, 'qa_metrics.db')
+
+        if args.lcstore:
+            lcstore = args.lcstore
+        else:
+            lcstore = os.path.join(reduxdir, 'lightcurves')
+
+        if args.headercache:
+            headercache = args.headercache
+        else:
+            headercache = os.path.join(reduxdir, 'header_cache.db')
+
+        if args.mapcache:
+            mapcache = args.mapcache
+        else:
+            mapcache = os.path.join(reduxdir, 'pixel_maps')
+
         tempdir = None
         if args.tempdir:
             tempdir = args.tempdir
@@ -102,8 +164,9 @@ def rotse_main(args=None):
         log.info("Running ROTSE-III pipeline using configuration file {}".format(args.config))
         if os.path.exists(args.config):
             if "yaml" in args.config:
-                config = rotse_config.Config(args.config, args.night, args.telescope, args.field, args.ra, args.dec, datadir=datadir, outdir=outdir, tempdir=tempdir, plots=args.plots)
-                configdict = config.expand_config()
+                config = rotse_config.Config(args.config, args.night, args.telescope, args.field, args.ra, args.dec, datadir=datadir, outdir=outdir, tempdir=tempdir, plots=args.plots, metricsdb=metricsdb, lcstore=lcstore, headercache=headercache, mapcache=mapcache)
+                plan = config.compile()
+                configdict = plan.as_dict()
             else:
                 log.critical("Can't open configuration file {}".format(args.config))
                 sys.exit("Can't open configuration file")
@@ -112,8 +175,93 @@ def rotse_main(args=None):
     else:
         sys.exit("Must provide a valid configuration file. See rotseproc/config for an example")
 
+    log.info("Pipeline plan hash {}".format(plan.hash))
+    if args.save_plan is not None:
+        plan.write(args.save_plan)
+        log.info("Wrote pipeline plan to {}".format(args.save_plan))
+
+    if args.plan is not None:
+        import json
+        from rotseproc.planner import plan_targets
+        find = configdict["Pipeline"][0]["PA"]["kwargs"]
+        conf = {"Pipeline": [step["StepName"] for step in configdict["Pipeline"]],
+                "Algorithms": {"Find_Data": find}}
+        target = {'night': find["Night"], 'telescope': find["Telescope"], 'field': find["Field"],
+                  'ra': None if find["RA"] is None else str(find["RA"]), 'dec': None if find["DEC"] is None else str(find["DEC"]),
+                  'steps': args.steps, 'shared_field': args.shared_field}
+        workload = plan_targets([(configdict["Target"], target)], conf, find["datadir"], configdict["MetricsDB"])
+        if args.plan == '-':
+            print(json.dumps(workload, indent=2))
+        else:
+            with open(args.plan, 'w') as f:
+                json.dump(workload, f, indent=2)
+            log.info("Wrote workload plan to {}".format(args.plan))
+        return workload
+
+    # Only one run at a time may write into an output directory
+    from rotseproc.io.output import OutputLock
+    from rotseproc.exceptions import LockException
+    lock = OutputLock(configdict["OutputDir"])
+    try:
+        lock.acquire()
+    except LockException as e:
+        log.critical(str(e))
+        sys.exit("Another run is processing {}".format(configdict["OutputDir"]))
+
+    # Run a subset of the steps, e.g. the target steps on shared field products
+    steps = [step["StepName"] for step in configdict["Pipeline"]]
+    runsteps = steps if args.steps is None else args.steps
+    if args.shared_field is not None:
+        from rotseproc.fieldshare import FIELD_STEPS, link_field_products, night_range
+        reduxdir = args.reduxdir if args.reduxdir else os.getenv('ROTSE_REDUX', '')
+        fielddir = os.path.join(reduxdir, args.shared_field)
+        find = configdict["Pipeline"][0]["PA"]["kwargs"]
+        first, last = night_range(find["Night"], find["TimeBeforeDiscovery"], find["TimeAfterDiscovery"])
+        link_field_products(fielddir, configdict["OutputDir"], first, last)
+        runsteps = [s for s in runsteps if s not in FIELD_STEPS]
+    unknown = [s for s in runsteps if s not in steps]
+    if len(unknown) > 0:
+        sys.exit("Steps {} are not in the pipeline {}".format(unknown, steps))
+    if runsteps != steps:
+        configdict["Pipeline"] = [step for step in configdict["Pipeline"] if step["StepName"] in runsteps]
+        log.info("Running steps {}".format(', '.join(runsteps)))
+        # Later runs read the products of this one, which external tools need uncompressed
+        if steps[-1] not in runsteps:
+            configdict["Compression"] = None
+
+    # Choose the implementation of the steps running external tools
+    from rotseproc.pa.backends import BACKEND_SIGNATURES, get_backend, list_backends
+    from rotseproc.exceptions import ParameterException
+    for step in configdict["Pipeline"]:
+        paname = step["PA"]["ClassName"]
+        if paname not in BACKEND_SIGNATURES:
+            continue
+        if args.backend is not None and args.backend in list_backends(paname):
+            step["PA"]["kwargs"]["Backend"] = args.backend
+        backend = step["PA"]["kwargs"]["Backend"] if "Backend" in step["PA"]["kwargs"] else 'legacy'
+        try:
+            get_backend(paname, backend)
+        except ParameterException as e:
+            log.critical(str(e))
+            sys.exit("Unknown backend {} of {}".format(backend, step["StepName"]))
+        if backend != 'legacy':
+            log.info("Running {} with the {} backend".format(step["StepName"], backend))
+
+    # Share the node with the other pipelines running on it
+    from rotseproc.governor import setup_governor
+    resources = configdict["Resources"] if configdict.get("Resources") is not None else {}
+    maxprocs = args.max_procs if args.max_procs is not None else resources.get("MaxProcesses")
+    memory = args.memory if args.memory is not None else resources.get("MemoryBudget")
+    maxio = args.max_io if args.max_io is not None else resources.get("MaxIOStreams")
+    governor = setup_governor(maxprocs, None if memory is None else memory*1e9, maxio, args.governor)
+    if governor.enabled:
+        log.info("Limiting the node to {} processes, {} GB of memory and {} I/O streams".format(maxprocs, memory, maxio))
+
+    plots = plotservice.setup_plot_service(args.plotmode)
     pipeline, convdict = rotse.setup_pipeline(configdict)
     res = rotse.runpipeline(pipeline, convdict, configdict)
+    plots.shutdown()
+    lock.release()
     log.info("ROTSE-III Pipeline completed")
 
 if __name__=='__main__':
@@ -0,0 +1,102 @@
+"""
+Run the installed command line scripts end to end on synthetic data
+"""
+import os
+import sys
+import shlex
+import shutil
+import tempfile
+import unittest
+import subprocess
+import numpy as np
+
+BINDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..', 'bin'))
+CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'config_supernova.yaml'))
+
+class TestBinScripts(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        pydir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.env['PYTHONPATH'] = os.pathsep.join([pydir, self.env.get('PYTHONPATH', '')])
+        self.env['ROTSE_REDUX'] = os.path.join(self.testdir, 'redux')
+        self.env['MPLBACKEND'] = 'Agg'
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def run_script(self, name, *args):
+        cmd = [sys.executable, os.path.join(BINDIR, name)] + list(args)
+        return subprocess.run(cmd, env=self.env, cwd=self.testdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True, timeout=600)
+
+    def test_pipeline_mock(self):
+        """
+        rotse_pipeline runs the command printed by rotse_synthetic with plots rendered in the background
+        """
+        out = self.run_script('rotse_synthetic', '--datadir', os.path.join(self.testdir, 'data'),
+                              '--tempdir', os.path.join(self.testdir, 'template'), '-f', 'sks0246+3652',
+                              '-n', '130701', '130707', '--cadence', '3', '--nstars', '100', '--size', '256')
+        self.assertEqual(out.returncode, 0, out.stdout)
+        command = [line for line in out.stdout.splitlines() if line.startswith('rotse_pipeline')][-1]
+        args = shlex.split(command.replace('$CONFIG_DIR/config_supernova.yaml', CONFIG))[1:]
+
+        out = self.run_script('rotse_pipeline', *(args + ['--plotmode', 'async']))
+        self.assertEqual(out.returncode, 0, out.stdout)
+        self.assertNotIn('Failed to', out.stdout)
+        outdir = os.path.join(self.env['ROTSE_REDUX'], 'sks0246+3652')
+        for product in ('lightcurve.fits', 'lightcurve.pdf', 'mergedqa.jsonl'):
+            self.assertTrue(os.path.exists(os.path.join(outdir, product)), product)
+
+    def test_lcfeatures(self):
+        """
+        rotse_lcfeatures writes one row of features per target of the light curve store
+        """
+        from astropy.table import Table
+        from rotseproc.io.lightcurve import LightCurveStore
+        store = LightCurveStore(os.path.join(self.env['ROTSE_REDUX'], 'lightcurves'))
+        mjd = np.arange(56400., 56440., 2.)
+        for i, name in enumerate(['sn2013ej', 'sn2013fs', 'sn2013gc']):
+            store.upsert(name, mjd, 14. + i + 0.005*(mjd - 56420. - i)**2, np.full(mjd.size, 0.05))
+
+        out = self.run_script('rotse_lcfeatures')
+        self.assertEqual(out.returncode, 0, out.stdout)
+        features = Table.read(os.path.join(store.path, 'features.fits'))
+        self.assertEqual(list(features['TARGET']), ['sn2013ej', 'sn2013fs', 'sn2013gc'])
+        np.testing.assert_allclose(features['FIT_PEAK_MJD'], [56420., 56421., 56422.], atol=1e-6)
+        np.testing.assert_allclose(features['FIT_PEAK_MAG'], [14., 15., 16.], atol=1e-6)
+        self.assertEqual(list(features['NDET']), [20, 20, 20])
+
+        out = self.run_script('rotse_lcfeatures', '--targets', 'sn2013fs', '-o', 'sn2013fs.fits')
+        self.assertEqual(out.returncode, 0, out.stdout)
+        self.assertEqual(list(Table.read(os.path.join(self.testdir, 'sn2013fs.fits'))['TARGET']), ['sn2013fs'])
+
+    def test_saved_plan(self):
+        """
+        A plan saved with --save_plan and run with --load_plan is the same plan with the same hash
+        """
+        import json
+        os.makedirs(os.path.join(self.testdir, 'data'))
+        out = self.run_script('rotse_pipeline', '-i', CONFIG, '-n', '130701', '-f', 'sks0246+3652',
+                              '--datadir', os.path.join(self.testdir, 'data'), '-o', 'sks0246+3652',
+                              '--save_plan', 'plan.json', '--plan', 'workload.json')
+        self.assertEqual(out.returncode, 0, out.stdout)
+        hashes = [line.split()[-1] for line in out.stdout.splitlines() if 'Pipeline plan hash' in line]
+
+        out = self.run_script('rotse_pipeline', '--load_plan', 'plan.json', '--save_plan', 'plan.yaml',
+                              '--plan', 'workload.json')
+        self.assertEqual(out.returncode, 0, out.stdout)
+        hashes += [line.split()[-1] for line in out.stdout.splitlines() if 'Pipeline plan hash' in line]
+
+        from rotseproc.rotse_config import PipelinePlan
+        with open(os.path.join(self.testdir, 'plan.json')) as f:
+            saved = json.load(f)
+        loaded = PipelinePlan.read(os.path.join(self.testdir, 'plan.yaml'))
+        self.assertEqual(len(hashes), 2)
+        self.assertEqual(set(hashes), {saved['PlanHash']})
+        self.assertEqual(loaded.hash, saved['PlanHash'])
+        self.assertEqual(loaded.as_dict(), saved['Plan'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+Test the expanded pipeline configuration and its saved plans
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from rotseproc.exceptions import ParameterException
+from rotseproc.rotse_config import Config, PipelinePlan
+
+CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'config_supernova.yaml'))
+
+class TestPipelinePlan(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def config(self):
+        return Config(CONFIG, ['130701'], '3b', 'sks0246+3652', '02:46:30.0', '+36:55:00', datadir=self.testdir,
+                      outdir=os.path.join(self.testdir, 'sn1'), plots='noplots',
+                      metricsdb=os.path.join(self.testdir, 'qa_metrics.db'))
+
+    def test_round_trip(self):
+        """
+        Saved plans read back to the same plan and hash, as JSON and as YAML
+        """
+        plan = self.config().compile()
+        for name in ('plan.json', 'plan.yaml'):
+            filename = os.path.join(self.testdir, name)
+            plan.write(filename)
+            loaded = PipelinePlan.read(filename)
+            self.assertEqual(loaded.hash, plan.hash)
+            self.assertEqual(loaded.as_dict(), plan.as_dict())
+            self.assertEqual(loaded.step_hash('Coaddition'), plan.step_hash('Coaddition'))
+        # The same configuration expands to the same plan
+        self.assertEqual(self.config().compile().hash, plan.hash)
+
+    def test_modified(self):
+        filename = os.path.join(self.testdir, 'plan.json')
+        self.config().compile().write(filename)
+        with open(filename) as f:
+            saved = json.load(f)
+        saved['Plan']['Telescope'] = '3a'
+        with open(filename, 'w') as f:
+            json.dump(saved, f)
+        with self.assertRaises(ParameterException):
+            PipelinePlan.read(filename)
+
+    def test_step_hash(self):
+        """
+        Step hashes only depend on the plan up to the step
+        """
+        plan = self.config().compile().as_dict()
+        changed = self.config().compile().as_dict()
+        changed['Pipeline'][-1]['PA']['kwargs']['Extra'] = 1
+        plan, changed = PipelinePlan(plan), PipelinePlan(changed)
+        self.assertNotEqual(plan.hash, changed.hash)
+        self.assertEqual(plan.step_hash('Coaddition'), changed.step_hash('Coaddition'))
+        self.assertNotEqual(plan.step_hash('Photometry'), changed.step_hash('Photometry'))
+        with self.assertRaises(KeyError):
+            plan.step_hash('Unknown')
+
+    def test_args_from_plan(self):
+        """
+        The PA and QA arguments are built once, by compiling the plan
+        """
+        config = self.config()
+        with mock.patch.object(Config, '_build_qaargs', autospec=True, side_effect=Config._build_qaargs) as build:
+            qaargs = config.qaargs
+            self.assertEqual(config.qaargs, qaargs)
+            self.assertEqual(config.paargs['Coaddition']['outdir'], os.path.join(self.testdir, 'sn1'))
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual(qaargs['Image_Noise']['param']['NOISE_GRID'], [2, 2])
+        self.assertEqual(qaargs, {qa['ClassName']: qa['kwargs'] for step in config.compile()['Pipeline']
+                                  for qa in step['QAs']})
+
+if __name__ == '__main__':
+    unittest.main()
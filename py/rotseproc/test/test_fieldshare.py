@@ -0,0 +1,82 @@
+"""
+Test sharing field products between co-located targets
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from rotseproc.fieldshare import group_targets, link_field_products, field_dir
+
+def target(nights, field='sks0246+3652', telescope='3b'):
+    return {'night': nights, 'telescope': telescope, 'field': field, 'ra': None, 'dec': None}
+
+class TestGroupTargets(unittest.TestCase):
+
+    def test_overlapping_ranges(self):
+        """
+        Overlapping night ranges of a field merge, also through a chain of targets
+        """
+        targets = [('sn1', target(['130701', '130710'])),
+                   ('sn2', target(['130705', '130720'], field='0246+3652')),
+                   ('sn3', target(['130715', '130725'])),
+                   ('sn4', target(['130801', '130820'])),
+                   ('sn5', target(['130810', '130830'])),
+                   ('sn6', target(['130901', '130910'])),
+                   ('sn7', target(['130705', '130710'], telescope='3a')),
+                   ('sn8', target(['130705', '130710'], field=None))]
+        groups, single = group_targets(targets, 1, 1)
+
+        self.assertEqual(sorted(single), ['sn6', 'sn7', 'sn8'])
+        self.assertEqual(len(groups), 2)
+        self.assertEqual([g['NIGHT'] for g in groups], [['130701', '130725'], ['130801', '130830']])
+        self.assertEqual(groups[0]['TARGETS'], {'sn1': ['130701', '130710'], 'sn2': ['130705', '130720'],
+                                                'sn3': ['130715', '130725']})
+        self.assertEqual(sorted(groups[1]['TARGETS']), ['sn4', 'sn5'])
+        # The field keeps its full name, also when some targets give it without the prefix
+        for g in groups:
+            self.assertEqual((g['FIELD'], g['TELESCOPE']), ('sks0246+3652', '3b'))
+            self.assertEqual(g['DIR'], field_dir('sks0246+3652', '3b', *g['NIGHT']))
+
+    def test_minshare(self):
+        targets = [('sn1', target(['130701', '130710'])), ('sn2', target(['130705', '130720']))]
+        groups, single = group_targets(targets, 1, 1, minshare=3)
+        self.assertEqual((groups, sorted(single)), ([], ['sn1', 'sn2']))
+
+class TestLinkFieldProducts(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.fielddir = os.path.join(self.testdir, 'fields', '3b_sks0246+3652_130701-130830')
+        for sub, suffix in (('image', 'c.fit'), ('prod', 'c_cobj.fit')):
+            os.makedirs(os.path.join(self.fielddir, 'coadd', sub))
+            for night in ('130701', '130710', '130725', '130801'):
+                open(os.path.join(self.fielddir, 'coadd', sub, '{}_sks0246+3652_3b_{}'.format(night, suffix)), 'w').close()
+        open(os.path.join(self.fielddir, 'zeropoints.fits'), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def test_nights(self):
+        """
+        Only the coadds of nights within [first, last] are linked
+        """
+        outdir = os.path.join(self.testdir, 'sn1')
+        self.assertEqual(link_field_products(self.fielddir, outdir, '130705', '130725'), 2)
+        for sub in ('image', 'prod'):
+            linked = sorted(os.listdir(os.path.join(outdir, 'coadd', sub)))
+            self.assertEqual([f[:6] for f in linked], ['130710', '130725'])
+            for f in linked:
+                link = os.path.join(outdir, 'coadd', sub, f)
+                self.assertTrue(os.path.islink(link))
+                self.assertEqual(os.path.realpath(link), os.path.realpath(os.path.join(self.fielddir, 'coadd', sub, f)))
+        self.assertTrue(os.path.islink(os.path.join(outdir, 'zeropoints.fits')))
+
+        # Linking again keeps the existing links
+        self.assertEqual(link_field_products(self.fielddir, outdir, '130705', '130725'), 2)
+
+    def test_all_nights(self):
+        outdir = os.path.join(self.testdir, 'field')
+        self.assertEqual(link_field_products(self.fielddir, outdir), 4)
+
+if __name__ == '__main__':
+    unittest.main()
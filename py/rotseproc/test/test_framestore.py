@@ -0,0 +1,106 @@
+"""
+Test the shared-memory frame store
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from astropy.io import fits
+from rotseproc.framestore import FrameStore, attach
+
+def _measure(handle):
+    """ Worker task: statistics of an attached frame """
+    data = attach(handle)
+    return handle.key, float(data.sum()), data.shape, data.dtype.str, data.flags.writeable
+
+class TestFrameStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        rng = np.random.default_rng(4)
+        self.frames = {'f{}'.format(i): rng.normal(100., 10., (64, 80)).astype(np.float32) for i in range(4)}
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def exists(self, handle):
+        if handle.kind == 'mmap':
+            return os.path.exists(handle.name)
+        try:
+            shared_memory.SharedMemory(name=handle.name).close()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def test_spawn_workers(self):
+        """
+        Handles of frames in shared memory, spilled and read from FITS attach in spawned workers
+        """
+        filename = os.path.join(self.testdir, 'frame.fit')
+        image = np.arange(100*120, dtype='>i2').reshape(100, 120)
+        fits.PrimaryHDU(image).writeto(filename)
+
+        # Room for two frames in shared memory, the others are spilled
+        with FrameStore(maxbytes=2*64*80*4, spilldir=os.path.join(self.testdir, 'spill')) as store:
+            handles = [store.put(key, data) for key, data in self.frames.items()]
+            stamp = store.load(filename, section=(slice(10, 30), slice(0, 50)))
+            self.assertEqual([h.kind for h in handles], ['shm', 'shm', 'mmap', 'mmap'])
+            self.assertEqual(store.utilization(), {'NFRAMES': 5, 'NBYTES': 2*64*80*4, 'NSPILLED': 3})
+
+            ctx = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(2, mp_context=ctx) as pool:
+                results = list(pool.map(_measure, handles + [stamp]))
+
+            for (key, total, shape, dtype, writeable), handle in zip(results, handles):
+                data = self.frames[key]
+                self.assertAlmostEqual(total, float(data.sum()), places=0)
+                self.assertEqual((shape, dtype, writeable), (data.shape, data.dtype.str, False))
+            key, total, shape, dtype, writeable = results[-1]
+            self.assertEqual((total, shape), (float(image[10:30, :50].sum()), (20, 50)))
+            self.assertEqual(np.dtype(dtype), np.dtype('int16'))
+            np.testing.assert_array_equal(store.get(stamp.key), image[10:30, :50])
+            # The stamp is read once, later loads take a reference
+            self.assertEqual(store.load(filename, section=(slice(10, 30), slice(0, 50))), stamp)
+
+    def test_release(self):
+        """
+        Frames are freed with their last reference, shared memory and spilled alike
+        """
+        store = FrameStore(maxbytes=64*80*4)
+        shm = store.put('f0', self.frames['f0'])
+        spilled = store.put('f1', self.frames['f1'])
+        self.assertEqual(spilled.kind, 'mmap')
+        self.assertEqual(store.put('f0', self.frames['f0']), shm)
+        store.acquire(spilled)
+
+        for handle in (shm, spilled):
+            self.assertEqual(store.release(handle), 1)
+            self.assertTrue(self.exists(handle))
+            np.testing.assert_array_equal(store.get(handle.key), self.frames[handle.key])
+            self.assertEqual(store.release(handle), 0)
+            self.assertFalse(self.exists(handle))
+            self.assertNotIn(handle.key, store)
+        self.assertEqual(store.utilization(), {'NFRAMES': 0, 'NBYTES': 0, 'NSPILLED': 0})
+        # Freed memory is available again
+        self.assertEqual(store.put('f2', self.frames['f2']).kind, 'shm')
+        store.close()
+
+    def test_close(self):
+        """
+        Closing frees every frame and the temporary spill directory
+        """
+        store = FrameStore(maxbytes=64*80*4)
+        handles = [store.put(key, data) for key, data in self.frames.items()]
+        store.acquire(handles[0])
+        spilldir = os.path.dirname(handles[-1].name)
+        store.close()
+        self.assertEqual(len(store), 0)
+        self.assertFalse(any(self.exists(h) for h in handles))
+        self.assertFalse(os.path.exists(spilldir))
+
+if __name__ == '__main__':
+    unittest.main()
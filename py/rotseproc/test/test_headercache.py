@@ -0,0 +1,139 @@
+"""
+Test the FITS header keyword cache
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from astropy.io import fits
+from rotseproc.exceptions import ParameterException
+from rotseproc.io import headercache
+from rotseproc.io.headercache import HeaderCache
+
+class TestHeaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'cache', 'headers.db')
+        self.frames = [self.write_frame('frame{}.fit'.format(i), SATCNTS=30000 + i, EXPTIME=60., OBJECT='sks0246+3652')
+                       for i in range(3)]
+        self.cache = HeaderCache(self.dbfile, keys=('SATCNTS', 'EXPTIME', 'OBJECT'))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def write_frame(self, name, mtime=1.e9, shape=(8, 8), **keys):
+        filename = os.path.join(self.testdir, name)
+        hdu = fits.PrimaryHDU(np.zeros(shape, dtype=np.float32))
+        hdu.header.update(keys)
+        hdu.writeto(filename, overwrite=True)
+        os.utime(filename, (mtime, mtime))
+        return filename
+
+    def reads(self):
+        return mock.patch('rotseproc.io.headercache._read_keys', wraps=headercache._read_keys)
+
+    def test_cached(self):
+        with self.reads() as read:
+            headers = self.cache.headers(self.frames)
+        self.assertEqual(read.call_count, 3)
+        self.assertEqual([h['SATCNTS'] for h in headers], [30000, 30001, 30002])
+        # Values keep their header type
+        self.assertIsInstance(headers[0]['SATCNTS'], int)
+
+        # Later lookups, also by a new cache on the same database, don't read the files
+        cache = HeaderCache(self.dbfile, keys=('SATCNTS', 'EXPTIME', 'OBJECT'))
+        with self.reads() as read:
+            self.assertEqual(cache.headers(self.frames), headers)
+            self.assertEqual(cache.get(self.frames[1], 'EXPTIME'), 60.)
+        self.assertEqual(read.call_count, 0)
+        cache.close()
+
+    def test_invalidation(self):
+        """
+        Files are read again when their size or mtime changes
+        """
+        self.cache.headers(self.frames)
+
+        # Same size, new mtime
+        self.write_frame('frame0.fit', mtime=1.e9 + 10, SATCNTS=100, EXPTIME=60., OBJECT='sks0246+3652')
+        # New size, same mtime
+        self.write_frame('frame1.fit', shape=(80, 80), SATCNTS=101, EXPTIME=60., OBJECT='sks0246+3652')
+        self.assertEqual(os.path.getsize(self.frames[0]), os.path.getsize(self.frames[2]))
+        with self.reads() as read:
+            headers = self.cache.headers(self.frames)
+        self.assertEqual(sorted(c.args[0] for c in read.call_args_list), self.frames[:2])
+        self.assertEqual([h['SATCNTS'] for h in headers], [100, 101, 30002])
+
+        # Keywords that aren't cached yet are read, missing ones are None
+        with self.reads() as read:
+            headers = self.cache.headers(self.frames, ['SATCNTS', 'FWHM'])
+        self.assertEqual(read.call_count, 3)
+        self.assertEqual(headers[0], {'SATCNTS': 100, 'FWHM': None})
+
+    def test_lookup(self):
+        """
+        Numeric keywords give float columns with NaN where missing, others object columns
+        """
+        frames = self.frames + [self.write_frame('nosat.fit', EXPTIME=30, OBJECT='sks0246+3652')]
+        table = self.cache.lookup(frames)
+        self.assertEqual(table.dtype.names, ('SATCNTS', 'EXPTIME', 'OBJECT'))
+        self.assertEqual(table['SATCNTS'].dtype, np.dtype(float))
+        np.testing.assert_array_equal(table['SATCNTS'], [30000., 30001., 30002., np.nan])
+        np.testing.assert_array_equal(table['EXPTIME'], [60., 60., 60., 30.])
+        self.assertEqual(table['OBJECT'].dtype, np.dtype(object))
+        self.assertEqual(list(table['OBJECT']), ['sks0246+3652'] * 4)
+
+    def test_prune(self):
+        self.cache.headers(self.frames)
+        os.remove(self.frames[0])
+        self.assertEqual(self.cache.prune(), 1)
+        self.assertEqual(self.cache.prune(), 0)
+
+class TestSaturationLevels(unittest.TestCase):
+    """
+    Source_Extraction needs SATCNTS in the header of every coadd
+    """
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        imagedir = os.path.join(self.testdir, 'coadd', 'image')
+        os.makedirs(imagedir)
+        for night, keys in (('130701', {'SATCNTS': 30000}), ('130704', {})):
+            hdu = fits.PrimaryHDU(np.zeros((8, 8), dtype=np.float32))
+            hdu.header.update(keys)
+            hdu.writeto(os.path.join(imagedir, '{}_sks0246+3652_3b000-000_c.fit'.format(night)))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def test_missing(self):
+        from rotseproc.pa.paalgs import Source_Extraction
+        pa = Source_Extraction('Source_Extraction', {'kwargs': {}})
+        for headercache in (None, os.path.join(self.testdir, 'headers.db')):
+            with mock.patch('rotseproc.pa.backends.get_backend') as get_backend:
+                with self.assertRaisesRegex(ParameterException, '130704_sks0246\\+3652_3b000-000_c.fit') as e:
+                    pa.run_pa(self.testdir, headercache)
+                self.assertNotIn('130701', str(e.exception))
+                get_backend.return_value.assert_not_called()
+
+    def test_types(self):
+        """
+        The saturation levels reach the backend with their header type, cached or not
+        """
+        from rotseproc.pa.paalgs import Source_Extraction
+        fits.setval(os.path.join(self.testdir, 'coadd', 'image', '130704_sks0246+3652_3b000-000_c.fit'), 'SATCNTS',
+                    value=32767)
+        pa = Source_Extraction('Source_Extraction', {'kwargs': {}})
+        for headercache in (None, os.path.join(self.testdir, 'headers.db'), os.path.join(self.testdir, 'headers.db')):
+            with mock.patch('rotseproc.pa.backends.get_backend') as get_backend:
+                pa.run_pa(self.testdir, headercache)
+            cimgs, coadddir, satcnts = get_backend.return_value.call_args.args
+            self.assertEqual(sorted(zip([os.path.basename(c)[:6] for c in cimgs], satcnts)),
+                             [('130701', 30000), ('130704', 32767)])
+            self.assertTrue(all(isinstance(s, int) for s in satcnts))
+
+if __name__ == '__main__':
+    unittest.main()
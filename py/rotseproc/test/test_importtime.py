@@ -0,0 +1,54 @@
+"""
+Test that pipeline startup stays within its import-time budget
+
+Heavy dependencies (astropy, matplotlib, the PA and QA modules) should only
+be imported when a step needs them, so --help and configuration only runs
+stay fast. This runs ``python -X importtime`` on the modules imported by
+rotse_main before the pipeline starts.
+"""
+import os
+import sys
+import unittest
+import subprocess
+
+#- Modules imported by rotse_main before any pipeline step runs
+STARTUP_MODULES = ['rotseproc.scripts.run_rotse', 'rotseproc.rotse', 'rotseproc.rotse_config']
+
+#- Modules that must not be imported at startup
+HEAVY_MODULES = ['matplotlib', 'astropy', 'rotseproc.pa.paalgs', 'rotseproc.qa.qaalgs']
+
+#- Import time budget in ms
+BUDGET = 250.
+
+def measure_importtime(modules=STARTUP_MODULES):
+    """
+    Import modules in a fresh interpreter and return (total time in ms, imported module names)
+    """
+    pydir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([pydir, os.environ.get('PYTHONPATH', '')]))
+    cmd = [sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)]
+    proc = subprocess.run(cmd, env=env, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    total = 0
+    imported = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imported.append(name.strip())
+        # Top level imports are not indented, skip the interpreter's own startup imports
+        if not name[1:].startswith(' ') and name.strip().startswith('rotseproc'):
+            total += int(cumulative_us)
+
+    return total / 1000., imported
+
+class TestImportTime(unittest.TestCase):
+
+    def test_startup(self):
+        total, imported = measure_importtime()
+        heavy = set(m.split('.')[0] if not m.startswith('rotseproc') else m for m in imported) & set(HEAVY_MODULES)
+        self.assertEqual(sorted(heavy), [], "Heavy modules imported at startup")
+        self.assertLess(total, BUDGET, "Startup import time {:.1f} ms over budget".format(total))
+
+if __name__ == '__main__':
+    unittest.main()
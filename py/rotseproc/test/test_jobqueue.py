@@ -0,0 +1,168 @@
+"""
+Test the SQLite job queue
+"""
+import os
+import sys
+import time
+import signal
+import shutil
+import tempfile
+import unittest
+import subprocess
+from rotseproc.jobqueue import JobQueue, run_worker, PENDING, RUNNING, DONE, FAILED
+
+PYDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+BINDIR = os.path.abspath(os.path.join(PYDIR, '..', 'bin'))
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'queue.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def states(self, queue):
+        return {job['target']: job['state'] for job in queue.jobs()}
+
+    def crash(self, queue):
+        """ Claim the next job and let its lease expire, like a killed worker """
+        job = queue.claim('crashed')
+        self.assertIsNotNone(job)
+        time.sleep(0.1)
+        return job
+
+    def test_claim_finish(self):
+        queue = JobQueue(self.dbfile)
+        queue.add('field', field='sks0246+3652')
+        queue.add('sn1', after='field')
+        self.assertEqual(queue.claim('w')[1], 'field')
+        self.assertIsNone(queue.claim('w'))
+        self.assertEqual(queue.waiting(), 1)
+        queue.finish(1, 0, 'w')
+        self.assertEqual(queue.claim('w')[1], 'sn1')
+
+    def test_exhausted_lease_fails(self):
+        """
+        A job whose last attempt crashed is failed with its dependents, not left pending
+        """
+        queue = JobQueue(self.dbfile, lease=0.05, maxattempts=2)
+        queue.add('field')
+        queue.add('sn1', after='field')
+        queue.add('sn2', after='sn1')
+        self.crash(queue)
+        self.assertEqual(queue.release_stale(), 1)
+        self.crash(queue)
+        self.assertEqual(queue.release_stale(), 0)
+        self.assertEqual(self.states(queue), {'field': FAILED, 'sn1': FAILED, 'sn2': FAILED})
+        self.assertEqual(queue.waiting(), 0)
+
+    def test_worker_exits(self):
+        """
+        Workers stop once the only target left waits for a job without attempts left
+        """
+        queue = JobQueue(self.dbfile, lease=0.05, maxattempts=2)
+        queue.add('field')
+        queue.add('sn1', after='field')
+        self.crash(queue)
+        self.crash(queue)
+        self.assertEqual(queue.waiting(), 0)
+        command = lambda target, args: [sys.executable, '-c', 'pass']
+        self.assertEqual(run_worker(queue, command, poll=0.01), 0)
+        self.assertEqual(self.states(queue), {'field': FAILED, 'sn1': FAILED})
+
+# Pipeline stand-in for the worker tests: records the target it was run for,
+# and hangs like a stuck pipeline when $HANG is set
+RECORDER = """
+import os, sys, time
+target = sys.argv[sys.argv.index('-o') + 1]
+with open(os.environ['RECORD'], 'a') as f:
+    f.write(target + '\\n')
+if 'HANG' in os.environ:
+    time.sleep(600)
+time.sleep(0.05)
+"""
+
+class TestWorkers(unittest.TestCase):
+    """
+    Several rotse_queue workers sharing one queue database
+    """
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'queue.db')
+        self.record = os.path.join(self.testdir, 'record.txt')
+        recorder = os.path.join(self.testdir, 'recorder.py')
+        with open(recorder, 'w') as f:
+            f.write(RECORDER)
+        self.command = '{} {}'.format(sys.executable, recorder)
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.pathsep.join([PYDIR, self.env.get('PYTHONPATH', '')])
+        self.env['RECORD'] = self.record
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def add(self, names):
+        targets = os.path.join(self.testdir, 'targets.txt')
+        with open(targets, 'w') as f:
+            for name in names:
+                f.write('{} 130725 01:36:48.16 15:45:31.00\n'.format(name))
+        subprocess.check_call(self.queue_command('add', targets), env=self.env, stdout=subprocess.DEVNULL)
+
+    def queue_command(self, *args):
+        return [sys.executable, os.path.join(BINDIR, 'rotse_queue'), '--db', self.dbfile, '--lease', '1'] + list(args)
+
+    def worker(self, env=None):
+        return subprocess.Popen(self.queue_command('work', '--command', self.command), env=env or self.env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+    def recorded(self):
+        with open(self.record) as f:
+            return f.read().split()
+
+    def test_claimed_once(self):
+        """
+        Workers started at once run every target exactly once
+        """
+        names = ['sn{:02d}'.format(i) for i in range(24)]
+        self.add(names)
+        workers = [self.worker() for i in range(4)]
+        for p in workers:
+            self.assertEqual(p.wait(timeout=120), 0)
+        self.assertEqual(sorted(self.recorded()), names)
+        queue = JobQueue(self.dbfile)
+        jobs = queue.jobs()
+        queue.close()
+        self.assertEqual({job['state'] for job in jobs}, {DONE})
+        self.assertEqual({job['attempts'] for job in jobs}, {1})
+        self.assertGreater(len({job['worker'] for job in jobs}), 1)
+
+    def test_killed_worker(self):
+        """
+        The target of a killed worker is run again by another worker once its lease expires
+        """
+        self.add(['sn1'])
+        env = dict(self.env, HANG='1')
+        hung = self.worker(env)
+        queue = JobQueue(self.dbfile)
+        t0 = time.time()
+        while not os.path.exists(self.record) and time.time() - t0 < 60:
+            time.sleep(0.1)
+        self.assertEqual(queue.summary(), {RUNNING: 1})
+        # Kill the worker together with the pipeline it runs
+        os.killpg(hung.pid, signal.SIGKILL)
+        hung.wait()
+
+        # Nothing to claim while the lease is still valid, workers exit
+        self.assertEqual(self.worker().wait(timeout=60), 0)
+        self.assertEqual(queue.summary(), {RUNNING: 1})
+        time.sleep(1.5)
+        self.assertEqual(self.worker().wait(timeout=60), 0)
+        job = queue.jobs()[0]
+        queue.close()
+        self.assertEqual((job['state'], job['attempts']), (DONE, 2))
+        self.assertEqual(self.recorded(), ['sn1', 'sn1'])
+
+if __name__ == '__main__':
+    unittest.main()
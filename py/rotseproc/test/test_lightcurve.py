@@ -0,0 +1,53 @@
+"""
+Test the multi-target light curve store
+"""
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+import numpy as np
+from rotseproc.io.lightcurve import LightCurveStore
+
+def _upsert(path, i, barrier):
+    mjd = np.arange(20) + 56000.
+    store = LightCurveStore(path)
+    barrier.wait()
+    for n in range(10):
+        store.upsert('target{}'.format(i), mjd, np.full(20, 15. + i), np.full(20, 0.1))
+
+class TestLightCurveStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_upsert_replaces(self):
+        store = LightCurveStore(self.path)
+        store.upsert('sn1', [1., 2.], [15., 16.], [0.1, 0.1])
+        store.upsert('sn2', [1.], [17.], [0.2])
+        store.upsert('sn1', [3.], [14.], [0.1])
+        self.assertEqual(store.targets, ['sn1', 'sn2'])
+        self.assertEqual(list(store.get('sn1')['ROTSE_MAG']), [14.])
+        store.compact()
+        self.assertEqual(list(LightCurveStore(self.path).get('sn2')['MJD']), [1.])
+
+    def test_concurrent_upserts(self):
+        """
+        Pipelines upserting different targets at once all keep their light curves
+        """
+        ctx = multiprocessing.get_context('spawn')
+        barrier = ctx.Barrier(8)
+        procs = [ctx.Process(target=_upsert, args=(self.path, i, barrier)) for i in range(8)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        store = LightCurveStore(self.path)
+        self.assertEqual(len(store.targets), 8)
+        for i in range(8):
+            np.testing.assert_array_equal(store.get('target{}'.format(i))['ROTSE_MAG'], 15. + i)
+
+if __name__ == '__main__':
+    unittest.main()
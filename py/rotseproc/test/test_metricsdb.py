@@ -0,0 +1,115 @@
+"""
+Test the QA metrics history and the rolling references derived from it
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from rotseproc.exceptions import ParameterException
+from rotseproc.io.metricsdb import MetricsStore
+from rotseproc.rotse_config import Config
+
+CONFIG = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'config', 'config_supernova.yaml'))
+FIELD = 'sks0246+3652'
+
+class TestMetricsStore(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'qa_metrics.db')
+        self.store = MetricsStore(self.dbfile)
+        rng = np.random.default_rng(2)
+        # Older runs of the field drifted, the rolling reference only sees the last window
+        self.values = np.concatenate([rng.normal(30., 1., 20), rng.normal(12., 2., 60)])
+        for i, value in enumerate(self.values):
+            self.store.append('Coaddition', {'RMS': value, 'NOISE': [1., 2.], 'NAME': 'x'}, target='sn{}'.format(i),
+                              field=FIELD, telescope='3b', night=['130701', '130801'], runtime=1000. + i)
+        # Other fields, telescopes, steps and failed measurements don't count
+        self.store.append('Coaddition', {'RMS': 100.}, field='sks1234+5678', telescope='3b', runtime=5000.)
+        self.store.append('Coaddition', {'RMS': 100.}, field=FIELD, telescope='3a', runtime=5000.)
+        self.store.append('Source_Extraction', {'RMS': 100.}, field=FIELD, telescope='3b', runtime=5000.)
+        self.store.append('Coaddition', {'RMS': np.nan}, field=FIELD, telescope='3b', runtime=5001.)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def test_append(self):
+        # Only scalar numeric metrics are stored
+        rows = self.store.query('NOISE')
+        self.assertEqual(len(rows), 0)
+        rows = self.store.query('RMS', step='coaddition', field=FIELD, telescope='3b', limit=3)
+        np.testing.assert_array_equal(rows['runtime'], [5001., 1079., 1078.])
+        self.assertEqual(rows['night'][1], '130701 130801')
+
+    def test_reference(self):
+        """
+        Median and percentile bands of the last window runs, as reference - metric
+        """
+        ref = self.store.reference('RMS', step='Coaddition', field=FIELD, telescope='3b', window=51)
+        # The NaN run is in the window but not in the statistics
+        last = self.values[-50:]
+        expected = np.median(last)
+        nlo, nhi, wlo, whi = np.percentile(last, [16., 84., 2.5, 97.5])
+        self.assertAlmostEqual(ref['REF'][0], expected)
+        np.testing.assert_allclose(ref['NORMAL_RANGE'], [expected - nhi, expected - nlo])
+        np.testing.assert_allclose(ref['WARN_RANGE'], [expected - whi, expected - wlo])
+        self.assertLess(ref['WARN_RANGE'][0], ref['NORMAL_RANGE'][0])
+        self.assertGreater(ref['WARN_RANGE'][1], ref['NORMAL_RANGE'][1])
+
+        # Narrower bands with other percentiles
+        narrow = self.store.reference('RMS', step='Coaddition', field=FIELD, telescope='3b', window=51,
+                                      normal_pct=(25., 75.))
+        self.assertLess(np.ptp(narrow['NORMAL_RANGE']), np.ptp(ref['NORMAL_RANGE']))
+
+    def test_minruns(self):
+        self.assertIsNone(self.store.reference('RMS', step='Coaddition', field='sks1234+5678', telescope='3b'))
+        self.assertIsNotNone(self.store.reference('RMS', step='Coaddition', field='sks1234+5678', minruns=1))
+
+    def test_field_required(self):
+        with self.assertRaises(ParameterException):
+            self.store.reference('RMS', step='Coaddition', telescope='3b')
+
+class TestHistoryReferences(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'qa_metrics.db')
+        store = MetricsStore(self.dbfile)
+        for i in range(10):
+            store.append('Coaddition', {'RMS': 20. + i}, field=FIELD, telescope='3b', runtime=1000. + i)
+        store.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def qa_params(self, field):
+        config = Config(CONFIG, ['130701'], '3b', field, '02:46:00.0', '+36:52:00', datadir=self.testdir,
+                        outdir=os.path.join(self.testdir, 'sn1'), plots='noplots', metricsdb=self.dbfile)
+        pipeline = config.expand_config()['Pipeline']
+        return {qa['ClassName']: qa['kwargs']['param'] for step in pipeline for qa in step['QAs']}
+
+    def test_override(self):
+        """
+        Rolling references replace the configured ones of the QAs with enough history
+        """
+        params = self.qa_params(FIELD)
+        self.assertEqual(params['Image_Noise']['RMS_REF'], [24.5])
+        nlo, nhi = np.percentile(20. + np.arange(10), [16., 84.])
+        np.testing.assert_allclose(params['Image_Noise']['RMS_NORMAL_RANGE'], [24.5 - nhi, 24.5 - nlo])
+        # Other parameters of the QA are kept
+        self.assertEqual(params['Image_Noise']['NOISE_GRID'], [2, 2])
+        # QAs without history keep their configured references
+        self.assertEqual(params['Saturation']['SAT_FRACTION_REF'], [0.])
+
+    def test_no_field(self):
+        """
+        Targets without a field use the configured references, not those pooled over all fields
+        """
+        params = self.qa_params(None)
+        self.assertEqual(params['Image_Noise']['RMS_REF'], [10.])
+        self.assertEqual(params['Image_Noise']['RMS_NORMAL_RANGE'], [-20., 20.])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Test the native source extraction on synthetic images
+"""
+import unittest
+import numpy as np
+from astropy.wcs import WCS
+from rotseproc.pa import mock
+from rotseproc.pa.native import detect_sources
+
+SHAPE = (300, 300)
+
+class TestDetectSources(unittest.TestCase):
+
+    def setUp(self):
+        self.header = mock.mock_header(41.5, 36.9, SHAPE, 56500.)
+        rng = np.random.default_rng(3)
+        # Stars on a jittered grid 30 pixels apart, so none are blended
+        gy, gx = np.mgrid[20:SHAPE[0]:30, 20:SHAPE[1]:30]
+        x = (gx + rng.uniform(-5, 5, gx.shape)).ravel()
+        y = (gy + rng.uniform(-5, 5, gy.shape)).ravel()
+        ra, dec = WCS(self.header).all_pix2world(x, y, 0)
+        mag = rng.uniform(11., 16.5, x.size)
+        # One saturated star
+        mag[44] = 8.
+        self.image = mock.render_image(self.header, SHAPE, ra, dec, mag, rng)
+        self.catalog = mock.mock_catalog(self.header, SHAPE, ra, dec, mag, rng)
+        self.sources = detect_sources(self.image, self.header, satlevel=mock.SATLEVEL)
+
+        # Closest synthetic source of each detection
+        dist = np.hypot(self.sources['X_IMAGE'][:, None] - self.catalog['X_IMAGE'][None],
+                        self.sources['Y_IMAGE'][:, None] - self.catalog['Y_IMAGE'][None])
+        self.match = dist.argmin(axis=1)
+        self.dist = dist.min(axis=1)
+
+    def test_counts(self):
+        self.assertEqual(len(self.catalog), 100)
+        self.assertEqual(len(self.sources), len(self.catalog))
+        self.assertEqual(len(set(self.match)), len(self.catalog))
+        # The saturated star is flagged like SExtractor does
+        np.testing.assert_array_equal(self.sources['FLAGS'], self.catalog['FLAGS'][self.match])
+        self.assertEqual(int(np.count_nonzero(self.sources['FLAGS'] == 4)), 1)
+
+    def test_positions(self):
+        self.assertLess(self.dist.max(), 0.5)
+        cosdec = np.cos(np.radians(self.catalog['DELTA_J2000'][self.match]))
+        dra = (self.sources['ALPHA_J2000'] - self.catalog['ALPHA_J2000'][self.match]) * cosdec * 3600.
+        ddec = (self.sources['DELTA_J2000'] - self.catalog['DELTA_J2000'][self.match]) * 3600.
+        # Within the 0.3 arcsec scatter of the synthetic catalog
+        self.assertLess(np.max(np.hypot(dra, ddec)), 1.5)
+        np.testing.assert_allclose(np.median(self.sources['FWHM_IMAGE']), self.header['FWHM'], rtol=0.05)
+
+    def test_magnitudes(self):
+        clean = self.sources['FLAGS'] == 0
+        dmag = self.sources['MAG_AUTO'][clean] - self.catalog['MAG_AUTO'][self.match][clean]
+        err = np.hypot(self.sources['MAGERR_AUTO'][clean], self.catalog['MAGERR_AUTO'][self.match][clean])
+        self.assertLess(abs(np.median(dmag)), 0.01)
+        self.assertLess(np.max(np.abs(dmag) / err), 4.)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+Test atomic output and output directory locks
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from rotseproc.exceptions import LockException
+from rotseproc.io.output import OutputLock, atomic_output, temp_name
+
+class TestOutputLock(unittest.TestCase):
+
+    def setUp(self):
+        self.reduxdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.reduxdir, ignore_errors=True)
+
+    def touch(self, *path):
+        filename = temp_name(os.path.join(self.reduxdir, *path))
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        open(filename, 'w').close()
+        return filename
+
+    def test_atomic_output(self):
+        filename = os.path.join(self.reduxdir, 'product.txt')
+        with self.assertRaises(RuntimeError):
+            with atomic_output(filename) as tmpfile:
+                open(tmpfile, 'w').close()
+                raise RuntimeError
+        self.assertEqual(os.listdir(self.reduxdir), [])
+
+    def test_exclusive(self):
+        with OutputLock(self.reduxdir):
+            with self.assertRaises(LockException):
+                OutputLock(self.reduxdir).acquire()
+
+    def test_sweep_own_directories(self):
+        """
+        Locking the redux directory leaves temporary files of other targets' runs alone
+        """
+        own = self.touch('coadd', 'image', 'coadd_c.fit')
+        with OutputLock(os.path.join(self.reduxdir, 'sn1')):
+            other = self.touch('sn1', 'coadd', 'image', 'coadd_c.fit')
+            with OutputLock(self.reduxdir):
+                self.assertFalse(os.path.exists(own))
+                self.assertTrue(os.path.exists(other))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""
+Test the vectorized PA library functions
+"""
+import unittest
+import numpy as np
+from rotseproc.pa import palib
+
+class TestFrameQuality(unittest.TestCase):
+
+    def catalogs(self, magerr):
+        """ Stacked catalogs of frames with the given error functions of magnitude """
+        rng = np.random.default_rng(1)
+        nsrc = 200
+        seg = np.repeat(np.arange(len(magerr)), nsrc)
+        mag = rng.uniform(11., 18., seg.size)
+        err = np.concatenate([f(mag[seg == i]) for i, f in enumerate(magerr)])
+        data = {'MAG': mag, 'MAGERR': err, 'FWHM': np.full(seg.size, 2.5),
+                'BACKGROUND': np.full(seg.size, 500.), 'FLAGS': np.zeros(seg.size)}
+        return seg, data
+
+    def test_limiting_mag(self):
+        seg, data = self.catalogs([lambda m: 0.01 * 10**(0.4*(m - 13.))])
+        limit = palib.frame_quality(seg, 1, data)['LIMITING_MAG']
+        # magerr = 1.0857/5 at 13 + 2.5*log10(21.7)
+        self.assertAlmostEqual(limit[0], 13. + 2.5*np.log10(21.714), places=3)
+
+    def test_no_limit_from_flat_errors(self):
+        """
+        Flat errors or too few sources give no limiting magnitude instead of an extrapolation to infinity
+        """
+        rng = np.random.default_rng(2)
+        seg, data = self.catalogs([lambda m: 0.05 + 1e-9*rng.normal(size=m.size),
+                                   lambda m: 0.01 * 10**(0.4*(m - 13.))])
+        data['MAGERR'][200+5:] = np.nan
+        limit = palib.frame_quality(seg, 2, data)['LIMITING_MAG']
+        self.assertTrue(np.all(np.isnan(limit)))
+
+class TestLightCurveFeatures(unittest.TestCase):
+    """
+    The segmented reductions agree with fitting each target on its own
+    """
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        ids, mjd, mag, magerr = [], [], [], []
+        for tid in rng.permutation(200)[:40]:
+            n = rng.integers(0, 30)
+            t = np.sort(rng.uniform(56400., 56500., n))
+            peak = rng.uniform(56420., 56480.)
+            m = 15. + rng.uniform(0.002, 0.01)*(t - peak)**2 + rng.normal(0., 0.05, n)
+            e = np.full(n, 0.05)
+            # Outliers and non-detections
+            m[rng.random(n) < 0.1] -= 2.
+            m[rng.random(n) < 0.1] = np.nan
+            ids.append(np.full(n, tid))
+            mjd.append(t)
+            mag.append(m)
+            magerr.append(e)
+        # Points come in any order
+        order = rng.permutation(sum(len(t) for t in mjd))
+        self.ids, self.mjd, self.mag, self.magerr = [np.concatenate(a)[order] for a in (ids, mjd, mag, magerr)]
+
+    def reference(self, mjd, mag, magerr, window=30., nsigma=3., niter=3):
+        """ Features of one light curve with per-target numpy fits """
+        order = np.argsort(mjd, kind='stable')
+        mjd, mag, magerr = mjd[order], mag[order], magerr[order]
+        det = np.isfinite(mag) & np.isfinite(magerr)
+        features = {'NDET': det.sum(), 'MJD_FIRST': mjd.min(), 'MJD_LAST': mjd.max()}
+        nan = dict(PEAK_MAG=np.nan, PEAK_MJD=np.nan, FIT_PEAK_MAG=np.nan, FIT_PEAK_MJD=np.nan,
+                   RISE_RATE=np.nan, DECLINE_RATE=np.nan)
+        if det.sum() == 0:
+            features.update(nan)
+            return features
+        i = np.flatnonzero(det)[np.argmin(mag[det])]
+        features['PEAK_MAG'], features['PEAK_MJD'] = mag[i], mjd[i]
+        dt = mjd - mjd[i]
+
+        def slope(use):
+            if use.sum() < 2 or np.ptp(dt[use]) == 0:
+                return np.nan
+            return np.polyfit(dt[use], mag[use], 1)[0]
+        features['RISE_RATE'] = -slope(det & (dt <= 0))
+        features['DECLINE_RATE'] = slope(det & (dt >= 0))
+
+        use = det & (np.abs(dt) <= window)
+        for it in range(niter + 1):
+            if use.sum() < 4:
+                c2 = c1 = c0 = np.nan
+                break
+            c2, c1, c0 = np.polyfit(dt[use], mag[use], 2)
+            if it == niter:
+                break
+            resid = mag[use] - (c0 + c1*dt[use] + c2*dt[use]**2)
+            rms = np.sqrt(np.sum(resid**2) / max(use.sum() - 3, 1))
+            use[np.flatnonzero(use)[np.abs(resid) > nsigma*rms]] = False
+        dt_peak = -c1/(2*c2) if c2 > 0 else np.nan
+        if not np.abs(dt_peak) <= window:
+            dt_peak = np.nan
+        features['FIT_PEAK_MJD'] = mjd[i] + dt_peak
+        features['FIT_PEAK_MAG'] = c0 + c1*dt_peak + c2*dt_peak**2
+        return features
+
+    def test_features(self):
+        features = palib.light_curve_features(self.ids, self.mjd, self.mag, self.magerr)
+        np.testing.assert_array_equal(features['TARGET_ID'], np.unique(self.ids))
+        self.assertTrue(np.isfinite(features['FIT_PEAK_MAG']).sum() > 20)
+        for k, tid in enumerate(features['TARGET_ID']):
+            this = self.ids == tid
+            expected = self.reference(self.mjd[this], self.mag[this], self.magerr[this])
+            for key, value in expected.items():
+                np.testing.assert_allclose(features[key][k], value, rtol=1e-6, atol=1e-6, equal_nan=True,
+                                           err_msg='{} of target {}'.format(key, tid))
+
+class TestZeroPoints(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.nepoch, self.nstar = 10, 30
+        self.epoch = np.repeat(np.arange(self.nepoch), self.nstar)
+        self.star = np.tile(np.arange(self.nstar), self.nepoch)
+        self.refmag = rng.uniform(12., 16., self.nstar)
+        self.zp = rng.normal(0., 0.3, self.nepoch)
+        self.magerr = np.full(self.epoch.size, 0.02)
+        self.mag = self.refmag[self.star] - self.zp[self.epoch] + rng.normal(0., 0.02, self.epoch.size)
+        # One 2-3 mag outlier in each of the first two epochs
+        self.mag[3] += 2.5
+        self.mag[self.nstar + 7] -= 3.
+
+    def test_outliers_clipped(self):
+        """
+        Only the outliers are clipped, whatever the number of iterations
+        """
+        for niter in (1, 4, 5, 6):
+            result = palib.solve_zero_points(self.epoch, self.star, self.mag, self.magerr, self.nepoch, self.nstar,
+                                             refmag=self.refmag, niter=niter)
+            np.testing.assert_array_equal(result['NCLIP'], [1, 1] + [0]*(self.nepoch - 2))
+            np.testing.assert_allclose(result['ZP'], self.zp, atol=0.015)
+
+    def test_relative_outliers_clipped(self):
+        result = palib.solve_zero_points(self.epoch, self.star, self.mag, self.magerr, self.nepoch, self.nstar)
+        np.testing.assert_array_equal(result['NCLIP'], [1, 1] + [0]*(self.nepoch - 2))
+        np.testing.assert_allclose(result['ZP'], self.zp - self.zp.mean(), atol=0.015)
+
+class TestCalibrateLightCurve(unittest.TestCase):
+
+    def setUp(self):
+        self.zp = {'MJD': np.array([56401.2, 56404.2, np.nan]), 'ZP': np.array([-10.5, -10.3, -10.4]),
+                   'ZP_ERR': np.array([0.03, 0.04, 0.02])}
+        self.mjd = np.array([56404.25, 56401.15, 56410.2])
+        self.mag = np.array([25.1, 25.6, 25.3])
+        self.magerr = np.array([0.04, 0.03, 0.05])
+
+    def test_absolute(self):
+        mag, magerr, zp, zperr = palib.calibrate_light_curve(self.mjd, self.mag, self.magerr, self.zp)
+        np.testing.assert_allclose(mag, [14.8, 15.1, np.nan])
+        np.testing.assert_allclose(magerr, [np.hypot(0.04, 0.04), np.hypot(0.03, 0.03), np.nan])
+        np.testing.assert_allclose(zp, [-10.3, -10.5, np.nan])
+
+    def test_relative(self):
+        """
+        Relative zero points are offsets between epochs and leave the magnitudes alone
+        """
+        mag, magerr, zp, zperr = palib.calibrate_light_curve(self.mjd, self.mag, self.magerr, self.zp, absolute=False)
+        np.testing.assert_array_equal(mag, self.mag)
+        np.testing.assert_array_equal(magerr, self.magerr)
+        np.testing.assert_allclose(zperr, [0.04, 0.03, np.nan])
+
+
+if __name__ == '__main__':
+    unittest.main()
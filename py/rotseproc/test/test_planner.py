@@ -0,0 +1,141 @@
+"""
+Test the workload planner and its cost model
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from rotseproc.fieldshare import FIELD_STEPS, field_dir
+from rotseproc.io.metricsdb import MetricsStore
+from rotseproc.pa import mock
+from rotseproc.planner import CostModel, plan_targets
+
+FIELD = 'sks0246+3652'
+STEPS = ['Find_Data', 'Frame_Quality', 'Coaddition', 'Source_Extraction', 'Zero_Points', 'Make_Subimages', 'Photometry']
+
+def elapsed(step, nframes, nnights):
+    """ Run time of the synthetic timing history """
+    coeffs = {'Coaddition': (2., 0.5, 3.), 'Photometry': (1., 0.1, 0.)}
+    c = coeffs[step] if step in coeffs else (0.5, 0.01, 0.)
+    return c[0] + c[1]*nframes + c[2]*nnights
+
+def record_timings(dbfile, runs, steps=STEPS):
+    """ Synthetic step timings of runs of (NFRAMES, NNIGHTS) """
+    store = MetricsStore(dbfile)
+    for i, (nframes, nnights) in enumerate(runs):
+        for step in steps:
+            store.append(step, {'ELAPSED': elapsed(step, nframes, nnights), 'NFRAMES': nframes,
+                                'NNIGHTS': nnights, 'NBYTES': 1.e6*nframes},
+                         target='sn{}'.format(i), field=FIELD, telescope='3b', runtime=1000. + i)
+    return store
+
+class TestCostModel(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.testdir, 'qa_metrics.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def test_linear_fit(self):
+        rng = np.random.default_rng(1)
+        store = record_timings(self.dbfile, zip(rng.integers(10, 300, 20), rng.integers(2, 40, 20)))
+        model = CostModel.from_store(store, ['Coaddition', 'Photometry', 'Image_Differencing'])
+        store.close()
+        np.testing.assert_allclose(model.coeffs['Coaddition'], [2., 0.5, 3.], atol=1e-8)
+        np.testing.assert_allclose(model.coeffs['Photometry'], [1., 0.1, 0.], atol=1e-8)
+        self.assertAlmostEqual(model.estimate('Coaddition', {'NFRAMES': 100, 'NNIGHTS': 10}), 82.)
+        # Steps without timings can't be estimated
+        self.assertNotIn('Image_Differencing', model.coeffs)
+        self.assertIsNone(model.estimate('Image_Differencing', {'NFRAMES': 100, 'NNIGHTS': 10}))
+
+    def test_few_runs(self):
+        """
+        With fewer than 3 runs the model is the median time per frame
+        """
+        store = record_timings(self.dbfile, [(100, 10), (50, 5)], steps=['Coaddition'])
+        model = CostModel.from_store(store, ['Coaddition'])
+        store.close()
+        self.assertEqual(model.coeffs['Coaddition'], [0., float(np.median([82./100., 42./50.])), 0.])
+
+    def test_window(self):
+        """
+        Only the last window runs calibrate the model
+        """
+        store = record_timings(self.dbfile, [(n, 5) for n in range(10, 30)], steps=['Coaddition'])
+        store.append('Coaddition', {'ELAPSED': 1.e4, 'NFRAMES': 10., 'NNIGHTS': 5.}, runtime=0.)
+        model = CostModel.from_store(store, ['Coaddition'], window=20)
+        store.close()
+        # The two frame and night terms can't be told apart with a fixed number of nights
+        self.assertAlmostEqual(model.coeffs['Coaddition'][1], 0.5)
+        self.assertAlmostEqual(model.estimate('Coaddition', {'NFRAMES': 20, 'NNIGHTS': 5}), elapsed('Coaddition', 20, 5))
+
+class TestPlanTargets(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.testdir = tempfile.mkdtemp()
+        cls.datadir = os.path.join(cls.testdir, 'data')
+        cls.nights = ['130701', '130703', '130705', '130707', '130709']
+        cls.data = mock.make_synthetic_data(cls.datadir, os.path.join(cls.testdir, 'template'), '3b', FIELD,
+                                            cls.nights, nframes=2, shape=(32, 32), nstars=10)
+        cls.conf = {'Pipeline': STEPS, 'Algorithms': {'Find_Data': {'TimeBeforeDiscovery': 1, 'TimeAfterDiscovery': 2}}}
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.testdir, ignore_errors=True)
+
+    def target(self, first, last, field=FIELD, **kwargs):
+        args = {'night': [first, last], 'telescope': '3b', 'field': field, 'ra': None, 'dec': None}
+        args.update(kwargs)
+        return args
+
+    def nbytes(self, nights):
+        files = [f for f in self.data['IMAGES'] + self.data['PRODS'] if os.path.basename(f)[:6] in nights]
+        return sum(os.path.getsize(f) for f in files)
+
+    def test_workload(self):
+        workload = plan_targets([('sn1', self.target('130702', '130708', field='0246+3652'))], self.conf, self.datadir)
+        plan = workload['TARGETS'][0]
+        # The field prefix is found from the data
+        self.assertEqual(plan['FIELD'], FIELD)
+        self.assertEqual(sorted(plan['NIGHTS']), ['130703', '130705', '130707'])
+        self.assertEqual((plan['NFRAMES'], plan['NNIGHTS']), (6, 3))
+        self.assertEqual(plan['NBYTES'], self.nbytes(['130703', '130705', '130707']))
+        self.assertEqual(plan['STEPS'], {step: None for step in STEPS})
+
+    def test_shared_field(self):
+        """
+        Frames of targets sharing a field are counted once, by the field job
+        """
+        fielddir = field_dir(FIELD, '3b', '130701', '130709')
+        targets = [(fielddir, self.target('130701', '130709', steps=list(FIELD_STEPS))),
+                   ('sn1', self.target('130701', '130705', shared_field=fielddir)),
+                   ('sn2', self.target('130703', '130709', shared_field=fielddir)),
+                   ('sn3', self.target('130707', '130709'))]
+        dbfile = os.path.join(self.testdir, 'qa_metrics.db')
+        record_timings(dbfile, [(n, n//2) for n in range(4, 20)]).close()
+        workload = plan_targets(targets, self.conf, self.datadir, dbfile)
+        plans = {p['TARGET']: p for p in workload['TARGETS']}
+
+        self.assertEqual([plans[t]['NFRAMES'] for t in (fielddir, 'sn1', 'sn2', 'sn3')], [10, 6, 8, 4])
+        self.assertEqual(workload['TOTAL']['NTARGETS'], 4)
+        self.assertEqual(workload['TOTAL']['NFRAMES'], 14)
+        self.assertEqual(workload['TOTAL']['NNIGHTS'], 7)
+        self.assertEqual(workload['TOTAL']['NBYTES'], self.nbytes(self.nights) + self.nbytes(['130707', '130709']))
+
+        # The field job runs the field steps, the targets sharing it the others
+        self.assertEqual(sorted(plans[fielddir]['STEPS']), sorted(FIELD_STEPS))
+        for target in ('sn1', 'sn2'):
+            self.assertEqual(plans[target]['SHARED_FIELD'], fielddir)
+            self.assertEqual(sorted(plans[target]['STEPS']), ['Make_Subimages', 'Photometry'])
+        self.assertEqual(sorted(plans['sn3']['STEPS']), sorted(STEPS))
+        for plan in plans.values():
+            expected = sum(elapsed(step, plan['NFRAMES'], plan['NNIGHTS']) for step in plan['STEPS'])
+            self.assertAlmostEqual(plan['ESTIMATED_SECONDS'], expected)
+        self.assertAlmostEqual(workload['TOTAL']['ESTIMATED_SECONDS'], sum(p['ESTIMATED_SECONDS'] for p in plans.values()))
+
+if __name__ == '__main__':
+    unittest.main()
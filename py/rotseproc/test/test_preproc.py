@@ -0,0 +1,137 @@
+"""
+Test staging preprocessed files night by night
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from rotseproc.io.preproc import NightStream
+
+class TestNightStream(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        self.srcdir = os.path.join(self.testdir, 'data')
+        os.makedirs(self.srcdir)
+        self.outdir = self.testdir
+        self.listed = []
+        self.staged = []
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def source(self, nnight=8, nframe=2):
+        """
+        Generator of the source files of each night, recording the listed nights
+        """
+        for n in range(nnight):
+            date = '1307{:02d}'.format(n + 1)
+            images, prods = [], []
+            for e in range(nframe):
+                image = os.path.join(self.srcdir, '{}_sks0246+3652_3b{:03d}.fit'.format(date, e))
+                prod = image.replace('.fit', '_cobj.fit')
+                for f in (image, prod):
+                    with open(f, 'w') as out:
+                        out.write(date)
+                images.append(image)
+                prods.append(prod)
+            self.listed.append(date)
+            yield date, images, prods
+
+    def stage(self, images, prods, fail=None):
+        if fail is not None and images[0].split(os.sep)[-1][:6] == fail:
+            raise ValueError("Can't stage {}".format(fail))
+        for files, sub in ((images, 'image'), (prods, 'prod')):
+            outdir = os.path.join(self.outdir, 'preproc', sub)
+            os.makedirs(outdir, exist_ok=True)
+            for f in files:
+                shutil.copy(f, outdir)
+        self.staged.append(os.path.basename(images[0])[:6])
+
+    def wait(self, condition, timeout=5.):
+        end = time.time() + timeout
+        while not condition() and time.time() < end:
+            time.sleep(0.01)
+
+    def test_prefetch_depth(self):
+        """
+        Nights are listed and staged at most depth nights ahead of the consumer
+        """
+        stream = NightStream(self.source(), self.stage, self.testdir, depth=2)
+        self.assertEqual(self.listed, [])
+        for n, (date, images, prods) in enumerate(stream):
+            # The consumed night, depth nights waiting in the queue and one blocked on it
+            self.wait(lambda: len(self.staged) >= min(n + 4, 8))
+            time.sleep(0.2)
+            self.assertEqual(len(self.staged), min(n + 4, 8))
+            self.assertEqual(len(self.listed), len(self.staged))
+            self.assertEqual((len(images), len(prods)), (2, 2))
+        self.assertEqual(self.staged, self.listed)
+        self.assertEqual(stream.workload['NFRAMES'], 16)
+        self.assertEqual(stream.workload['NNIGHTS'], 8)
+        with self.assertRaises(RuntimeError):
+            list(stream)
+
+    def test_reject(self):
+        """
+        Listing all images lists the whole source, frames rejected before staging aren't copied
+        """
+        stream = NightStream(self.source(4), self.stage, self.testdir)
+        self.assertEqual(len(stream.images), 8)
+        self.assertEqual(len(self.listed), 4)
+        stream.reject([i for i in stream.images if '3b001' in i])
+        nights = list(stream)
+        self.assertEqual([len(images) for date, images, prods in nights], [1, 1, 1, 1])
+        self.assertEqual(len(stream.images), 4)
+
+    def test_producer_error(self):
+        """
+        Staging errors are raised in the consumer after the nights staged before
+        """
+        stream = NightStream(self.source(), lambda i, p: self.stage(i, p, fail='130703'), self.testdir)
+        dates = []
+        with self.assertRaisesRegex(ValueError, "130703"):
+            for date, images, prods in stream:
+                dates.append(date)
+        self.assertEqual(dates, ['130701', '130702'])
+
+    def test_early_stop(self):
+        """
+        A consumer stopping early stops the producer, also while it waits on a full queue
+        """
+        nthread = threading.active_count()
+        stream = NightStream(self.source(), self.stage, self.testdir, depth=1)
+        nights = iter(stream)
+        next(nights)
+        self.wait(lambda: len(self.staged) >= 3)
+        nights.close()
+        self.assertEqual(threading.active_count(), nthread)
+        self.assertEqual(len(self.staged), 3)
+        self.assertEqual(len(self.listed), 3)
+
+    def test_remove(self):
+        """
+        The staged files of a night are removed once the next one is asked for, unless kept
+        """
+        stream = NightStream(self.source(3), self.stage, self.testdir)
+        consumed = []
+        for date, images, prods in stream:
+            self.assertTrue(all(os.path.exists(f) for f in images + prods))
+            self.assertTrue(all(os.path.dirname(f).startswith(os.path.join(self.testdir, 'preproc')) for f in images))
+            for files in consumed:
+                self.assertFalse(any(os.path.exists(f) for f in files))
+            consumed.append(images + prods)
+        self.assertFalse(any(os.path.exists(f) for files in consumed for f in files))
+        # Source files are never removed
+        self.assertEqual(len(os.listdir(self.srcdir)), 12)
+
+        self.outdir = os.path.join(self.testdir, 'kept')
+        kept = NightStream(self.source(3), self.stage, self.outdir, keep=True)
+        files = [f for date, images, prods in kept for f in images + prods]
+        self.assertEqual(len(files), 12)
+        self.assertTrue(all(os.path.exists(f) for f in files))
+
+if __name__ == '__main__':
+    unittest.main()
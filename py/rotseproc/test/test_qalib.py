@@ -0,0 +1,153 @@
+"""
+Test the fused QA kernels
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+from rotseproc import plotservice
+from rotseproc.qa import qalib, qaalgs
+
+class TestCatalogQA(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        qalib._catalog_qa_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def write_catalogs(self):
+        """
+        SExtractor catalogs of three epochs of one field, shifted by known offsets from the first
+        """
+        rng = np.random.default_rng(5)
+        nstar = 150
+        ra0, dec0 = 41.5 + rng.uniform(-0.5, 0.5, nstar), 60. + rng.uniform(-0.5, 0.5, nstar)
+        mag = rng.uniform(11., 15., nstar)
+        # Offsets in arcsec along RA (on the sky) and DEC, and ellipticity of the bright sources
+        epochs = [(0., 0., 0.10, nstar), (1.0, -0.5, 0.20, 120), (0., 2.0, 0.30, 100)]
+        catalogs = []
+        for i, (dra, ddec, ell, n) in enumerate(epochs):
+            t = Table()
+            t['ALPHA_J2000'] = ra0[:n] + dra / 3600. / np.cos(np.radians(dec0[:n]))
+            t['DELTA_J2000'] = dec0[:n] + ddec / 3600.
+            t['MAG_AUTO'] = mag[:n]
+            t['MAGERR_AUTO'] = np.full(n, 0.02)
+            t['FWHM_IMAGE'] = np.full(n, 2.5)
+            t['BACKGROUND'] = np.full(n, 500.)
+            t['ELLIPTICITY'] = np.full(n, ell)
+            t['FLAGS'] = np.zeros(n, dtype=np.int16)
+            # Faint and flagged sources don't count
+            t['MAGERR_AUTO'][:10] = 0.3
+            t['ELLIPTICITY'][:10] = 0.9
+            t['FLAGS'][10:20] = 4
+            t['ELLIPTICITY'][10:20] = 0.9
+            t['ALPHA_J2000'][10:20] += 30. / 3600.
+            filename = os.path.join(self.testdir, '13070{}_sks0246+3652_3b_cobj.fit'.format(i+1))
+            t.write(filename)
+            catalogs.append(filename)
+        return catalogs
+
+    def test_metrics(self):
+        catalogs = self.write_catalogs()
+        result = qalib.catalog_qa(catalogs)
+        self.assertEqual(result['EPOCHS'], [os.path.basename(c) for c in catalogs])
+        np.testing.assert_array_equal(result['NSOURCES'], [150, 120, 100])
+        np.testing.assert_allclose(result['ELLIPTICITY'], [0.1, 0.2, 0.3])
+        # Residuals against the epoch with most bright sources, which has none itself
+        np.testing.assert_allclose(result['ASTROM_DRA'], [np.nan, 1.0, 0.], atol=1e-3)
+        np.testing.assert_allclose(result['ASTROM_DDEC'], [np.nan, -0.5, 2.0], atol=1e-3)
+        np.testing.assert_allclose(result['ASTROM_RESID'], [np.nan, np.hypot(1.0, 0.5), 2.0], atol=1e-3)
+
+    def test_match_radius(self):
+        """
+        Epochs shifted by more than the match radius have no residuals
+        """
+        result = qalib.catalog_qa(self.write_catalogs(), radius=1.5)
+        np.testing.assert_allclose(result['ASTROM_RESID'], [np.nan, np.hypot(1.0, 0.5), np.nan], atol=1e-3)
+
+    def test_shared(self):
+        """
+        QAs asking for the same catalogs share one result
+        """
+        catalogs = self.write_catalogs()
+        self.assertIs(qalib.catalog_qa(catalogs), qalib.catalog_qa(list(catalogs)))
+        self.assertIsNot(qalib.catalog_qa(catalogs[:2]), qalib.catalog_qa(catalogs))
+
+class TestImageQA(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        qalib._image_qa_cache.clear()
+        plotservice.setup_plot_service('off')
+
+    def tearDown(self):
+        plotservice.setup_plot_service('inline')
+        shutil.rmtree(self.testdir, ignore_errors=True)
+
+    def write_images(self, nimage=3):
+        rng = np.random.default_rng(6)
+        images = []
+        for i in range(nimage):
+            data = rng.normal(500., 10., (40, 60)).astype(np.float32)
+            data[:2] = 0.
+            data[5, :4] = np.nan
+            data[10, 10:13] = 40000.
+            hdu = fits.PrimaryHDU(data)
+            hdu.header['SATCNTS'] = 30000.
+            filename = os.path.join(self.testdir, 'image{}.fit'.format(i))
+            hdu.writeto(filename)
+            images.append(filename)
+        return images
+
+    def test_image_stats(self):
+        """
+        The in place metrics match direct ones of the good (finite non-zero) pixels
+        """
+        filename = self.write_images(1)[0]
+        data = fits.getdata(filename).astype(np.float32)
+        good = np.isfinite(data) & (data != 0)
+        values = data[good]
+        stats = qalib.image_stats(filename, grid=(2, 3))
+        self.assertTrue(np.isnan(stats['MEDIAN']))
+        self.assertAlmostEqual(stats['BACKGROUND'], np.median(values), places=3)
+        self.assertAlmostEqual(stats['RMS'], 1.4826 * np.median(np.abs(values - np.median(values))), places=3)
+        self.assertAlmostEqual(stats['NAN_FRACTION'], 4. / data.size)
+        self.assertAlmostEqual(stats['ZERO_FRACTION'], 120. / data.size)
+        self.assertAlmostEqual(stats['SAT_FRACTION'], 3. / data.size)
+        self.assertEqual(stats['NOISE'].shape, (6,))
+        np.testing.assert_allclose(stats['NOISE'], 10., rtol=0.5)
+
+        # Without bad pixels the median is of all pixels
+        data[~good] = 500.
+        fits.writeto(filename, data, overwrite=True)
+        self.assertAlmostEqual(qalib.image_stats(filename)['MEDIAN'], np.median(data), places=3)
+
+    def test_shared(self):
+        """
+        The image QAs of one step read each image once
+        """
+        images = self.write_images()
+        param = {'NOISE_GRID': [2, 2]}
+        for key, ref in [('RMS', 10.), ('SAT_FRACTION', 0.), ('BAD_FRACTION', 0.), ('GRADIENT', 0.)]:
+            param.update({key + '_REF': ref, key + '_NORMAL_RANGE': [-1e3, 1e3], key + '_WARN_RANGE': [-2e3, 2e3]})
+        qas = [cls(None, {'kwargs': {'param': param}})
+               for cls in (qaalgs.Image_Noise, qaalgs.Saturation, qaalgs.Bad_Pixels, qaalgs.Background_Gradient)]
+
+        with mock.patch('rotseproc.qa.qalib.image_stats', wraps=qalib.image_stats) as image_stats:
+            for qa in qas:
+                inputs = qaalgs.get_inputs(images, param=param, paname='Preprocessing', program='supernova',
+                                           qafile=os.path.join(self.testdir, qa.name + '.yaml'),
+                                           qafig=os.path.join(self.testdir, qa.name + '.png'))
+                retval = qa.run_qa(images, inputs)
+                self.assertEqual(retval['STATUS'], 'NORMAL')
+        self.assertEqual(sorted(c.args[0] for c in image_stats.call_args_list), images)
+        self.assertAlmostEqual(qas[1].metrics(qalib.image_qa(images))[0], 3. / 2400)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+Test the WCS reprojection with cached field maps
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy.wcs import WCS
+from scipy.ndimage import map_coordinates
+from rotseproc.reproject import PixelMap, ReprojectionCache, _transform
+
+SHAPE = (96, 128)
+
+def make_wcs(dx=0., dy=0., rotation=0., scale=3.3):
+    """
+    TAN WCS of a field with scale"/pixel, pointed (dx, dy) pixels away from the reference
+    """
+    scale = scale / 3600.
+    c, s = np.cos(np.radians(rotation)), np.sin(np.radians(rotation))
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crpix = [SHAPE[1] / 2., SHAPE[0] / 2.]
+    wcs.wcs.crval = [41.5 - dx * scale / np.cos(np.radians(36.9)), 36.9 + dy * scale]
+    wcs.wcs.cd = scale * np.array([[-c, s], [s, c]])
+    return wcs
+
+class TestReprojection(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        rng = np.random.RandomState(1)
+        self.data = rng.normal(100., 10., SHAPE).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir, ignore_errors=True)
+
+    def test_apply_map_coordinates(self):
+        """
+        The gather map interpolates like map_coordinates at order 1
+        """
+        wcs_in, wcs_out = make_wcs(3.37, -5.81, rotation=0.4), make_wcs()
+        out = PixelMap.compute(wcs_in, SHAPE, wcs_out, SHAPE).apply(self.data)
+
+        y, x = np.indices(SHAPE, dtype=float)
+        xin, yin = _transform(wcs_in, wcs_out, x.ravel(), y.ravel())
+        expected = map_coordinates(self.data.astype(float), [yin, xin], order=1, mode='constant',
+                                   cval=np.nan).reshape(SHAPE)
+        valid = np.isfinite(out)
+        self.assertGreater(valid.sum(), 0.8 * out.size)
+        np.testing.assert_allclose(out[valid], expected[valid], rtol=1e-5)
+        # Pixels outside the input image are filled
+        inside = (xin >= 0) & (xin <= SHAPE[1]-1) & (yin >= 0) & (yin <= SHAPE[0]-1)
+        np.testing.assert_array_equal(valid.ravel(), inside)
+
+    def test_jittered_frames(self):
+        """
+        Frames of a field pointed up to tens of pixels apart share one field map
+        """
+        cache = ReprojectionCache(self.cachedir)
+        shape = (256, 256)
+        # Pixel coordinates as images, so the reprojections give the input coordinates
+        coords = np.array(np.indices(shape)[::-1], dtype=np.float32)
+        wcs_out = make_wcs(scale=13.2)
+        y, x = np.indices(shape, dtype=float)
+        frames = [(0.4, 0.2, 0.), (12.71, -9.33, 0.), (-24.06, 3.52, 0.), (37.9, 30.61, 0.), (5.5, -3.1, 0.3)]
+        for dx, dy, rotation in frames:
+            wcs_in = make_wcs(dx, dy, rotation, scale=13.2)
+            xin, yin = _transform(wcs_in, wcs_out, x.ravel(), y.ravel())
+            out = cache.reproject_frames([(c, wcs_in) for c in coords], wcs_out, shape)
+            inner = np.isfinite(out[0]).ravel() & (xin > 1) & (xin < shape[1]-2) & (yin > 1) & (yin < shape[0]-2)
+            self.assertGreater(inner.sum(), 0.6 * inner.size)
+            self.assertLess(np.max(np.abs(out[0].ravel() - xin)[inner]), 0.05)
+            self.assertLess(np.max(np.abs(out[1].ravel() - yin)[inner]), 0.05)
+        self.assertEqual((cache.misses, cache.hits), (1, len(frames) - 1))
+
+        # Frames of another size need their own field map
+        cache.reproject(coords[0, :128], make_wcs(scale=13.2), wcs_out, shape)
+        self.assertEqual(cache.misses, 2)
+
+    def test_disk_cache(self):
+        """
+        Field maps are reused from the cache directory by later runs
+        """
+        wcs_out = make_wcs()
+        first = ReprojectionCache(self.cachedir).reproject(self.data, make_wcs(1.5, 0.5), wcs_out, SHAPE)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+        cache = ReprojectionCache(self.cachedir)
+        frames = [(self.data, make_wcs(1.5, 0.5)), (self.data, make_wcs(-2.25, 3.)), (self.data, wcs_out)]
+        out = cache.reproject_frames(frames, wcs_out, SHAPE)
+        self.assertEqual((cache.misses, cache.hits, cache.identities), (0, 2, 1))
+        np.testing.assert_allclose(out[0], first, atol=1e-3)
+        np.testing.assert_array_equal(out[2], self.data)
+
+if __name__ == '__main__':
+    unittest.main()
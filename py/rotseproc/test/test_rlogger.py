@@ -0,0 +1,35 @@
+"""
+Test queued logging
+"""
+import io
+import json
+import logging
+import unittest
+from rotseproc import rlogger
+
+class TestJSONLogging(unittest.TestCase):
+
+    def tearDown(self):
+        rlogger.setup_logging(logging.INFO)
+
+    def test_exception_field(self):
+        """
+        Tracebacks go to the exception field of JSON records, not into the message
+        """
+        out = io.StringIO()
+        rlogger.setup_logging(logging.INFO, jsonfmt=True, stream=out)
+        with rlogger.log_context(target='sn1', step='Coaddition'):
+            try:
+                1/0
+            except ZeroDivisionError:
+                logging.getLogger('ROTSE-III').error("Failed to run %s", 'PA', exc_info=True)
+        rlogger.shutdown_logging()
+
+        record = json.loads(out.getvalue())
+        self.assertEqual(record['message'], 'Failed to run PA')
+        self.assertIn('ZeroDivisionError', record['exception'])
+        self.assertEqual(record['target'], 'sn1')
+        self.assertEqual(record['step'], 'Coaddition')
+
+if __name__ == '__main__':
+    unittest.main()